@@ -43,9 +43,9 @@ except Exception as e:
 # local imports
 from default_prefs import default_prefs
 from constants import contributes_to, version
-from plex_api_helper import plex_listener, start_queue_threads, update_plex_item
+from plex_api_helper import plex_listener, q, start_queue_threads, update_themerr_db_cache
 import migration_helper
-from scheduled_tasks import setup_scheduling
+from scheduled_tasks import run_threaded, setup_scheduling
 from webapp import start_server
 
 # variables
@@ -122,14 +122,28 @@ def ValidatePrefs():
 
             # special cases
             int_greater_than_zero = [
+                'int_full_update_interval',
                 'int_plexapi_plexapi_timeout',
-                'int_plexapi_upload_threads'
+                'int_plexapi_upload_threads',
+                'int_pipeline_resolve_threads',
+                'int_pipeline_resolve_batch_size',
+                'int_pipeline_lookup_threads',
+                'int_pipeline_extract_threads',
+                'int_themerr_db_fetch_threads',
             ]
             for test in int_greater_than_zero:
                 if key == test and int(Prefs[key]) <= 0:
                     Log.Error("Setting '%s' must be greater than 0; Value '%s'" % (key, Prefs[key]))
                     error_message += "Setting '%s' must be greater than 0; Value '%s'<br/>" % (key, Prefs[key])
 
+            int_not_negative = [
+                'int_themerr_db_max_staleness',
+            ]
+            for test in int_not_negative:
+                if key == test and int(Prefs[key]) < 0:
+                    Log.Error("Setting '%s' must be 0 or greater; Value '%s'" % (key, Prefs[key]))
+                    error_message += "Setting '%s' must be 0 or greater; Value '%s'<br/>" % (key, Prefs[key])
+
             # restart webserver if required
             requires_restart = [
                 'str_webapp_http_host',
@@ -174,8 +188,8 @@ def Start():
     <https://web.archive.org/web/https://dev.plexapp.com/docs/channels/basics.html#predefined-functions>`_
     for more information.
 
-    Preferences are validated, then additional threads are started for the web server, queue, plex listener, and
-    scheduled tasks.
+    Preferences are validated, then additional threads are started for the web server, ThemerrDB cache refresh, queue,
+    plex listener, and scheduled tasks.
 
     Examples
     --------
@@ -192,6 +206,10 @@ def Start():
     start_server()  # start the web server
     Log.Debug('web server started.')
 
+    # the ThemerrDB index was restored from disk when imported, refresh it in the background if it is stale
+    run_threaded(target=update_themerr_db_cache, daemon=True)
+    Log.Debug('ThemerrDB cache refresh started.')
+
     start_queue_threads()  # start queue threads
     Log.Debug('queue threads started.')
 
@@ -356,6 +374,9 @@ class Themerr(object):
         <https://web.archive.org/web/https://dev.plexapp.com/docs/agents/update.html>`_
         for more information.
 
+        The item is added to the ``agent`` lane of the Themerr-plex work queue, which is served ahead of the
+        scheduled update of all items.
+
         Parameters
         ----------
         metadata : MetadataModel
@@ -384,7 +405,7 @@ class Themerr(object):
                   (metadata, media, lang, force))
 
         rating_key = int(media.id)  # rating key of plex item
-        update_plex_item(rating_key=rating_key)
+        q.put_unique(item=rating_key, lane='agent')  # processed ahead of the scheduled update
 
         return metadata
 
@@ -15,10 +15,17 @@ default_prefs = dict(
     bool_update_collection_metadata_plex_movie='False',
     bool_update_collection_metadata_legacy='True',
     int_update_themes_interval='60',
+    int_full_update_interval='24',
     int_update_database_cache_interval='60',
+    int_themerr_db_fetch_threads='4',
+    int_themerr_db_max_staleness='168',
     int_plexapi_plexapi_timeout='180',
     int_plexapi_upload_retries_max='3',
     int_plexapi_upload_threads='3',
+    int_pipeline_resolve_threads='2',
+    int_pipeline_resolve_batch_size='50',
+    int_pipeline_lookup_threads='2',
+    int_pipeline_extract_threads='2',
     str_youtube_cookies='',
     enum_webapp_locale='en',
     str_webapp_http_host='0.0.0.0',
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 # standard imports
+from itertools import chain
 import json
 import os
 from threading import Lock
@@ -211,16 +212,17 @@ class MigrationHelper:
                 Log.Warn('ReadTimeout occurred while unlocking all themes for section: {}, will fallback to '
                          'individual item unlocking'.format(section.title))
 
-            # get all the items in the section
-            media_items = section.all()  # this is redundant, assuming unlockAllField() works on movies
+            # get all the items in the section, one page at a time
+            # this is redundant, assuming unlockAllField() works on movies
+            media_items = plex_api_helper.iter_section_items(section=section)
 
             # collections were added in v0.3.0, but collect them as well for anyone who may have used a nightly build
             # get all collections in the section
-            collections = section.collections()
+            collections = plex_api_helper.iter_section_items(section=section, libtype='collection')
 
-            # combine the items and collections into one list
+            # chain the items and collections
             # this is done so that we can process both items and collections in the same loop
-            all_items = media_items + collections
+            all_items = chain(media_items, collections)
 
             for item in all_items:
                 if item.isLocked(field=field):
@@ -262,8 +264,8 @@ class MigrationHelper:
             ]
 
             # collections were added in v0.3.0, but collect them as well for anyone who may have used a nightly build
-            # get all collections in the section
-            collections = section.collections()
+            # get all collections in the section, one page at a time
+            collections = plex_api_helper.iter_section_items(section=section, libtype='collection')
 
             for item in collections:
                 for field in fields:
@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 
 # standard imports
+from datetime import datetime
+import json
 import os
+from threading import Lock
 import time
-import threading
 
 # plex debugging
 try:
@@ -11,26 +13,27 @@ try:
 except ImportError:
     pass
 else:  # the code is running outside of Plex
+    from plexhints.core_kit import Core  # core kit
     from plexhints.log_kit import Log  # log kit
-    from plexhints.parse_kit import JSON  # parse kit
     from plexhints.prefs_kit import Prefs  # prefs kit
 
 # imports from Libraries\Shared
-from future.moves import queue
 import requests
-from typing import Callable, Optional, Tuple
+from typing import Any, Callable, Iterator, Optional, Tuple
 import urllib3
 from urllib3.exceptions import InsecureRequestWarning
 from plexapi.alert import AlertListener
 from plexapi.base import PlexPartialObject
 from plexapi.exceptions import BadRequest
+from plexapi.library import LibrarySection
 import plexapi.server
-from plexapi.utils import reverseSearchType
+from plexapi.utils import searchType
 
 # local imports
-from constants import contributes_to, guid_map, media_type_dict, plex_token, plex_url
+from constants import contributes_to, guid_map, media_type_dict, plex_token, plex_url, themerr_data_directory
 import general_helper
 import lizardbyte_db_helper
+import queue_helper
 import themerr_db_helper
 import tmdb_helper
 from youtube_dl_helper import process_youtube
@@ -40,7 +43,66 @@ import _strptime  # noqa: F401
 
 plex_server = None
 
-q = queue.Queue()
+# the items that were queued and not finished are kept in a journal on disk, and queued again after a restart
+work_journal_file = os.path.join(themerr_data_directory, 'work_journal.jsonl')
+
+# the scheduled update waits while the queue is full, so it walks the library at the speed of the workers, the
+# reserved places are left to the items from the agent, the listener and the web UI
+work_queue_size = 1000
+work_queue_reserved = 200
+q = queue_helper.WorkQueue(maxsize=work_queue_size, reserved=work_queue_reserved,
+                           journal=queue_helper.WorkJournal(path=work_journal_file))
+
+# the update pipeline, started by start_queue_threads()
+pipeline = None
+pipeline_queue_size = 100
+
+# rating keys of the items Themerr just changed, with the time each entry expires
+# the Plex server reports these changes back to the listener, which drops them instead of queuing the item again
+self_writes = {}
+self_writes_lock = Lock()
+self_write_ttl = 60
+listener_stats = dict(
+    queued=0,  # events handed to the queue
+    self_writes=0,  # events dropped because Themerr just changed the item
+    batches=0,  # batches of events handed to the queue
+)
+
+# items are fetched from the Plex server in batches, the batch size adapts to how long each request takes, and is
+# limited by the preferences in start_queue_threads()
+fetch_batch_size = queue_helper.AdaptiveBatchSize(maximum=50, target_latency=2)
+
+# a library scan reports thousands of items in bursts, these are collected until the burst settles, and handed to the
+# queue in a single batch, with each item once
+listener_settle = 2
+listener_max_wait = 10
+
+# the number of items fetched per request when walking a library section
+section_page_size = 100
+
+# the reasons the scheduled update queues an item for, in the order they are checked
+sweep_reasons = (
+    'full',  # a full update, every item is checked
+    'no_theme',  # the item has no theme
+    'no_themerr_data',  # the item has a theme without a Themerr data file, and Plex provided themes are overwritten
+    'settings_changed',  # the Themerr settings changed since the theme was uploaded
+    'changed',  # the item was added or changed in Plex since the previous sweep
+)
+
+# the start time and plan of the last scheduled update
+last_sweep = dict(started_at=None, finished_at=None, plan=None)
+
+# held while a scheduled update runs, the next one is skipped if the previous one is still waiting for the queue
+sweep_lock = Lock()
+
+# the scheduled update state, kept between restarts
+# the watermarks are the latest time an item was added or changed, for each listing of each section, between full
+# updates only the items changed since the watermark are checked
+# the fingerprints of the sections are used to skip the sections that did not change at all
+sweep_state_file = os.path.join(themerr_data_directory, 'sweep_state.json')
+# the progress of a running scheduled update is saved after each page, so an interrupted update is resumed
+sweep_state_file_version = 3
+sweep_state = dict(full_sweep_at=None, settings_hash=None, watermarks={}, fingerprints={}, progress=None)
 
 # disable auto-reload, because Themerr doesn't rely on it, so it will only slow down the app
 # when accessing a missing field
@@ -80,13 +142,13 @@ def setup_plexapi():
     return plex_server
 
 
-def update_plex_item(rating_key):
-    # type: (int) -> bool
+def resolve_item(rating_key):
+    # type: (int) -> Optional[dict]
     """
-    Automated update of Plex item using only the rating key.
+    Resolve the database information of a Plex item.
 
-    Given the rating key, this function will automatically handle collecting the required information to update the
-    theme song, and any other metadata.
+    This is the first stage of the update pipeline. The item is fetched from the Plex server, and the ThemerrDB
+    database, database type and id are resolved from its GUIDs.
 
     Parameters
     ----------
@@ -95,19 +157,75 @@ def update_plex_item(rating_key):
 
     Returns
     -------
-    py:class:`bool`
-        True if the item was updated successfully, False otherwise.
+    Optional[dict]
+        The job for the ``lookup_item()`` stage, or None if the item cannot be updated.
 
     Examples
     --------
-    >>> update_plex_item(rating_key=12345)
+    >>> resolve_item(rating_key=12345)
+    {'item': ..., 'database_type': 'movies', 'database': 'themoviedb', 'agent': ..., 'database_id': ...}
     """
     # first get the plex item
     item = get_plex_item(rating_key=rating_key)
 
+    return resolve_plex_item(rating_key=rating_key, item=item)
+
+
+def resolve_items(rating_keys):
+    # type: (list) -> list
+    """
+    Resolve the database information of a batch of Plex items.
+
+    This is the first stage of the update pipeline, when it runs in batches. The items are fetched from the Plex server
+    in a single request, and the batch size adapts to how long the request takes.
+
+    Parameters
+    ----------
+    rating_keys : list
+        The rating keys of the items to be updated.
+
+    Returns
+    -------
+    list
+        The job for the ``lookup_item()`` stage for each rating key, or None if the item cannot be updated.
+
+    Examples
+    --------
+    >>> resolve_items(rating_keys=[12345, 12346])
+    [{'item': ..., 'database_type': 'movies', ...}, None]
+    """
+    start = time.time()
+    items = get_plex_items(rating_keys=rating_keys)
+    fetch_batch_size.record(seconds=time.time() - start)
+
+    return [resolve_plex_item(rating_key=rating_key, item=items.get(rating_key)) for rating_key in rating_keys]
+
+
+def resolve_plex_item(rating_key, item):
+    # type: (int, Optional[PlexPartialObject]) -> Optional[dict]
+    """
+    Resolve the database information of a Plex item that was already fetched.
+
+    Parameters
+    ----------
+    rating_key : int
+        The rating key of the item.
+    item : Optional[PlexPartialObject]
+        The Plex item, or None if it was not found.
+
+    Returns
+    -------
+    Optional[dict]
+        The job for the ``lookup_item()`` stage, or None if the item cannot be updated.
+
+    Examples
+    --------
+    >>> resolve_plex_item(rating_key=12345, item=...)
+    {'item': ..., 'database_type': 'movies', 'database': 'themoviedb', 'agent': ..., 'database_id': ...}
+    """
     if not item:
         Log.Error('Could not find item with rating key: %s' % rating_key)
-        return False
+        return
 
     database_info = get_database_info(item=item)
     Log.Debug('-' * 50)
@@ -115,108 +233,207 @@ def update_plex_item(rating_key):
     Log.Debug('item type: {}'.format(item.type))
     Log.Debug('database_info: {}'.format(database_info))
 
-    database_type = database_info[0]
-    database = database_info[1]
-    agent = database_info[2]
-    database_id = database_info[3]
+    database_type, database, agent, database_id = database_info
 
-    if database and database_type and database_id:
-        if not themerr_db_helper.item_exists(database_type=database_type, database=database, id=database_id):
-            Log.Debug('{} item does not exist in ThemerrDB, skipping: {} ({})'
-                      .format(item.type, item.title, database_id))
-            return False
+    if not (database and database_type and database_id):
+        return
+
+    return dict(item=item, database_type=database_type, database=database, agent=agent, database_id=database_id)
+
+
+def lookup_item(job):
+    # type: (dict) -> Optional[dict]
+    """
+    Look up a Plex item in ThemerrDB, and decide what needs to be updated.
+
+    This is the second stage of the update pipeline.
 
+    Parameters
+    ----------
+    job : dict
+        The job from the ``resolve_item()`` stage.
+
+    Returns
+    -------
+    Optional[dict]
+        The job for the ``extract_theme()`` stage, with the ThemerrDB ``data``, whether to
+        ``update_collection_metadata``, and the ``youtube_theme_url`` to extract, if any. None if there is nothing to
+        update.
+
+    Examples
+    --------
+    >>> lookup_item(job={'item': ..., 'database_type': 'movies', 'database': 'themoviedb', ...})
+    {'item': ..., 'data': {...}, 'update_collection_metadata': False, 'youtube_theme_url': ..., ...}
+    """
+    item = job['item']
+    database_type = job['database_type']
+    database = job['database']
+    agent = job['agent']
+    database_id = job['database_id']
+
+    if not themerr_db_helper.item_exists(database_type=database_type, database=database, id=database_id):
+        Log.Debug('{} item does not exist in ThemerrDB, skipping: {} ({})'
+                  .format(item.type, item.title, database_id))
+        return
+
+    data = themerr_db_helper.get_item_data(database_type=database_type, database=database, id=database_id)
+    if not data:
+        return
+
+    Log.Debug('data found for {} {}'.format(item.type, item.title))
+
+    # finish the unlocks that failed after an upload, so the fields are not mistaken for fields locked by the user
+    for media_type in media_type_dict:
+        if lock_retries.pending(item=(item.ratingKey, media_type)):
+            unlock_media_field(item=item, media_type=media_type)
+
+    # determine if we want to update the collection metadata based on the agent and user preferences
+    update_collection_metadata = False
+    if item.type == 'collection':
+        if agent == 'tv.plex.agents.movie':  # new Plex Movie agent
+            if Prefs['bool_update_collection_metadata_plex_movie']:
+                update_collection_metadata = True
+        elif database != 'igdb':  # any other legacy agents except RetroArcher
+            # game collections/franchises don't have extended metadata
+            if Prefs['bool_update_collection_metadata_legacy']:
+                update_collection_metadata = True
+
+    yt_video_url = None
+    if item.isLocked(field='theme') and not Prefs['bool_ignore_locked_fields']:
+        Log.Debug('Not overwriting locked theme for {}: {}'.format(item.type, item.title))
+    elif (
+            not Prefs['bool_overwrite_plex_provided_themes'] and
+            general_helper.get_theme_provider(item=item) == 'plex'
+    ):
+        Log.Debug('Not overwriting Plex provided theme for {}: {}'.format(item.type, item.title))
+    else:
+        # get youtube_url
         try:
-            data = JSON.ObjectFromURL(
-                cacheTime=3600,
-                url='https://app.lizardbyte.dev/ThemerrDB/{}/{}/{}.json'.format(database_type, database, database_id),
-                errors='ignore'  # don't crash the plugin
-            )
+            yt_video_url = data['youtube_theme_url']
+        except KeyError:
+            Log.Info('{}: No theme song found for {} ({})'.format(item.ratingKey, item.title, item.year))
+        else:
+            settings_hash = general_helper.get_themerr_settings_hash()
+            themerr_data = general_helper.get_themerr_json_data(item=item)
+
+            try:
+                skip = themerr_data['settings_hash'] == settings_hash \
+                       and themerr_data[media_type_dict['themes']['themerr_data_key']] == yt_video_url
+            except KeyError:
+                skip = False
+
+            if skip:
+                Log.Info('Skipping {} for type: {}, title: {}, rating_key: {}'.format(
+                    media_type_dict['themes']['name'], item.type, item.title, item.ratingKey
+                ))
+                yt_video_url = None
+
+    if not update_collection_metadata and not yt_video_url:
+        return
+
+    job.update(data=data, update_collection_metadata=update_collection_metadata, youtube_theme_url=yt_video_url)
+    return job
+
+
+def extract_theme(job):
+    # type: (dict) -> Optional[dict]
+    """
+    Extract the theme song audio url from YouTube.
+
+    This is the third stage of the update pipeline. It is usually the slowest stage, so it has its own pool of
+    threads and does not hold up the other stages.
+
+    Parameters
+    ----------
+    job : dict
+        The job from the ``lookup_item()`` stage.
+
+    Returns
+    -------
+    Optional[dict]
+        The job for the ``upload_item()`` stage, with the extracted ``theme_url``, if any. None if there is nothing
+        to upload.
+
+    Examples
+    --------
+    >>> extract_theme(job={'item': ..., 'youtube_theme_url': 'https://www.youtube.com/watch?v=...', ...})
+    {'item': ..., 'theme_url': 'https://...googlevideo.com/...', ...}
+    """
+    job['theme_url'] = None
+
+    if job['youtube_theme_url']:
+        try:
+            job['theme_url'] = process_youtube(url=job['youtube_theme_url'])
         except Exception as e:
-            Log.Error('{}: Error retrieving data from ThemerrDB: {}'.format(item.ratingKey, e))
+            Log.Exception('{}: Error processing youtube url: {}'.format(job['item'].ratingKey, e))
+
+    if not job['update_collection_metadata'] and not job['theme_url']:
+        return
+
+    return job
+
+
+def upload_item(job):
+    # type: (dict) -> Optional[dict]
+    """
+    Upload the collection metadata and theme song to the Plex server.
+
+    This is the last stage of the update pipeline.
+
+    Parameters
+    ----------
+    job : dict
+        The job from the ``extract_theme()`` stage.
+
+    Returns
+    -------
+    Optional[dict]
+        The finished job.
+
+    Examples
+    --------
+    >>> upload_item(job={'item': ..., 'data': {...}, 'theme_url': 'https://...googlevideo.com/...', ...})
+    {...}
+    """
+    item = job['item']
+    data = job['data']
+
+    if job['update_collection_metadata']:
+        # update poster
+        try:
+            url = 'https://image.tmdb.org/t/p/original{}'.format(data['poster_path'])
+        except KeyError:
+            pass
         else:
-            if data:
-                # update collection metadata
-                Log.Debug('data found for {} {}'.format(item.type, item.title))
-                if item.type == 'collection':
-                    # determine if we want to update the metadata based on the agent and user preferences
-                    update_collection_metadata = False
-
-                    if agent == 'tv.plex.agents.movie':  # new Plex Movie agent
-                        if Prefs['bool_update_collection_metadata_plex_movie']:
-                            update_collection_metadata = True
-                    elif database != 'igdb':  # any other legacy agents except RetroArcher
-                        # game collections/franchises don't have extended metadata
-                        if Prefs['bool_update_collection_metadata_legacy']:
-                            update_collection_metadata = True
-
-                    if update_collection_metadata:
-                        # update poster
-                        try:
-                            url = 'https://image.tmdb.org/t/p/original{}'.format(data['poster_path'])
-                        except KeyError:
-                            pass
-                        else:
-                            add_media(item=item, media_type='posters', media_url_id=data['poster_path'], media_url=url)
-                        # update art
-                        try:
-                            url = 'https://image.tmdb.org/t/p/original{}'.format(data['backdrop_path'])
-                        except KeyError:
-                            pass
-                        else:
-                            add_media(item=item, media_type='art', media_url_id=data['backdrop_path'], media_url=url)
-                        # update summary
-                        if item.isLocked(field='summary') and not Prefs['bool_ignore_locked_fields']:
-                            Log.Debug('Not overwriting locked summary for collection: {}'.format(item.title))
-                        else:
-                            try:
-                                summary = data['overview']
-                            except KeyError:
-                                pass
-                            else:
-                                if item.summary != summary:
-                                    Log.Info('Updating summary for collection: {}'.format(item.title))
-                                    try:
-                                        item.editSummary(summary=summary, locked=False)
-                                    except Exception as e:
-                                        Log.Error('{}: Error updating summary: {}'.format(item.ratingKey, e))
-
-                if item.isLocked(field='theme') and not Prefs['bool_ignore_locked_fields']:
-                    Log.Debug('Not overwriting locked theme for {}: {}'.format(item.type, item.title))
-                elif (
-                        not Prefs['bool_overwrite_plex_provided_themes'] and
-                        general_helper.get_theme_provider(item=item) == 'plex'
-                ):
-                    Log.Debug('Not overwriting Plex provided theme for {}: {}'.format(item.type, item.title))
-                else:
-                    # get youtube_url
+            add_media(item=item, media_type='posters', media_url_id=data['poster_path'], media_url=url)
+        # update art
+        try:
+            url = 'https://image.tmdb.org/t/p/original{}'.format(data['backdrop_path'])
+        except KeyError:
+            pass
+        else:
+            add_media(item=item, media_type='art', media_url_id=data['backdrop_path'], media_url=url)
+        # update summary
+        if item.isLocked(field='summary') and not Prefs['bool_ignore_locked_fields']:
+            Log.Debug('Not overwriting locked summary for collection: {}'.format(item.title))
+        else:
+            try:
+                summary = data['overview']
+            except KeyError:
+                pass
+            else:
+                if item.summary != summary:
+                    Log.Info('Updating summary for collection: {}'.format(item.title))
+                    record_self_write(rating_key=item.ratingKey)
                     try:
-                        yt_video_url = data['youtube_theme_url']
-                    except KeyError:
-                        Log.Info('{}: No theme song found for {} ({})'.format(item.ratingKey, item.title, item.year))
-                    else:
-                        settings_hash = general_helper.get_themerr_settings_hash()
-                        themerr_data = general_helper.get_themerr_json_data(item=item)
-
-                        try:
-                            skip = themerr_data['settings_hash'] == settings_hash \
-                                   and themerr_data[media_type_dict['themes']['themerr_data_key']] == yt_video_url
-                        except KeyError:
-                            skip = False
-
-                        if skip:
-                            Log.Info('Skipping {} for type: {}, title: {}, rating_key: {}'.format(
-                                media_type_dict['themes']['name'], item.type, item.title, item.ratingKey
-                            ))
-                        else:
-                            try:
-                                theme_url = process_youtube(url=yt_video_url)
-                            except Exception as e:
-                                Log.Exception('{}: Error processing youtube url: {}'.format(item.ratingKey, e))
-                            else:
-                                if theme_url:
-                                    add_media(item=item, media_type='themes',
-                                              media_url_id=yt_video_url, media_url=theme_url)
+                        item.editSummary(summary=summary, locked=False)
+                    except Exception as e:
+                        Log.Error('{}: Error updating summary: {}'.format(item.ratingKey, e))
+
+    if job['theme_url']:
+        add_media(item=item, media_type='themes', media_url_id=job['youtube_theme_url'], media_url=job['theme_url'])
+
+    return job
 
 
 def add_media(item, media_type, media_url_id, media_file=None, media_url=None):
@@ -286,9 +503,11 @@ def add_media(item, media_type, media_url_id, media_file=None, media_url=None):
             media_type_dict[media_type]['name'], item.type, item.title, item.ratingKey
         ))
         if media_file:
-            uploaded = upload_media(item=item, method=media_type_dict[media_type]['method'](item), filepath=media_file)
+            uploaded = upload_media(item=item, method=media_type_dict[media_type]['method'](item),
+                                    media_type=media_type, filepath=media_file)
         if media_url:
-            uploaded = upload_media(item=item, method=media_type_dict[media_type]['method'](item), url=media_url)
+            uploaded = upload_media(item=item, method=media_type_dict[media_type]['method'](item),
+                                    media_type=media_type, url=media_url)
     else:
         Log.Warning('No theme songs provided for type: {}, title: {}, rating_key: {}'.format(
             item.type, item.title, item.ratingKey
@@ -304,7 +523,7 @@ def add_media(item, media_type, media_url_id, media_file=None, media_url=None):
         general_helper.update_themerr_data_file(item=item, new_themerr_data=new_themerr_data)
 
         # unlock the field since it contains an automatically added value
-        change_lock_status(item=item, field=media_type_dict[media_type]['plex_field'], lock=False)
+        unlock_media_field(item=item, media_type=media_type)
     else:
         Log.Debug('Could not upload {} for type: {}, title: {}, rating_key: {}'.format(
             media_type_dict[media_type]['name'], item.type, item.title, item.ratingKey
@@ -347,22 +566,13 @@ def change_lock_status(item, field, lock=False):
         '{}.locked'.format(field): int(lock),
     }
 
-    count = 0
-    successful = False
-    exception = None
-    while count < 3:  # there are random read timeouts
-        try:
-            item.edit(**edits)
-        except requests.ReadTimeout as e:
-            exception = e
-            time.sleep(5)
-            count += 1
-        else:
-            successful = True
-            break
+    record_self_write(rating_key=item.ratingKey)
+    try:
+        item.edit(**edits)
+    except requests.ReadTimeout as e:  # there are random read timeouts
+        Log.Error('{}: Error {}ing field: {}'.format(item.ratingKey, lock_string, e))
 
-    if not successful:
-        Log.Error('{}: Error {}ing field: {}'.format(item.ratingKey, lock_string, exception))
+    record_self_write(rating_key=item.ratingKey)  # the events may arrive after the edit is done
 
     # we need to reload the item to get the new lock status
     reload_kwargs = {field: True}
@@ -375,12 +585,55 @@ def change_lock_status(item, field, lock=False):
     return locked == lock
 
 
-def upload_media(item, method, filepath=None, url=None):
-    # type: (PlexPartialObject, Callable, Optional[str], Optional[str]) -> bool
+def unlock_media_field(item, media_type):
+    # type: (PlexPartialObject, str) -> bool
+    """
+    Unlock the field of uploaded media.
+
+    Plex locks the field when media is uploaded. When the field cannot be unlocked, e.g. after a timeout, the item is
+    queued again later by ``lock_retries``, instead of holding up the worker, and the unlock is done again by the
+    ``lookup_item()`` stage.
+
+    Parameters
+    ----------
+    item : PlexPartialObject
+        The Plex item to unlock the field for.
+    media_type : str
+        The type of media that was uploaded. Must be one of 'art', 'posters', or 'themes'.
+
+    Returns
+    -------
+    py:class:`bool`
+        True if the field is unlocked, False otherwise.
+
+    Examples
+    --------
+    >>> unlock_media_field(item=..., media_type='themes')
+    True
+    """
+    retry_key = (item.ratingKey, media_type)
+
+    if change_lock_status(item=item, field=media_type_dict[media_type]['plex_field'], lock=False):
+        lock_retries.succeeded(item=retry_key)
+        return True
+
+    error = 'The {} field is still locked'.format(media_type_dict[media_type]['plex_field'])
+    if lock_retries.failed(item=retry_key, error=error):
+        Log.Warn('{}: Could not unlock {}, trying again later'.format(
+            item.ratingKey, media_type_dict[media_type]['name']))
+    else:
+        Log.Error('{}: Giving up unlocking {} after {} retries'.format(
+            item.ratingKey, media_type_dict[media_type]['name'], lock_retries.max_retries))
+    return False
+
+
+def upload_media(item, method, media_type, filepath=None, url=None):
+    # type: (PlexPartialObject, Callable, str, Optional[str], Optional[str]) -> bool
     """
     Upload media to the specified item.
 
-    Uploads art, poster, or theme to the item specified by the ``item``.
+    Uploads art, poster, or theme to the item specified by the ``item``. When the upload fails, the item is queued
+    again later by ``upload_retries``, instead of holding up the worker.
 
     Parameters
     ----------
@@ -388,6 +641,8 @@ def upload_media(item, method, filepath=None, url=None):
         The Plex item to upload the theme to.
     method : Callable
         The method to use to upload the theme.
+    media_type : str
+        The type of media. Must be one of 'art', 'posters', or 'themes'.
     filepath : Optional[str]
         The path to the theme song.
     url : Optional[str]
@@ -400,33 +655,112 @@ def upload_media(item, method, filepath=None, url=None):
 
     Examples
     --------
-    >>> upload_media(item=..., method=item.uploadArt, url=...)
-    >>> upload_media(item=..., method=item.uploadPoster, url=...)
-    >>> upload_media(item=..., method=item.uploadTheme, url=...)
+    >>> upload_media(item=..., method=item.uploadArt, media_type='art', url=...)
+    >>> upload_media(item=..., method=item.uploadPoster, media_type='posters', url=...)
+    >>> upload_media(item=..., method=item.uploadTheme, media_type='themes', url=...)
     ...
     """
-    count = 0
-    while count <= int(Prefs['int_plexapi_upload_retries_max']):
-        try:
-            if filepath:
-                if method == item.uploadTheme:
-                    method(filepath=filepath, timeout=int(Prefs['int_plexapi_plexapi_timeout']))
-                else:
-                    method(filepath=filepath)
-            elif url:
-                if method == item.uploadTheme:
-                    method(url=url, timeout=int(Prefs['int_plexapi_plexapi_timeout']))
-                else:
-                    method(url=url)
-        except BadRequest as e:
-            sleep_time = 2 ** count
-            Log.Error('%s: Error uploading media: %s' % (item.ratingKey, e))
-            Log.Error('%s: Trying again in : %s' % (item.ratingKey, sleep_time))
-            time.sleep(sleep_time)
-            count += 1
+    retry_key = (item.ratingKey, media_type)
+
+    record_self_write(rating_key=item.ratingKey)
+    try:
+        if filepath:
+            if method == item.uploadTheme:
+                method(filepath=filepath, timeout=int(Prefs['int_plexapi_plexapi_timeout']))
+            else:
+                method(filepath=filepath)
+        elif url:
+            if method == item.uploadTheme:
+                method(url=url, timeout=int(Prefs['int_plexapi_plexapi_timeout']))
+            else:
+                method(url=url)
+    except BadRequest as e:
+        Log.Error('%s: Error uploading media: %s' % (item.ratingKey, e))
+        if upload_retries.failed(item=retry_key, error=e):
+            Log.Error('%s: Trying again later' % item.ratingKey)
         else:
-            return True
-    return False
+            Log.Error('%s: Giving up after %s retries' % (item.ratingKey, upload_retries.max_retries))
+        return False
+
+    record_self_write(rating_key=item.ratingKey)  # the events may arrive after the upload is done
+    upload_retries.succeeded(item=retry_key)
+    return True
+
+
+def queue_retry(retry_key):
+    # type: (Tuple[int, str]) -> None
+    """
+    Queue an item again after a failed upload or unlock.
+
+    This is the callback of ``upload_retries`` and ``lock_retries``, it is called from the timer thread once the
+    delay before the retry has passed. The item is only queued, the retry is done by the workers.
+
+    Parameters
+    ----------
+    retry_key : Tuple[int, str]
+        The rating key of the item, and the type of media.
+
+    Examples
+    --------
+    >>> queue_retry(retry_key=(1, 'themes'))
+    """
+    rating_key, media_type = retry_key
+    q.put_unique(item=rating_key, lane='retry')
+
+
+# failed uploads and unlocks are tried again after a delay, without holding up the workers
+# the number of upload retries is set from the preferences in start_queue_threads()
+upload_retries = queue_helper.RetryScheduler(callback=queue_retry)
+lock_retries = queue_helper.RetryScheduler(callback=queue_retry, max_retries=2)
+
+
+def record_self_write(rating_key):
+    # type: (int) -> None
+    """
+    Record that Themerr is changing an item.
+
+    The Plex server reports the change back to ``plex_listener_handler()``, which drops the events for the item until
+    the entry expires, after ``self_write_ttl`` seconds. Expired entries are removed here.
+
+    Parameters
+    ----------
+    rating_key : int
+        The rating key of the item.
+
+    Examples
+    --------
+    >>> record_self_write(rating_key=1)
+    """
+    now = time.time()
+    with self_writes_lock:
+        for expired_key in [key for key, expires_at in self_writes.items() if expires_at <= now]:
+            del self_writes[expired_key]
+
+        self_writes[rating_key] = now + self_write_ttl
+
+
+def is_self_write(rating_key):
+    # type: (int) -> bool
+    """
+    Check if Themerr just changed an item.
+
+    Parameters
+    ----------
+    rating_key : int
+        The rating key of the item.
+
+    Returns
+    -------
+    py:class:`bool`
+        True if the item was changed by Themerr less than ``self_write_ttl`` seconds ago.
+
+    Examples
+    --------
+    >>> is_self_write(rating_key=1)
+    False
+    """
+    with self_writes_lock:
+        return self_writes.get(rating_key, 0) > time.time()
 
 
 def get_database_info(item):
@@ -569,6 +903,92 @@ def get_database_info(item):
     return database_type, database, agent, database_id
 
 
+def get_library_database_types(sections):
+    # type: (list) -> set
+    """
+    Get the ThemerrDB database types used by the library sections.
+
+    This is used to skip refreshing database types that no library can use, e.g. ``games`` when there is no
+    RetroArcher library.
+
+    Parameters
+    ----------
+    sections : list
+        The library sections of the Plex server.
+
+    Returns
+    -------
+    set
+        The database types used by the library sections.
+
+    Examples
+    --------
+    >>> get_library_database_types(sections=plex.library.sections())
+    {'movies', 'movie_collections', 'tv_shows'}
+    """
+    database_types = set()
+
+    for section in sections:
+        database_types.update(get_section_database_types(section=section))
+
+    return database_types
+
+
+def update_themerr_db_cache():
+    # type: () -> None
+    """
+    Refresh the ThemerrDB cache for the database types used by the Plex libraries.
+
+    This is used when the plug-in starts, so the first refresh does not download database types that no library uses.
+    If the library sections cannot be listed, the refresh is left to the next scheduled task. Database types that are
+    needed before then are loaded on demand.
+
+    Examples
+    --------
+    >>> update_themerr_db_cache()
+    """
+    try:
+        sections = setup_plexapi().library.sections()
+    except Exception as e:
+        Log.Warning('Unable to list the Plex library sections, skipping the ThemerrDB cache refresh: {}'.format(e))
+        return
+
+    themerr_db_helper.update_cache(active_types=get_library_database_types(sections=sections))
+
+
+def get_section_database_types(section):
+    # type: (LibrarySection) -> set
+    """
+    Get the ThemerrDB database types used by a library section.
+
+    Parameters
+    ----------
+    section : LibrarySection
+        The library section.
+
+    Returns
+    -------
+    set
+        The database types used by the library section, empty for unsupported metadata agents.
+
+    Examples
+    --------
+    >>> get_section_database_types(section=plex.library.section('Movies'))
+    {'movies', 'movie_collections'}
+    """
+    if section.agent not in contributes_to:
+        return set()  # skip unsupported metadata agents
+
+    if section.type == 'movie':
+        if section.agent == 'dev.lizardbyte.retroarcher-plex':
+            return {'games', 'game_collections', 'game_franchises'}
+        return {'movies', 'movie_collections'}
+    elif section.type == 'show':
+        return {'tv_shows'}
+
+    return set()
+
+
 def get_plex_item(rating_key):
     # type: (int) -> PlexPartialObject
     """
@@ -597,25 +1017,88 @@ def get_plex_item(rating_key):
     return item
 
 
-def process_queue():
-    # type: () -> None
+def get_plex_items(rating_keys):
+    # type: (list) -> dict
     """
-    Add items to the queue.
+    Get many items from the Plex Server in a single request.
+
+    If the request fails, for example because none of the items exist anymore, the items are fetched one by one.
 
-    This is an endless loop to add items to the queue.
+    Parameters
+    ----------
+    rating_keys : list
+        The rating keys of the items to get.
+
+    Returns
+    -------
+    dict
+        The Plex items that were found, by rating key.
 
     Examples
     --------
-    >>> process_queue()
-    ...
+    >>> get_plex_items(rating_keys=[1, 2])
+    {1: ..., 2: ...}
+    """
+    plex = setup_plexapi()
+
+    try:
+        items = plex.fetchItems(ekey='/library/metadata/{}'.format(','.join(str(key) for key in rating_keys)))
+    except Exception as e:
+        Log.Warn('Error fetching {} items in one request, fetching them one by one: {}'.format(len(rating_keys), e))
+        items = []
+        for rating_key in rating_keys:
+            try:
+                items.append(plex.fetchItem(ekey=rating_key))
+            except Exception as e:
+                Log.Error('{}: Error fetching item: {}'.format(rating_key, e))
+
+    return {int(item.ratingKey): item for item in items}
+
+
+def iter_section_items(section, libtype=None, page_size=None, start=0, **kwargs):
+    # type: (LibrarySection, Optional[str], Optional[int], int, **Any) -> Iterator[PlexPartialObject]
+    """
+    Iterate over the items of a library section, one page at a time.
+
+    Unlike ``section.all()`` and ``section.collections()``, which load the whole section before returning, the items
+    are fetched as they are needed, so only one page of items is held in memory and the first items are available
+    after the first request.
+
+    Parameters
+    ----------
+    section : LibrarySection
+        The library section.
+    libtype : Optional[str]
+        The type of the items, e.g. ``collection``. Defaults to the type of the section.
+    page_size : Optional[int]
+        The number of items fetched per request. Defaults to ``section_page_size``.
+    start : int
+        The position of the first item, to continue a previous walk of the section.
+    **kwargs
+        Filters passed to ``section.search()``.
+
+    Yields
+    ------
+    PlexPartialObject
+        The items of the section.
+
+    Examples
+    --------
+    >>> for item in iter_section_items(section=..., libtype='collection'):
+    ...     print(item.title)
     """
+    page_size = page_size or section_page_size
+
+    container_start = start
     while True:
-        rating_key = q.get()  # get the rating_key from the queue
-        try:
-            update_plex_item(rating_key=rating_key)  # process that rating_key
-        except Exception as e:
-            Log.Exception('Unexpected error processing rating key: %s, error: %s' % (rating_key, e))
-        q.task_done()  # tells the queue that we are done with this item
+        page = section.search(libtype=libtype, container_start=container_start, container_size=page_size,
+                              maxresults=page_size, **kwargs)
+        for item in page:
+            yield item
+
+        if len(page) < page_size:
+            return
+        container_start += page_size
 
 
 def start_queue_threads():
@@ -623,26 +1106,42 @@ def start_queue_threads():
     """
     Start queue threads.
 
-    Start the queue threads based on the number of threads set in the preferences.
+    Items taken from the work queue pass through the update pipeline: ``resolve_items()``, ``lookup_item()``,
+    ``extract_theme()`` and ``upload_item()``. Each stage has its own number of threads set in the preferences, so
+    the quick stages do not wait behind the slow YouTube extraction. The first stage fetches the waiting items from
+    the Plex server in batches.
+
+    The items that were not finished before the plugin stopped are queued again from the work journal first, so the
+    work resumes where it stopped.
 
     Examples
     --------
     >>> start_queue_threads()
     ...
     """
+    global pipeline
+
+    resumed = q.resume()
+    if resumed:
+        Log.Info('Resuming {} items that were not finished before the restart'.format(resumed))
+
+    fetch_batch_size.maximum = max(1, int(Prefs['int_pipeline_resolve_batch_size']))
+    upload_retries.max_retries = int(Prefs['int_plexapi_upload_retries_max'])
+
     # create multiple threads for processing themes faster
     # minimum value of 1
-    for t in range(max(1, int(Prefs['int_plexapi_upload_threads']))):
-        try:
-            # for each thread, start it
-            t = threading.Thread(target=process_queue)
-            # when we set daemon to true, that thread will end when the main thread ends
-            t.daemon = True
-            # start the daemon thread
-            t.start()
-        except RuntimeError as e:
-            Log.Error('RuntimeError encountered: %s' % e)
-            break
+    pipeline = queue_helper.Pipeline(
+        source=q,
+        stages=[
+            ('resolve', resolve_items, int(Prefs['int_pipeline_resolve_threads'])),
+            ('lookup', lookup_item, int(Prefs['int_pipeline_lookup_threads'])),
+            ('extract', extract_theme, int(Prefs['int_pipeline_extract_threads'])),
+            ('upload', upload_item, int(Prefs['int_plexapi_upload_threads'])),
+        ],
+        queue_size=pipeline_queue_size,
+        batch_size=fetch_batch_size,
+    )
+    pipeline.start()
 
 
 def plex_listener():
@@ -668,7 +1167,8 @@ def plex_listener_handler(data):
     Process events from ``plex_listener()``.
 
     Check if we need to add an item to the queue. This is used to automatically add themes to items from the
-    new Plex Movie agent, since metadata agents cannot extend it.
+    new Plex Movie agent, since metadata agents cannot extend it. Events for items Themerr just changed are dropped,
+    and the other items are collected by ``listener_debouncer``, which adds them to the queue in batches.
 
     Parameters
     ----------
@@ -682,17 +1182,20 @@ def plex_listener_handler(data):
     """
     # Log.Debug(data)
     if data['type'] == 'timeline':
+        # known search types:
+        # https://github.com/pkkid/python-plexapi/blob/8b3235445f6b3051c39ff6d6fc5d49f4e674d576/plexapi/utils.py#L35-L55
+        search_types = set()
+        if Prefs['bool_plex_movie_support']:
+            search_types.add(int(searchType(libtype='movie')))
+        if Prefs['bool_plex_series_support']:
+            search_types.add(int(searchType(libtype='show')))
+
+        rating_keys = []
         for entry in data['TimelineEntry']:
             # known state values:
             # https://python-plexapi.readthedocs.io/en/latest/modules/alert.html#module-plexapi.alert
-
-            # known search types:
-            # https://github.com/pkkid/python-plexapi/blob/8b3235445f6b3051c39ff6d6fc5d49f4e674d576/plexapi/utils.py#L35-L55
             if (
-                    (
-                        (reverseSearchType(libtype=entry['type']) == 'movie' and Prefs['bool_plex_movie_support']) or
-                        (reverseSearchType(libtype=entry['type']) == 'show' and Prefs['bool_plex_series_support'])
-                    ) and
+                    int(entry['type']) in search_types and
                     entry['state'] == 5 and
                     entry['identifier'] == 'com.plexapp.plugins.library'
             ):
@@ -702,10 +1205,39 @@ def plex_listener_handler(data):
 
                 rating_key = int(entry['itemID'])
 
-                # since we added the themerr json file, we no longer need to keep track of whether the update
-                # here is from Themerr updating the theme, as we will just skip it if no changes are required
-                if rating_key not in q.queue:  # if the item was not in the list, then add it to the queue
-                    q.put(item=rating_key)
+                # uploads and lock changes made by Themerr are reported back as well, these would only be skipped
+                # after resolving and looking up the item again
+                if is_self_write(rating_key=rating_key):
+                    listener_stats['self_writes'] += 1
+                    continue
+
+                listener_stats['queued'] += 1
+                rating_keys.append(rating_key)
+
+        listener_debouncer.add(items=rating_keys)
+
+
+def queue_listener_batch(rating_keys):
+    # type: (list) -> None
+    """
+    Add a batch of items reported by the Plex server to the queue.
+
+    Parameters
+    ----------
+    rating_keys : list
+        The rating keys of the items, each once.
+
+    Examples
+    --------
+    >>> queue_listener_batch(rating_keys=[1, 2, 3])
+    """
+    listener_stats['batches'] += 1
+    added = q.put_many(items=rating_keys, lane='listener')  # skips the items that are already queued
+    Log.Debug('Queued {} of {} items reported by the Plex server'.format(added, len(rating_keys)))
+
+
+listener_debouncer = queue_helper.Debouncer(
+    callback=queue_listener_batch, settle=listener_settle, max_wait=listener_max_wait)
 
 
 def scheduled_update():
@@ -713,7 +1245,13 @@ def scheduled_update():
     """
     Update all items in the Plex Server.
 
-    This is used to update all items in the Plex Server. It is called from a scheduled task.
+    This is used to update all items in the Plex Server. It is called from a scheduled task. The sweep is planned
+    with ``plan_sweep()``, and each candidate is queued as soon as it is found. While the queue is full, the walk of
+    the library waits for the workers. The plan is logged, and kept in ``last_sweep``.
+
+    A full update checks every item, and runs on the ``int_full_update_interval``, or when the Themerr settings
+    change. Between full updates, only the items changed since the watermarks in ``sweep_state`` are checked, and the
+    sections with an unchanged fingerprint are not walked at all.
 
     Examples
     --------
@@ -724,44 +1262,444 @@ def scheduled_update():
     scheduled_tasks.setup_scheduling : The method where the scheduled task is configurerd.
     scheduled_tasks.schedule_loop : The method that runs the pending scheduled tasks.
     """
-    plex = setup_plexapi()
+    if not sweep_lock.acquire(False):
+        Log.Info('Skipping scheduled update, the previous scheduled update is still running')
+        return
+
+    try:
+        _scheduled_update()
+    finally:
+        sweep_lock.release()
+
 
-    themerr_db_helper.update_cache()
+def _scheduled_update():
+    # type: () -> None
+    plex = setup_plexapi()
 
     plex_library = plex.library
 
     sections = plex_library.sections()
 
-    for section in sections:
-        if section.agent not in contributes_to:
-            # todo - there is a small chance that a library with an unsupported agent could still have
-            # individual items that was matched with a supported agent...
-            continue  # skip unsupported metadata agents
+    themerr_db_helper.update_cache(active_types=get_library_database_types(sections=sections))
 
-        if not plex_token:
-            Log.Error('Plex token not found in environment, cannot proceed.')
-            continue
+    started_at = time.time()
+    settings_hash = general_helper.get_themerr_settings_hash()
+
+    progress = sweep_state['progress']
+    if progress and progress['settings_hash'] == settings_hash:
+        # the previous update was interrupted, e.g. by a restart, so it continues where it stopped
+        full = progress['full']
+        started_at = progress['started_at']
+        Log.Info('Resuming the interrupted scheduled update, listings already done: {}'.format(progress['done']))
+    else:
+        # a full update runs on its own interval, and when the settings change
+        full = (
+            not sweep_state['full_sweep_at'] or
+            started_at - sweep_state['full_sweep_at'] >= int(Prefs['int_full_update_interval']) * 3600 or
+            sweep_state['settings_hash'] != settings_hash
+        )
+        progress = dict(started_at=started_at, full=full, settings_hash=settings_hash,
+                        offsets={}, watermarks={}, done=[])
+        sweep_state['progress'] = progress
+
+    # blocks while the queue is full
+    def queue_candidate(rating_key, reason):
+        q.put_unique(item=rating_key, lane='sweep')
+
+    plan = plan_sweep(sections=sections, watermarks=None if full else sweep_state['watermarks'],
+                      fingerprints=sweep_state['fingerprints'], on_candidate=queue_candidate,
+                      progress=progress, on_progress=save_sweep_state)
+
+    queued = sum(plan['counts'].values())
+    Log.Info('Scheduled {} update plan: {} of {} checked items queued, by reason: {}, unchanged sections skipped: {}'
+             .format(plan['mode'], queued, queued + plan['skipped'], plan['counts'], plan['sections_skipped']))
+
+    last_sweep.update(
+        started_at=started_at,
+        finished_at=time.time(),
+        plan=dict(mode=plan['mode'], counts=plan['counts'], skipped=plan['skipped'],
+                  sections_skipped=plan['sections_skipped']),
+    )
+
+    sweep_state['watermarks'] = plan['watermarks']
+    sweep_state['fingerprints'] = plan['fingerprints']
+    sweep_state['progress'] = None
+    if full:
+        sweep_state.update(full_sweep_at=started_at, settings_hash=settings_hash)
+    save_sweep_state()
+
+
+def get_sweep_libtypes(section):
+    # type: (LibrarySection) -> list
+    """
+    Get the types of items of a library section that the scheduled update checks.
+
+    Parameters
+    ----------
+    section : LibrarySection
+        The library section.
+
+    Returns
+    -------
+    list
+        The types of items, e.g. ``movie`` and ``collection``, depending on the agent of the section and the
+        preferences.
+
+    Examples
+    --------
+    >>> get_sweep_libtypes(section=...)
+    ['movie', 'collection']
+    """
+    if section.agent not in contributes_to:
+        # todo - there is a small chance that a library with an unsupported agent could still have
+        # individual items that was matched with a supported agent...
+        return []  # skip unsupported metadata agents
+
+    if not plex_token:
+        Log.Error('Plex token not found in environment, cannot proceed.')
+        return []
+
+    # check if the agent is enabled
+    if not general_helper.continue_update(item_agent=section.agent, item_type=section.type):
+        Log.Debug('Themerr-plex is disabled for agent "{}"'.format(section.agent))
+        return []
+
+    libtypes = []
+    if section.type == 'movie':
+        if Prefs['bool_auto_update_movie_themes']:
+            libtypes.append('movie')
+        if Prefs['bool_auto_update_collection_themes']:
+            libtypes.append('collection')
+    elif section.type == 'show':
+        if Prefs['bool_auto_update_tv_themes']:
+            libtypes.append('show')
+
+    return libtypes
+
+
+def _timestamp(value):
+    # type: (Optional[datetime]) -> float
+    # plexapi converts the Plex timestamps to local datetimes
+    return time.mktime(value.timetuple()) if value else 0
 
-        # check if the agent is enabled
-        if not general_helper.continue_update(item_agent=section.agent, item_type=section.type):
-            Log.Debug('Themerr-plex is disabled for agent "{}"'.format(section.agent))
+
+def get_section_fingerprint(section, settings_hash):
+    # type: (LibrarySection, str) -> dict
+    """
+    Get the fingerprint of a library section.
+
+    The fingerprint combines everything that decides the outcome of a sweep of the section, when any of its inputs
+    changes, the section has to be walked again.
+
+    Parameters
+    ----------
+    section : LibrarySection
+        The library section.
+    settings_hash : str
+        The hash of the current Themerr settings.
+
+    Returns
+    -------
+    dict
+        The time the section was last updated, the content change counter of the section, the Themerr settings hash,
+        and the version of the ThemerrDB index for the database types of the section.
+
+    Examples
+    --------
+    >>> get_section_fingerprint(section=..., settings_hash=general_helper.get_themerr_settings_hash())
+    {'updated_at': 1700000000.0, 'content_changed_at': '12345', 'settings_hash': '...', 'index_version': '...'}
+    """
+    # plexapi does not parse contentChangedAt, a counter Plex increments on every change to the items of the section
+    data = getattr(section, '_data', None)
+
+    return dict(
+        updated_at=_timestamp(section.updatedAt),
+        content_changed_at=data.attrib.get('contentChangedAt') if data is not None else None,
+        settings_hash=settings_hash,
+        index_version=themerr_db_helper.get_index_version(
+            database_types=get_section_database_types(section=section)),
+    )
+
+
+def get_item_changed_at(item):
+    # type: (PlexPartialObject) -> float
+    """
+    Get the latest time an item was added or changed in Plex.
+
+    Parameters
+    ----------
+    item : PlexPartialObject
+        The item.
+
+    Returns
+    -------
+    float
+        The time the item was added or changed, as a timestamp.
+
+    Examples
+    --------
+    >>> get_item_changed_at(item=...)
+    1700000000.0
+    """
+    return max(_timestamp(item.updatedAt), _timestamp(item.addedAt))
+
+
+def plan_item(item, settings_hash, changed_since):
+    # type: (PlexPartialObject, str, Optional[float]) -> Optional[str]
+    """
+    Decide if the scheduled update should queue an item.
+
+    Only the fields of the item in the section listing and the Themerr data file are used, so no requests are made
+    to the Plex server for the item.
+
+    Parameters
+    ----------
+    item : PlexPartialObject
+        The item from the section listing.
+    settings_hash : str
+        The hash of the current Themerr settings.
+    changed_since : Optional[float]
+        The time of the previous check of the item, or None for a full update.
+
+    Returns
+    -------
+    Optional[str]
+        The first of the ``sweep_reasons`` that applies to the item, or None if the item can be skipped.
+
+    Examples
+    --------
+    >>> plan_item(item=..., settings_hash=general_helper.get_themerr_settings_hash(), changed_since=None)
+    'full'
+    """
+    if changed_since is None:
+        return 'full'
+
+    themerr_json_path = general_helper.get_themerr_json_path(item=item)
+    themerr_json_exists = os.path.isfile(themerr_json_path)
+
+    if not item.isLocked(field='theme') or Prefs['bool_ignore_locked_fields']:
+        if not item.theme:
+            return 'no_theme'
+
+        if not themerr_json_exists:
+            if Prefs['bool_overwrite_plex_provided_themes']:
+                return 'no_themerr_data'
+        elif general_helper.get_themerr_json_data(item=item).get('settings_hash') != settings_hash:
+            return 'settings_changed'
+
+    changed_at = get_item_changed_at(item=item)
+    if changed_at > changed_since:
+        # an upload by Themerr changes the item as well, the Themerr data file is written right after it
+        if not themerr_json_exists or changed_at > os.path.getmtime(themerr_json_path) + self_write_ttl:
+            return 'changed'
+
+
+def plan_sweep(sections, watermarks=None, fingerprints=None, on_candidate=None, progress=None, on_progress=None):
+    # type: (list, Optional[dict], Optional[dict], Optional[Callable], Optional[dict], Optional[Callable]) -> dict
+    """
+    Plan the scheduled update of the library sections.
+
+    Without watermarks, this is a full update, and every item is a candidate for the queue. With watermarks, each
+    listing is walked from the most recently changed item, and the walk stops at the first item that was not changed
+    since the watermark of the listing, so the work is proportional to the changes in the library rather than its
+    size. The changed items are checked with ``plan_item()``. A listing without a watermark, e.g. a new section, is
+    walked in full.
+
+    Between full updates, a section with the same fingerprint as the previous plan is not walked at all. When the
+    ThemerrDB index for the section changed, the section is walked in full, so items without a theme are checked
+    against the new index.
+
+    The ``progress`` is updated as the listings are walked, so an interrupted plan can be resumed by passing the same
+    progress again. A listing walked in full records its position after each page, and is resumed from the previous
+    page, in case items were removed in the meantime. A listing walked up to its watermark is only recorded once it is
+    done, because its items are ordered by their last change.
+
+    Parameters
+    ----------
+    sections : list
+        The library sections.
+    watermarks : Optional[dict]
+        The watermark of each listing, from the previous plan, or None for a full update.
+    fingerprints : Optional[dict]
+        The fingerprint of each section, from the previous plan.
+    on_candidate : Optional[Callable[[int, str], Any]]
+        Called with the rating key and the reason of each candidate as soon as it is found, instead of collecting the
+        candidates. The walk of the library waits while it runs, so it can hold back the walk.
+    progress : Optional[dict]
+        The ``offsets`` and ``watermarks`` of the listings being walked, and the listings ``done``, from an
+        interrupted plan. It is updated in place.
+    on_progress : Optional[Callable[[], Any]]
+        Called each time the ``progress`` is updated, e.g. to save it.
+
+    Returns
+    -------
+    dict
+        The ``mode``, ``full`` or ``changes``, the ``candidates``, a list of rating keys and their reasons, empty with
+        ``on_candidate``, the ``counts`` of candidates for each reason, the number of ``skipped`` items, the number of
+        ``sections_skipped``, and the new ``watermarks`` and ``fingerprints``.
+
+    Examples
+    --------
+    >>> plan_sweep(sections=..., watermarks={'1:movie': 1700000000.0}, fingerprints={'1': {...}})
+    {'mode': 'changes', 'candidates': [(1, 'no_theme'), ...], 'counts': {...}, 'skipped': 2, ...}
+    """
+    settings_hash = general_helper.get_themerr_settings_hash()
+    fingerprints = fingerprints or {}
+    if progress is None:
+        progress = dict(offsets={}, watermarks={}, done=[])
+
+    candidates = []
+    counts = {reason: 0 for reason in sweep_reasons}
+    skipped = 0
+    sections_skipped = 0
+    new_watermarks = {}
+    new_fingerprints = {}
+
+    for section in sections:
+        libtypes = get_sweep_libtypes(section=section)
+        if not libtypes:
             continue
 
-        all_items = []
+        section_key = str(section.key)  # the keys are strings once the state is saved as json
+        fingerprint = get_section_fingerprint(section=section, settings_hash=settings_hash)
+        previous = fingerprints.get(section_key)
+        new_fingerprints[section_key] = fingerprint
+
+        index_changed = False
+        if watermarks is not None and previous:
+            listings = ['{}:{}'.format(section.key, libtype) for libtype in libtypes]
+            if previous == fingerprint and all(listing in watermarks for listing in listings):
+                # nothing in the section, the settings, or the index changed since the previous plan
+                sections_skipped += 1
+                new_watermarks.update((listing, watermarks[listing]) for listing in listings)
+                continue
+            index_changed = previous['index_version'] != fingerprint['index_version']
+
+        for libtype in libtypes:
+            listing = '{}:{}'.format(section.key, libtype)
+            watermark = watermarks.get(listing) if watermarks is not None else None
+            if listing in progress['done']:
+                new_watermarks[listing] = progress['watermarks'][listing]
+                continue  # walked before the plan was interrupted
+            new_watermarks[listing] = max(watermark or 0, progress['watermarks'].get(listing, 0))
+
+            # the whole listing is walked without a watermark, or when the index changed
+            walk_all = watermark is None or index_changed
+            if walk_all:
+                # in the order the items were added, so the position of the walk is kept when items are added
+                start = max(0, progress['offsets'].get(listing, 0) - section_page_size)
+                items = iter_section_items(section=section, libtype=libtype, start=start, sort='addedAt')
+            else:
+                start = 0
+                items = iter_section_items(section=section, libtype=libtype, sort='updatedAt:desc')
+
+            for position, item in enumerate(items, start + 1):
+                changed_at = get_item_changed_at(item=item)
+                if not walk_all and changed_at <= watermark:
+                    break  # this item, and all the items after it, were checked by a previous sweep
+                new_watermarks[listing] = max(new_watermarks[listing], changed_at)
+
+                reason = plan_item(item=item, settings_hash=settings_hash, changed_since=watermark)
+                if reason:
+                    if on_candidate:
+                        on_candidate(item.ratingKey, reason)
+                    else:
+                        candidates.append((item.ratingKey, reason))
+                    counts[reason] += 1
+                else:
+                    skipped += 1
+
+                if walk_all and position % section_page_size == 0:
+                    progress['offsets'][listing] = position
+                    progress['watermarks'][listing] = new_watermarks[listing]
+                    if on_progress:
+                        on_progress()
+
+            progress['offsets'].pop(listing, None)
+            progress['watermarks'][listing] = new_watermarks[listing]
+            progress['done'].append(listing)
+            if on_progress:
+                on_progress()
+
+    return dict(
+        mode='full' if watermarks is None else 'changes',
+        candidates=candidates,
+        counts=counts,
+        skipped=skipped,
+        sections_skipped=sections_skipped,
+        watermarks=new_watermarks,
+        fingerprints=new_fingerprints,
+    )
+
+
+def save_sweep_state():
+    # type: () -> bool
+    """
+    Save the scheduled update state to disk.
+
+    Returns
+    -------
+    py:class:`bool`
+        True if the state was saved, otherwise False.
 
-        # get all the items in the section
-        if section.type == 'movie':
-            media_items = section.all() if Prefs['bool_auto_update_movie_themes'] else []
+    Examples
+    --------
+    >>> save_sweep_state()
+    True
+    """
+    data = dict(sweep_state, version=sweep_state_file_version)
+
+    try:
+        if not os.path.isdir(os.path.dirname(sweep_state_file)):
+            os.makedirs(os.path.dirname(sweep_state_file))
+
+        Core.storage.save(filename=sweep_state_file, data=json.dumps(data), binary=False)
+    except Exception as e:
+        Log.Error('Error saving scheduled update state to disk: {}'.format(e))
+        return False
+
+    return True
+
+
+def load_sweep_state():
+    # type: () -> bool
+    """
+    Load the scheduled update state from disk.
+
+    This is called when the module is imported, so the first scheduled update after a restart only checks the
+    changed items, unless a full update is due.
+
+    Returns
+    -------
+    py:class:`bool`
+        True if the state was loaded, otherwise False.
+
+    Examples
+    --------
+    >>> load_sweep_state()
+    True
+    """
+    if not os.path.isfile(sweep_state_file):
+        return False
+
+    try:
+        data = json.loads(str(Core.storage.load(filename=sweep_state_file, binary=False)))
+    except Exception as e:
+        Log.Error('Error loading scheduled update state from disk: {}'.format(e))
+        return False
+
+    if data.get('version') != sweep_state_file_version:
+        Log.Info('Scheduled update state on disk is from an older version, ignoring it')
+        return False
 
-            # get all collections in the section
-            collections = section.collections() if Prefs['bool_auto_update_collection_themes'] else []
+    sweep_state.update(
+        full_sweep_at=data['full_sweep_at'],
+        settings_hash=data['settings_hash'],
+        watermarks=data['watermarks'],
+        fingerprints=data['fingerprints'],
+        progress=data['progress'],
+    )
+    return True
 
-            # combine the items and collections into one list
-            # this is done so that we can process both items and collections in the same loop
-            all_items = media_items + collections
-        elif section.type == 'show':
-            all_items = section.all() if Prefs['bool_auto_update_tv_themes'] else []
 
-        for item in all_items:
-            if item.ratingKey not in q.queue:
-                q.put(item=item.ratingKey)
+load_sweep_state()
@@ -0,0 +1,1246 @@
+# -*- coding: utf-8 -*-
+
+# standard imports
+from collections import deque, OrderedDict
+import heapq
+from itertools import count
+import json
+import os
+import random
+import threading
+import time
+
+# plex debugging
+try:
+    import plexhints  # noqa: F401
+except ImportError:
+    pass
+else:  # the code is running outside of Plex
+    from plexhints.log_kit import Log  # log kit
+
+# imports from Libraries\Shared
+from future.moves import queue
+from typing import Any, Callable, Hashable, Iterable, List, Optional, Tuple
+
+# the lanes of the work queue, from the highest to the lowest priority, with the share of items each lane gets when
+# all lanes are busy
+lane_weights = (
+    ('agent', 8),  # agent update() calls
+    ('listener', 4),  # new or changed items reported by the Plex server
+    ('manual', 2),  # refreshes requested from the web UI
+    ('retry', 1),  # items queued again after an error, by a RetryScheduler
+    ('sweep', 1),  # the scheduled update of all items
+)
+
+
+class WorkQueue(queue.Queue):
+    """
+    A priority queue with lanes, that holds each item at most once.
+
+    Items are taken from the lanes with a smooth weighted round-robin, so a higher priority lane is served first and
+    most often, but a lower priority lane still gets its share and never starves. Within a lane, items are taken in
+    the order they were added.
+
+    A map of the queued items is kept in step with the lanes, under the queue lock, so checking if an item is already
+    queued does not scan the queue. Adding an item that is queued in a lower priority lane moves it to the higher
+    priority lane.
+
+    An item taken from the queue stays in flight until ``finish()`` is called for it. Adding an item that is in flight
+    does not queue it again, so it is never processed by two workers at once. Instead, the item is marked to run once
+    more, and it is queued again when it is finished.
+
+    With a journal, every item that is queued, taken and finished is recorded on disk, and ``resume()`` queues the
+    items that were not finished before a restart again.
+
+    With a maximum size, adding an item blocks while the queue is full, so a producer can only run ahead of the
+    workers by the size of the queue. Part of the capacity can be reserved for the higher priority lanes, so the
+    lowest priority lane blocks before the queue is full, and the other lanes can still add their items.
+
+    Parameters
+    ----------
+    maxsize : int
+        The maximum number of items in the queue, 0 for no limit.
+    lanes : Optional[tuple]
+        The name and weight of each lane, from the highest to the lowest priority. Defaults to ``lane_weights``.
+    journal : Optional[WorkJournal]
+        The journal to record the items in.
+    reserved : int
+        The number of places in the queue that the lowest priority lane cannot use.
+
+    Raises
+    ------
+    ValueError
+        If the reserved places do not leave room for the lowest priority lane.
+
+    Attributes
+    ----------
+    lanes : dict
+        The entries of each lane. An entry that was moved to another lane is skipped when it is reached.
+    queued : dict
+        The lane and entry of each queued item.
+    in_flight : dict
+        The items taken from the queue that are not finished yet, with the lane to queue each item again in, or None.
+    coalesced : int
+        The number of times an item was added while it was in flight.
+    journal : Optional[WorkJournal]
+        The journal the items are recorded in.
+
+    Methods
+    -------
+    put_unique(item, lane=None)
+        Add an item to a lane of the queue, unless it is already queued.
+    put_many(items, lane=None)
+        Add items to a lane of the queue, skipping the items that are already queued.
+    finish(item)
+        Mark an item taken from the queue as finished.
+    resume()
+        Queue the items the journal recorded as not finished.
+    lane_sizes()
+        Get the number of items in each lane.
+    stats()
+        Get the number of queued and in flight items.
+
+    Examples
+    --------
+    >>> q = WorkQueue()
+    >>> q.put_unique(item=1, lane='sweep')
+    True
+    >>> q.put_unique(item=2, lane='listener')
+    True
+    >>> q.put_unique(item=2, lane='sweep')
+    False
+    >>> q.get()
+    2
+    """
+    def __init__(self, maxsize=0, lanes=None, journal=None, reserved=0):
+        # type: (int, Optional[tuple], Optional[WorkJournal], int) -> None
+        if reserved and not 0 < reserved < maxsize:
+            raise ValueError('reserved must be less than maxsize')
+
+        self.lane_weights = lanes or lane_weights
+        self.journal = journal
+        self.reserved = reserved
+        queue.Queue.__init__(self, maxsize)
+
+    def _init(self, maxsize):
+        self.lane_names = [lane for lane, _ in self.lane_weights]
+        self.weights = dict(self.lane_weights)
+        self.lanes = {lane: deque() for lane in self.lane_names}
+        self.sizes = {lane: 0 for lane in self.lane_names}
+        self.credits = {lane: 0 for lane in self.lane_names}
+        self.queued = {}
+        self.entry_ids = count()
+        self.in_flight = {}
+        self.coalesced = 0
+
+    def _qsize(self):
+        return len(self.queued)
+
+    def _put(self, item, lane=None):
+        lane = lane or self.lane_names[-1]
+
+        previous = self.queued.get(item)
+        if previous:
+            self.sizes[previous[0]] -= 1  # the previous entry is skipped when it is reached
+
+        entry = (lane, next(self.entry_ids))
+        self.lanes[lane].append((item, entry))
+        self.sizes[lane] += 1
+        self.queued[item] = entry
+
+    def _get(self):
+        busy_lanes = [lane for lane in self.lane_names if self.sizes[lane]]
+
+        # smooth weighted round-robin, ties go to the higher priority lane
+        for lane in busy_lanes:
+            self.credits[lane] += self.weights[lane]
+        lane = max(busy_lanes, key=lambda busy_lane: self.credits[busy_lane])
+        self.credits[lane] -= sum(self.weights[busy_lane] for busy_lane in busy_lanes)
+
+        while True:
+            item, entry = self.lanes[lane].popleft()
+            if self.queued.get(item) == entry:
+                break
+
+        del self.queued[item]
+        self.in_flight[item] = None
+        self.sizes[lane] -= 1
+        if not self.sizes[lane]:
+            self.credits[lane] = 0
+
+        if self.reserved:
+            # the producers of each lane wait for a different size, so wake all of them, not only the first one
+            self.not_full.notify_all()
+
+        if self.journal:
+            self.journal.record(op='started', entries=[(item, lane)])
+
+        return item
+
+    def __contains__(self, item):
+        # type: (Hashable) -> bool
+        with self.mutex:
+            return item in self.queued
+
+    def put_unique(self, item, lane=None):
+        # type: (Hashable, Optional[str]) -> bool
+        """
+        Add an item to a lane of the queue, unless it is already queued.
+
+        The check and the insert are done under the queue lock, so two threads cannot queue the same item. An item
+        that is in flight is not queued, it is marked to be queued again in the given lane when it is finished. While
+        the queue is full for the lane, this blocks until a place is free.
+
+        Parameters
+        ----------
+        item : Hashable
+            The item to add.
+        lane : Optional[str]
+            The lane to add the item to. Defaults to the lowest priority lane.
+
+        Returns
+        -------
+        py:class:`bool`
+            True if the item was added, or moved to a higher priority lane. False if it was already queued in the same
+            or a higher priority lane, or if it is in flight.
+
+        Raises
+        ------
+        ValueError
+            If the lane does not exist.
+
+        Examples
+        --------
+        >>> WorkQueue().put_unique(item=1, lane='listener')
+        True
+        """
+        lane = self._validate_lane(lane=lane)
+
+        with self.not_full:
+            added = self._put_unique(item=item, lane=lane)
+            if added and self.journal:
+                self.journal.record(op='queued', entries=[(item, lane)])
+            return added
+
+    def put_many(self, items, lane=None):
+        # type: (Iterable[Hashable], Optional[str]) -> int
+        """
+        Add items to a lane of the queue, skipping the items that are already queued.
+
+        All items are added under a single acquisition of the queue lock, and follow the same rules as
+        ``put_unique()``.
+
+        Parameters
+        ----------
+        items : Iterable[Hashable]
+            The items to add.
+        lane : Optional[str]
+            The lane to add the items to. Defaults to the lowest priority lane.
+
+        Returns
+        -------
+        int
+            The number of items added, or moved to a higher priority lane.
+
+        Raises
+        ------
+        ValueError
+            If the lane does not exist.
+
+        Examples
+        --------
+        >>> WorkQueue().put_many(items=[1, 2, 2], lane='listener')
+        2
+        """
+        lane = self._validate_lane(lane=lane)
+
+        with self.not_full:
+            added = [item for item in items if self._put_unique(item=item, lane=lane)]
+            if added and self.journal:
+                self.journal.record(op='queued', entries=[(item, lane) for item in added])
+            return len(added)
+
+    def _validate_lane(self, lane):
+        # type: (Optional[str]) -> str
+        lane = lane or self.lane_names[-1]
+        if lane not in self.lanes:
+            raise ValueError('lane must be one of: {}'.format(self.lane_names))
+        return lane
+
+    def _lane_limit(self, lane):
+        # type: (str) -> int
+        # the lowest priority lane leaves the reserved places to the other lanes
+        if lane == self.lane_names[-1]:
+            return self.maxsize - self.reserved
+        return self.maxsize
+
+    def _put_unique(self, item, lane):
+        # type: (Hashable, str) -> bool
+        # the caller must hold the queue lock
+        while True:
+            # checked again after each wait, another producer may have queued the item, and a worker taken it
+            if item in self.in_flight:
+                rerun_lane = self.in_flight[item]
+                if rerun_lane is None or self.lane_names.index(lane) < self.lane_names.index(rerun_lane):
+                    self.in_flight[item] = lane
+                self.coalesced += 1
+                return False
+
+            previous = self.queued.get(item)
+            if previous:
+                if self.lane_names.index(previous[0]) <= self.lane_names.index(lane):
+                    return False
+
+                # move the item to the higher priority lane, the queue size does not change
+                self._put(item, lane=lane)
+                self.not_empty.notify()
+                return True
+
+            if not 0 < self._lane_limit(lane=lane) <= self._qsize():
+                break
+            self.not_full.wait()
+
+        self._put(item, lane=lane)
+        self.unfinished_tasks += 1
+        self.not_empty.notify()
+        return True
+
+    def finish(self, item):
+        # type: (Hashable) -> bool
+        """
+        Mark an item taken from the queue as finished.
+
+        If the item was added again while it was in flight, it is queued once more, in the highest priority lane it
+        was added to. The queue size limit is not applied, so a worker finishing an item never blocks.
+
+        Parameters
+        ----------
+        item : Hashable
+            The item to finish.
+
+        Returns
+        -------
+        py:class:`bool`
+            True if the item was queued again.
+
+        Examples
+        --------
+        >>> q = WorkQueue()
+        >>> q.put_unique(item=1)
+        True
+        >>> q.get()
+        1
+        >>> q.put_unique(item=1)
+        False
+        >>> q.finish(item=1)
+        True
+        """
+        with self.mutex:
+            rerun_lane = self.in_flight.pop(item, None)
+            if rerun_lane is None:
+                if self.journal:
+                    self.journal.record(op='finished', entries=[(item, None)])
+                return False
+
+            self._put(item, lane=rerun_lane)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+            if self.journal:
+                self.journal.record(op='queued', entries=[(item, rerun_lane)])
+            return True
+
+    def resume(self):
+        # type: () -> int
+        """
+        Queue the items the journal recorded as not finished.
+
+        The items that were queued, or taken but not finished, before a restart are queued again in the lanes they
+        were in, in the order they were queued. The queue size limit is not applied, so this never blocks, even
+        before the workers are started.
+
+        Returns
+        -------
+        int
+            The number of items queued again.
+
+        Examples
+        --------
+        >>> WorkQueue(journal=WorkJournal(path='work_journal.jsonl')).resume()
+        0
+        """
+        if not self.journal:
+            return 0
+
+        pending = self.journal.load()
+
+        resumed = 0
+        with self.mutex:
+            for item, lane in pending.items():
+                if item in self.queued or item in self.in_flight:
+                    continue
+                # the journal already has the items, they are not recorded again
+                self._put(item, lane=lane if lane in self.lanes else None)
+                self.unfinished_tasks += 1
+                resumed += 1
+            self.not_empty.notify_all()
+        return resumed
+
+    def lane_sizes(self):
+        # type: () -> dict
+        """
+        Get the number of items in each lane.
+
+        Returns
+        -------
+        dict
+            The number of queued items in each lane.
+
+        Examples
+        --------
+        >>> WorkQueue().lane_sizes()
+        {'agent': 0, 'listener': 0, 'manual': 0, 'retry': 0, 'sweep': 0}
+        """
+        with self.mutex:
+            return dict(self.sizes)
+
+    def stats(self):
+        # type: () -> dict
+        """
+        Get the number of queued and in flight items.
+
+        Returns
+        -------
+        dict
+            The number of queued items, items in flight, items added while they were in flight, and items resumed
+            from the journal.
+
+        Examples
+        --------
+        >>> WorkQueue().stats()
+        {'queued': 0, 'in_flight': 0, 'coalesced': 0, 'resumed': 0}
+        """
+        with self.mutex:
+            return dict(queued=len(self.queued), in_flight=len(self.in_flight), coalesced=self.coalesced,
+                        resumed=self.journal.resumed if self.journal else 0)
+
+
+class WorkJournal(object):
+    """
+    An append-only journal of the items of a work queue, kept on disk.
+
+    Each line of the journal is a json array of the operation, the item, and the lane. The items that were queued and
+    not finished are kept in memory as well, so when the journal grows to several times their number, it is compacted
+    by writing only these items to a new journal, which replaces the old one.
+
+    The work queue records the changes while it holds the queue lock, so the records are in the same order as the
+    changes to the queue. Recording only buffers the lines in memory, a writer thread appends them to the file and
+    compacts it, so the queue never waits for the disk. The lines are flushed after each write, but not synced to
+    disk, so a power loss can lose the last records, while a restart of the plugin only loses the records of its last
+    moment.
+
+    Parameters
+    ----------
+    path : str
+        The path of the journal file.
+    compact_min : int
+        The number of records the journal must have before it is compacted.
+
+    Attributes
+    ----------
+    pending : OrderedDict
+        The lane of each item that was queued and not finished, in the order the items were first queued.
+    records : int
+        The number of records in the journal file.
+    resumed : int
+        The number of items that were not finished when the journal was loaded.
+
+    Methods
+    -------
+    load()
+        Read the journal from disk, and compact it.
+    record(op, entries)
+        Buffer records for the journal.
+    flush()
+        Write the buffered records to the journal.
+    compact()
+        Replace the journal with one that only has the pending items.
+
+    Examples
+    --------
+    >>> journal = WorkJournal(path='work_journal.jsonl')
+    >>> journal.record(op='queued', entries=[(1, 'sweep')])
+    >>> journal.pending
+    OrderedDict([(1, 'sweep')])
+    """
+    ops = ('queued', 'started', 'finished')
+
+    def __init__(self, path, compact_min=1000):
+        # type: (str, int) -> None
+        self.path = path
+        self.compact_min = compact_min
+
+        # the condition guards the pending items and the buffer, the write lock guards the file
+        self.condition = threading.Condition(threading.Lock())
+        self.write_lock = threading.Lock()
+        self.pending = OrderedDict()
+        self.buffer = []  # type: List[bytes]
+        self.records = 0
+        self.resumed = 0
+        self.file = None
+        self.writer = None  # type: Optional[threading.Thread]
+
+    def load(self):
+        # type: () -> OrderedDict
+        """
+        Read the journal from disk, and compact it.
+
+        A line that cannot be read, e.g. the last line when the plugin stopped while it was written, is skipped.
+
+        Returns
+        -------
+        OrderedDict
+            The lane of each item that was queued and not finished.
+
+        Examples
+        --------
+        >>> WorkJournal(path='work_journal.jsonl').load()
+        OrderedDict([(1, 'sweep')])
+        """
+        with self.write_lock:
+            with self.condition:
+                self.pending.clear()
+                del self.buffer[:]
+
+                if os.path.isfile(self.path):
+                    with open(self.path, 'rb') as f:
+                        for line in f:
+                            try:
+                                op, item, lane = json.loads(line.decode('utf-8'))
+                            except ValueError:
+                                Log.Warn('Skipping unreadable line in work journal: {}'.format(line))
+                                continue
+                            self._apply(op=op, item=item, lane=lane)
+
+                self.resumed = len(self.pending)
+                pending = OrderedDict(self.pending)
+
+            self._compact(pending=pending)
+            return pending
+
+    def _apply(self, op, item, lane):
+        # type: (str, Hashable, Optional[str]) -> None
+        # the caller must hold the condition
+        if op == 'queued':
+            self.pending[item] = lane
+        elif op == 'finished':
+            self.pending.pop(item, None)
+
+    def record(self, op, entries):
+        # type: (str, List[Tuple[Hashable, Optional[str]]]) -> None
+        """
+        Buffer records for the journal.
+
+        The records are written to disk by the writer thread, see ``flush()``.
+
+        Parameters
+        ----------
+        op : str
+            The operation, one of ``ops``.
+        entries : List[Tuple[Hashable, Optional[str]]]
+            The item and the lane of each record.
+
+        Raises
+        ------
+        ValueError
+            If the operation does not exist.
+
+        Examples
+        --------
+        >>> WorkJournal(path='work_journal.jsonl').record(op='queued', entries=[(1, 'sweep')])
+        """
+        if op not in self.ops:
+            raise ValueError('op must be one of: {}'.format(self.ops))
+
+        with self.condition:
+            for item, lane in entries:
+                self._apply(op=op, item=item, lane=lane)
+                self.buffer.append(json.dumps([op, item, lane]).encode('utf-8') + b'\n')
+
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._run)
+                # when we set daemon to true, that thread will end when the main thread ends
+                self.writer.daemon = True
+                self.writer.start()
+
+    def flush(self):
+        # type: () -> None
+        """
+        Write the buffered records to the journal.
+
+        The journal is compacted once it has grown to several times the number of pending items.
+
+        Examples
+        --------
+        >>> WorkJournal(path='work_journal.jsonl').flush()
+        """
+        with self.write_lock:
+            with self.condition:
+                lines, self.buffer = self.buffer, []
+            if not lines:
+                return
+
+            try:
+                if self.file is None:
+                    self._open()
+                self.file.write(b''.join(lines))
+                self.file.flush()
+            except (IOError, OSError) as e:
+                Log.Error('Error writing to work journal: {}'.format(e))
+                return
+            self.records += len(lines)
+
+            with self.condition:
+                if self.records < max(self.compact_min, 4 * len(self.pending)):
+                    return
+                pending = OrderedDict(self.pending)
+
+            self._compact(pending=pending)
+
+    def compact(self):
+        # type: () -> None
+        """
+        Replace the journal with one that only has the pending items.
+
+        Examples
+        --------
+        >>> WorkJournal(path='work_journal.jsonl').compact()
+        """
+        with self.write_lock:
+            with self.condition:
+                del self.buffer[:]
+                pending = OrderedDict(self.pending)
+
+            self._compact(pending=pending)
+
+    def _run(self):
+        # type: () -> None
+        while True:
+            with self.condition:
+                if not self.buffer:
+                    self.writer = None
+                    return
+
+            self.flush()
+
+    def _open(self):
+        # type: () -> None
+        # the caller must hold the write lock
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        self.file = open(self.path, 'ab')
+
+    def _compact(self, pending):
+        # type: (OrderedDict) -> None
+        # the caller must hold the write lock
+        temp_path = '{}.tmp'.format(self.path)
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+
+            with open(temp_path, 'wb') as f:
+                for item, lane in pending.items():
+                    f.write(json.dumps(['queued', item, lane]).encode('utf-8') + b'\n')
+
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+            # os.rename cannot replace a file on Windows
+            if os.path.isfile(self.path):
+                os.remove(self.path)
+            os.rename(temp_path, self.path)
+        except (IOError, OSError) as e:
+            Log.Error('Error compacting work journal: {}'.format(e))
+            return
+
+        self.records = len(pending)
+
+
+class Debouncer(object):
+    """
+    Collect items while they arrive in bursts, and hand them over in batches.
+
+    A batch is handed over once no item was added for the settle window, or once the oldest item in the batch has
+    waited for the maximum wait, so a steady stream of items is still handed over. Repeats of an item within a batch
+    are collapsed, and the items keep the order they were first added in.
+
+    Parameters
+    ----------
+    callback : Callable[[list], Any]
+        The function the batches are handed to. It is called from a worker thread.
+    settle : float
+        The number of seconds without new items before the batch is handed over.
+    max_wait : float
+        The maximum number of seconds an item waits before the batch is handed over.
+
+    Attributes
+    ----------
+    pending : OrderedDict
+        The items of the batch being collected.
+
+    Methods
+    -------
+    add(items)
+        Add items to the batch being collected.
+    flush()
+        Hand over the batch being collected now.
+
+    Examples
+    --------
+    >>> debouncer = Debouncer(callback=Log.Info, settle=2, max_wait=10)
+    >>> debouncer.add(items=[1, 2, 1])
+    """
+    def __init__(self, callback, settle=2.0, max_wait=10.0):
+        # type: (Callable[[list], Any], float, float) -> None
+        self.callback = callback
+        self.settle = settle
+        self.max_wait = max_wait
+
+        self.lock = threading.Lock()
+        self.pending = OrderedDict()
+        self.first_added_at = None  # type: Optional[float]
+        self.last_added_at = None  # type: Optional[float]
+        self.worker = None  # type: Optional[threading.Thread]
+
+    def add(self, items):
+        # type: (Iterable[Hashable]) -> None
+        """
+        Add items to the batch being collected.
+
+        Parameters
+        ----------
+        items : Iterable[Hashable]
+            The items to add.
+
+        Examples
+        --------
+        >>> Debouncer(callback=Log.Info).add(items=[1, 2, 1])
+        """
+        with self.lock:
+            for item in items:
+                self.pending[item] = None
+
+            if not self.pending:
+                return
+
+            now = time.time()
+            self.last_added_at = now
+            if self.first_added_at is None:
+                self.first_added_at = now
+
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._wait_and_flush)
+                # when we set daemon to true, that thread will end when the main thread ends
+                self.worker.daemon = True
+                self.worker.start()
+
+    def _wait_and_flush(self):
+        # type: () -> None
+        while True:
+            with self.lock:
+                if not self.pending:  # the batch was flushed while waiting
+                    self.worker = None
+                    return
+
+                due_at = min(self.last_added_at + self.settle, self.first_added_at + self.max_wait)
+                wait = due_at - time.time()
+                if wait <= 0:
+                    self.worker = None
+                    batch = self._take_batch()
+                    break
+            time.sleep(wait)
+
+        self._hand_over(batch=batch)
+
+    def _take_batch(self):
+        # type: () -> list
+        # the caller must hold the lock
+        batch = list(self.pending)
+        self.pending.clear()
+        self.first_added_at = None
+        self.last_added_at = None
+        return batch
+
+    def _hand_over(self, batch):
+        # type: (list) -> None
+        if not batch:
+            return
+
+        try:
+            self.callback(batch)
+        except Exception as e:
+            Log.Exception('Unexpected error handing over a batch of {} items: {}'.format(len(batch), e))
+
+    def flush(self):
+        # type: () -> None
+        """
+        Hand over the batch being collected now.
+
+        Examples
+        --------
+        >>> Debouncer(callback=Log.Info).flush()
+        """
+        with self.lock:
+            batch = self._take_batch()
+        self._hand_over(batch=batch)
+
+
+class RetryScheduler(object):
+    """
+    Retry failed items after a delay, without holding up the caller.
+
+    A failed item is kept in a heap ordered by the time it is due, and a timer thread hands it to the callback when
+    it is due, e.g. to queue it again. The delay doubles with each retry, up to the maximum delay, with a random
+    jitter, so the retries of items that failed together are spread out. An item that failed more times than the
+    maximum number of retries is moved to the dead letters instead.
+
+    Parameters
+    ----------
+    callback : Callable[[Hashable], Any]
+        The function the items are handed to when they are due. It is called from the timer thread.
+    max_retries : int
+        The number of times an item is retried.
+    base_delay : float
+        The number of seconds before the first retry.
+    max_delay : float
+        The maximum number of seconds between two retries.
+    dead_letter_max : int
+        The number of dead letters to keep, the oldest ones are dropped first.
+
+    Attributes
+    ----------
+    attempts : dict
+        The number of failed attempts of each item that has not succeeded since.
+    dead_letters : OrderedDict
+        The items that ran out of retries, with the number of attempts, the last error and the time it failed.
+
+    Methods
+    -------
+    failed(item, error)
+        Schedule a retry of a failed item.
+    succeeded(item)
+        Forget the failed attempts of an item.
+    pending(item)
+        Check if an item failed and has not succeeded since.
+    stats()
+        Get the number of scheduled retries and dead letters.
+    get_dead_letters()
+        Get a copy of the dead letters.
+
+    Examples
+    --------
+    >>> retries = RetryScheduler(callback=Log.Info, max_retries=3)
+    >>> retries.failed(item=1, error='timeout')
+    True
+    """
+    def __init__(self, callback, max_retries=3, base_delay=5.0, max_delay=600.0, dead_letter_max=100):
+        # type: (Callable[[Hashable], Any], int, float, float, int) -> None
+        self.callback = callback
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.dead_letter_max = dead_letter_max
+
+        self.condition = threading.Condition(threading.Lock())
+        self.heap = []  # type: List[Tuple[float, int, Hashable]]
+        self.entry_ids = count()
+        self.attempts = {}
+        self.dead_letters = OrderedDict()
+        self.worker = None  # type: Optional[threading.Thread]
+
+    def delay(self, attempt):
+        # type: (int) -> float
+        """
+        Get the number of seconds to wait before a retry.
+
+        Parameters
+        ----------
+        attempt : int
+            The number of failed attempts.
+
+        Returns
+        -------
+        float
+            Half of the backoff delay, plus a random share of the other half.
+
+        Examples
+        --------
+        >>> RetryScheduler(callback=Log.Info, base_delay=5).delay(attempt=2)  # between 5 and 10 seconds
+        8.3
+        """
+        backoff = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return backoff / 2 + random.uniform(0, backoff / 2)
+
+    def failed(self, item, error):
+        # type: (Hashable, Any) -> bool
+        """
+        Schedule a retry of a failed item.
+
+        Parameters
+        ----------
+        item : Hashable
+            The item that failed.
+        error : Any
+            The error, kept with the dead letter if the item runs out of retries.
+
+        Returns
+        -------
+        py:class:`bool`
+            True if a retry was scheduled, False if the item was moved to the dead letters.
+
+        Examples
+        --------
+        >>> RetryScheduler(callback=Log.Info).failed(item=1, error='timeout')
+        True
+        """
+        with self.condition:
+            attempt = self.attempts.get(item, 0) + 1
+
+            if attempt > self.max_retries:
+                self.attempts.pop(item, None)
+                self.dead_letters.pop(item, None)
+                self.dead_letters[item] = dict(attempts=attempt, error=str(error), failed_at=time.time())
+                while len(self.dead_letters) > self.dead_letter_max:
+                    self.dead_letters.popitem(last=False)
+                return False
+
+            self.attempts[item] = attempt
+            heapq.heappush(self.heap, (time.time() + self.delay(attempt=attempt), next(self.entry_ids), item))
+            self.condition.notify()
+
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._run)
+                # when we set daemon to true, that thread will end when the main thread ends
+                self.worker.daemon = True
+                self.worker.start()
+            return True
+
+    def succeeded(self, item):
+        # type: (Hashable) -> None
+        """
+        Forget the failed attempts of an item.
+
+        Parameters
+        ----------
+        item : Hashable
+            The item that succeeded.
+
+        Examples
+        --------
+        >>> RetryScheduler(callback=Log.Info).succeeded(item=1)
+        """
+        with self.condition:
+            self.attempts.pop(item, None)
+            self.dead_letters.pop(item, None)
+
+    def pending(self, item):
+        # type: (Hashable) -> bool
+        """
+        Check if an item failed and has not succeeded since.
+
+        Parameters
+        ----------
+        item : Hashable
+            The item to check.
+
+        Returns
+        -------
+        py:class:`bool`
+            True if a retry of the item is scheduled or was handed to the callback, False if the item succeeded, or
+            was moved to the dead letters.
+
+        Examples
+        --------
+        >>> RetryScheduler(callback=Log.Info).pending(item=1)
+        False
+        """
+        with self.condition:
+            return item in self.attempts
+
+    def stats(self):
+        # type: () -> dict
+        """
+        Get the number of scheduled retries and dead letters.
+
+        Returns
+        -------
+        dict
+            The number of retries waiting for their time, and the number of dead letters.
+
+        Examples
+        --------
+        >>> RetryScheduler(callback=Log.Info).stats()
+        {'scheduled': 0, 'dead_letters': 0}
+        """
+        with self.condition:
+            return dict(scheduled=len(self.heap), dead_letters=len(self.dead_letters))
+
+    def get_dead_letters(self):
+        # type: () -> OrderedDict
+        """
+        Get a copy of the dead letters.
+
+        The dead letters are copied under the lock, so they can be read while the timer thread and the workers
+        change them.
+
+        Returns
+        -------
+        OrderedDict
+            The items that ran out of retries, oldest first, with the number of attempts, the last error and the time
+            it failed.
+
+        Examples
+        --------
+        >>> RetryScheduler(callback=Log.Info).get_dead_letters()
+        OrderedDict()
+        """
+        with self.condition:
+            return OrderedDict((item, dict(dead_letter)) for item, dead_letter in self.dead_letters.items())
+
+    def _run(self):
+        # type: () -> None
+        while True:
+            with self.condition:
+                while True:
+                    if not self.heap:
+                        self.worker = None
+                        return
+
+                    wait = self.heap[0][0] - time.time()
+                    if wait <= 0:
+                        _, _, item = heapq.heappop(self.heap)
+                        break
+                    self.condition.wait(wait)  # woken early when an earlier retry is scheduled
+
+            try:
+                self.callback(item)
+            except Exception as e:
+                Log.Exception('Unexpected error retrying item: {}, error: {}'.format(item, e))
+
+
+class AdaptiveBatchSize(object):
+    """
+    A batch size that adapts to the observed latency of the requests.
+
+    The batch size is halved when a request takes longer than the target latency, and doubled when a request takes
+    less than half of it, within the minimum and maximum sizes.
+
+    Parameters
+    ----------
+    maximum : int
+        The largest batch size.
+    target_latency : float
+        The number of seconds a request should take.
+    minimum : int
+        The smallest batch size.
+
+    Attributes
+    ----------
+    size : int
+        The current batch size, starting at the minimum.
+
+    Methods
+    -------
+    record(seconds)
+        Adapt the batch size to the latency of a request.
+
+    Examples
+    --------
+    >>> batch_size = AdaptiveBatchSize(maximum=50, target_latency=2)
+    >>> batch_size.record(seconds=0.1)
+    >>> batch_size.size
+    2
+    """
+    def __init__(self, maximum, target_latency, minimum=1):
+        # type: (int, float, int) -> None
+        self.maximum = max(minimum, maximum)
+        self.target_latency = target_latency
+        self.minimum = minimum
+        self.size = minimum
+
+    def __call__(self):
+        # type: () -> int
+        return self.size
+
+    def record(self, seconds):
+        # type: (float) -> None
+        """
+        Adapt the batch size to the latency of a request.
+
+        Parameters
+        ----------
+        seconds : float
+            The number of seconds the request took.
+
+        Examples
+        --------
+        >>> AdaptiveBatchSize(maximum=50, target_latency=2).record(seconds=0.1)
+        """
+        if seconds > self.target_latency:
+            self.size = max(self.minimum, self.size // 2)
+        elif seconds < self.target_latency / 2.0:
+            self.size = min(self.maximum, self.size * 2)
+
+
+class Pipeline(object):
+    """
+    Stages connected by bounded queues, each with its own pool of worker threads.
+
+    Each stage is a function that takes a job from the previous stage and returns the job for the next stage, or None
+    when there is nothing left to do. The first stage takes its jobs from the source queue. Since the queues between
+    the stages are bounded, a slow stage holds back the stages before it, instead of letting jobs pile up in memory.
+
+    Each job carries the source item it was made from. When the job ends, after the last stage, or when a stage returns
+    None or raises an exception, the source item is finished on the source queue, if the source queue supports it.
+
+    With a batch size, the first stage takes a list of the items waiting in the source queue, up to the batch size,
+    and returns a list with the job for each item, or None, in the same order.
+
+    Parameters
+    ----------
+    source : queue.Queue
+        The queue the first stage takes its jobs from.
+    stages : List[Tuple[str, Callable, int]]
+        The name, function and number of worker threads of each stage, in order.
+    queue_size : int
+        The maximum number of jobs waiting between two stages.
+    batch_size : Optional[Callable[[], int]]
+        Returns the maximum number of items the first stage takes at once. The first stage takes single items if None.
+
+    Attributes
+    ----------
+    queues : list
+        The queue each stage takes its jobs from, starting with the source queue.
+    threads : list
+        The worker threads of all stages.
+
+    Methods
+    -------
+    start()
+        Start the worker threads of all stages.
+    join()
+        Block until every job has passed through all stages.
+
+    Examples
+    --------
+    >>> pipeline = Pipeline(source=WorkQueue(), stages=[('double', lambda job: job * 2, 2), ('log', Log.Info, 1)])
+    >>> pipeline.start()
+    """
+    def __init__(self, source, stages, queue_size=100, batch_size=None):
+        # type: (queue.Queue, List[Tuple[str, Callable[[Any], Any], int]], int, Optional[Callable[[], int]]) -> None
+        self.stages = stages
+        self.batch_size = batch_size
+        self.queues = [source] + [queue.Queue(maxsize=queue_size) for _ in stages[1:]]
+        self.threads = []
+
+    def start(self):
+        # type: () -> None
+        """
+        Start the worker threads of all stages.
+
+        Each stage gets at least one worker thread.
+
+        Examples
+        --------
+        >>> Pipeline(source=WorkQueue(), stages=[('log', Log.Info, 1)]).start()
+        """
+        finish = getattr(self.queues[0], 'finish', None)
+
+        for index, (name, func, threads) in enumerate(self.stages):
+            out_queue = self.queues[index + 1] if index + 1 < len(self.stages) else None
+            kwargs = dict(name=name, func=func, in_queue=self.queues[index], out_queue=out_queue, finish=finish)
+
+            if index == 0 and self.batch_size:
+                target = self._work_batch
+                kwargs['batch_size'] = self.batch_size
+            else:
+                target = self._work
+                kwargs['from_source'] = index == 0
+
+            for _ in range(max(1, threads)):
+                try:
+                    t = threading.Thread(target=target, kwargs=kwargs)
+                    # when we set daemon to true, that thread will end when the main thread ends
+                    t.daemon = True
+                    t.start()
+                except RuntimeError as e:
+                    Log.Error('RuntimeError encountered: %s' % e)
+                    break
+                self.threads.append(t)
+
+    @staticmethod
+    def _work(name, func, in_queue, out_queue, from_source=True, finish=None):
+        # type: (str, Callable[[Any], Any], queue.Queue, Optional[queue.Queue], bool, Optional[Callable]) -> None
+        while True:
+            job = in_queue.get()
+            if from_source:
+                item = job
+            else:
+                item, job = job
+
+            try:
+                result = func(job)
+            except Exception as e:
+                Log.Exception('Unexpected error in {} stage, job: {}, error: {}'.format(name, job, e))
+                result = None
+
+            if result is not None and out_queue is not None:
+                out_queue.put((item, result))  # blocks while the next stage is busy
+            elif finish:
+                finish(item)  # queues the item again if it was added while in flight
+
+            in_queue.task_done()  # the job is done here, after it was handed to the next stage
+
+    @staticmethod
+    def _work_batch(name, func, in_queue, out_queue, batch_size, finish=None):
+        # type: (str, Callable, queue.Queue, Optional[queue.Queue], Callable[[], int], Optional[Callable]) -> None
+        while True:
+            # wait for the first item, then take the items that are already waiting, up to the batch size
+            items = [in_queue.get()]
+            size = batch_size()
+            while len(items) < size:
+                try:
+                    items.append(in_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                results = func(items)
+            except Exception as e:
+                Log.Exception('Unexpected error in {} stage, jobs: {}, error: {}'.format(name, items, e))
+                results = [None] * len(items)
+
+            for item, result in zip(items, results):
+                if result is not None and out_queue is not None:
+                    out_queue.put((item, result))  # blocks while the next stage is busy
+                elif finish:
+                    finish(item)  # queues the item again if it was added while in flight
+
+                in_queue.task_done()
+
+    def join(self):
+        # type: () -> None
+        """
+        Block until every job has passed through all stages.
+
+        Examples
+        --------
+        >>> Pipeline(source=WorkQueue(), stages=[('log', Log.Info, 1)]).join()
+        """
+        while True:
+            for stage_queue in self.queues:
+                stage_queue.join()
+
+            # a later stage can queue an item on the source again when it finishes, after the source was joined
+            if not any(stage_queue.unfinished_tasks for stage_queue in self.queues):
+                return
@@ -1,8 +1,19 @@
 # -*- coding: utf-8 -*-
 
 # standard imports
-from threading import Lock
+from array import array
+from bisect import bisect_left
+import codecs
+import hashlib
+from itertools import islice
+import json
+import os
+import random
+import re
+import tempfile
+from threading import BoundedSemaphore, Event, Lock, Thread
 import time
+import zlib
 
 # plex debugging
 try:
@@ -10,15 +21,59 @@ try:
 except ImportError:
     pass
 else:  # the code is running outside of Plex
+    from plexhints.core_kit import Core  # core kit
     from plexhints.log_kit import Log  # log kit
-    from plexhints.parse_kit import JSON  # parse kit
+    from plexhints.prefs_kit import Prefs  # prefs kit
 
 # imports from Libraries\Shared
-from typing import Union
+from future.moves import queue
+import requests
+from six.moves import zip
+from typing import Any, Callable, Hashable, Iterable, Iterator, Optional, Tuple, Union
+
+# local imports
+from constants import themerr_data_directory
+
+base_url = 'https://app.lizardbyte.dev/ThemerrDB'
 
 database_cache = {}
 last_cache_update = 0
 
+# the validator, IDs, and records of every page, used to only re-index pages that changed
+page_cache = {}
+
+# the records of every database type, keyed by (database, id)
+record_cache = {}
+
+# where the ThemerrDB index is persisted between restarts
+database_cache_file = os.path.join(themerr_data_directory, 'themerr_db_index.json.zlib')
+database_cache_file_version = 4
+
+# individual ThemerrDB items, with the validators used to revalidate them
+item_cache_directory = os.path.join(themerr_data_directory, 'ThemerrDB')
+item_cache_max_age = 3600
+item_cache_stats = dict(
+    records=0,  # served from the record cache
+    hits=0,  # served from the item cache without a request
+    misses=0,  # not cached, fetched from ThemerrDB
+    revalidated=0,  # cached, ThemerrDB confirmed it has not changed
+    updated=0,  # cached, ThemerrDB returned a newer version
+    stale=0,  # cached, served after the request failed
+    errors=0,  # the request failed and no usable cached version was available
+)
+item_cache_stats_lock = Lock()
+
+session = requests.Session()
+request_timeout = 30
+
+# pages are parsed while they are downloaded, so only one chunk and one item are held in memory at a time
+page_chunk_size = 64 * 1024
+json_whitespace = re.compile(r'[ \t\n\r]*')
+
+# without validators from the server, a page is spooled while it is hashed, so an unchanged page is never parsed,
+# larger pages are spooled to disk
+page_spool_max_size = 1024 * 1024
+
 db_field_name = dict(
     games={'igdb': 'id'},
     game_collections={'igdb': 'id'},
@@ -28,61 +83,1063 @@ db_field_name = dict(
     tv_shows={'themoviedb': 'id'},
 )
 
+# the fields of a ThemerrDB item that are used by Themerr, kept in the record cache when the pages provide them
+record_fields = (
+    'youtube_theme_url',
+    'poster_path',
+    'backdrop_path',
+    'overview',
+)
+
+# IDs are stored as sorted arrays of integers, this is the prefix to strip before converting an ID to an integer
+db_id_prefix = dict(
+    igdb='',
+    imdb='tt',
+    themoviedb='',
+)
+
+# held for the duration of a full refresh, readers never wait on this lock
 lock = Lock()
 
+# held while a database type is being refreshed, so a cold start only waits for the type it needs
+type_locks = {database_type: Lock() for database_type in db_field_name}
+
+# held only while a refreshed snapshot is swapped in
+swap_lock = Lock()
+
+# the duration and outcome of the last full refresh
+refresh_stats = dict(
+    last_refresh_started=None,
+    last_refresh_duration=None,
+    last_refresh_outcome=None,
+    last_refresh_failed_types=[],
+)
+
+# the state of each database type, a failed refresh keeps the previous snapshot and is retried with backoff
+type_refresh_state = {}
+refresh_backoff_base = 60
+refresh_backoff_max = 3600
+
+# how often each database type is refreshed, in seconds, a random jitter spreads the refreshes apart
+type_refresh_policy = dict(
+    games=dict(interval=86400, jitter=3600),
+    game_collections=dict(interval=86400, jitter=3600),
+    game_franchises=dict(interval=86400, jitter=3600),
+    movies=dict(interval=3600, jitter=300),
+    movie_collections=dict(interval=21600, jitter=1800),
+    tv_shows=dict(interval=3600, jitter=300),
+)
+
+# the database types used by the Plex libraries, None until the libraries are known
+active_database_types = None
+
+
+class SingleFlight(object):
+    """
+    Run a function only once for concurrent callers.
+
+    The first caller for a key runs the function. Callers that arrive with the same key while it is running wait for
+    it to finish and receive the same result, or the same exception, instead of running the function again.
+
+    Attributes
+    ----------
+    calls : dict
+        The calls in progress, keyed by the call key.
+    calls_lock : Lock
+        The lock for ``calls``.
+
+    Methods
+    -------
+    do(key, func)
+        Run the function, or join the call already in progress for the key.
+
+    Examples
+    --------
+    >>> SingleFlight().do(key='all', func=update_cache)
+    """
+    def __init__(self):
+        self.calls = {}
+        self.calls_lock = Lock()
+
+    def do(self, key, func):
+        # type: (Hashable, Callable) -> Any
+        """
+        Run the function, or join the call already in progress for the key.
+
+        Parameters
+        ----------
+        key : Hashable
+            Identifies the call, callers with the same key share a single call.
+        func : Callable
+            The function to run, it is called without arguments.
+
+        Returns
+        -------
+        Any
+            The result of the function.
+
+        Raises
+        ------
+        Exception
+            Any exception raised by the function is raised for every caller.
+
+        Examples
+        --------
+        >>> SingleFlight().do(key='all', func=lambda: 'Hello, world!')
+        'Hello, world!'
+        """
+        with self.calls_lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = dict(event=Event(), result=None, exception=None)
+
+        if not leader:
+            call['event'].wait()
+        else:
+            try:
+                call['result'] = func()
+            except Exception as e:
+                call['exception'] = e
+            finally:
+                with self.calls_lock:
+                    del self.calls[key]
+                call['event'].set()
+
+        if call['exception'] is not None:
+            raise call['exception']
+        return call['result']
+
+
+refresh_flight = SingleFlight()
+
+
+def run_concurrently(func, args_list, threads):
+    # type: (Callable, Iterable, int) -> dict
+    """
+    Run a function for each argument using a bounded number of threads.
+
+    Parameters
+    ----------
+    func : Callable
+        The function to run. It is called with a single argument.
+    args_list : Iterable
+        The arguments to call the function with. Each argument must be hashable.
+    threads : int
+        The maximum number of threads to use, minimum value of 1.
+
+    Returns
+    -------
+    dict
+        A dictionary mapping each argument to the result of the function, or the exception raised by the function.
+
+    Examples
+    --------
+    >>> run_concurrently(func=str, args_list=[1, 2], threads=2)
+    {1: '1', 2: '2'}
+    """
+    results = {}
+
+    work_queue = queue.Queue()
+    for args in args_list:
+        work_queue.put(item=args)
+
+    def worker():
+        while True:
+            try:
+                worker_args = work_queue.get_nowait()
+            except queue.Empty:
+                return
+
+            try:
+                results[worker_args] = func(worker_args)
+            except Exception as worker_exception:
+                results[worker_args] = worker_exception
+
+    workers = [Thread(target=worker) for _ in range(max(1, min(threads, work_queue.qsize())))]
+    for t in workers:
+        t.daemon = True
+        t.start()
+    for t in workers:
+        t.join()
+
+    return results
+
+
+def get_json(url):
+    # type: (str) -> Union[dict, list]
+    """
+    Get a JSON object from ThemerrDB.
+
+    Parameters
+    ----------
+    url : str
+        The url of the JSON file.
+
+    Returns
+    -------
+    Union[dict, list]
+        The JSON object.
+
+    Examples
+    --------
+    >>> get_json(url='https://app.lizardbyte.dev/ThemerrDB/movies/pages.json')
+    {'pages': ...}
+    """
+    response = session.get(url=url, timeout=request_timeout)
+    response.raise_for_status()
+    return response.json()
+
+
+def iter_json_array(chunks, fields):
+    # type: (Iterable[bytes], Iterable[str]) -> Iterator[dict]
+    """
+    Parse a JSON array of objects from a stream of bytes.
+
+    Each object is decoded as soon as it is complete and only the requested fields are kept, so the memory used does
+    not grow with the size of the array.
+
+    Parameters
+    ----------
+    chunks : Iterable[bytes]
+        The UTF-8 encoded JSON document, in chunks of any size.
+    fields : Iterable[str]
+        The fields to keep from each object.
+
+    Yields
+    ------
+    dict
+        The requested fields of each object in the array.
+
+    Raises
+    ------
+    ValueError
+        If the document is not a JSON array of objects.
+
+    Examples
+    --------
+    >>> list(iter_json_array(chunks=[b'[{"id": 1, "ti', b'tle": "a"}, {"id": 2}]'], fields=['id']))
+    [{'id': 1}, {'id': 2}]
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    fields = frozenset(fields)
+    chunks = iter(chunks)
+
+    buffer = u''
+    position = 0
+    expected = '['  # '[', then 'value' or ']' for the first item, then ',' or ']' after each item
+    exhausted = False
+
+    while True:
+        position = json_whitespace.match(buffer, position).end()
+
+        if position < len(buffer):
+            char = buffer[position]
+            if expected == '[':
+                if char != u'[':
+                    raise ValueError('Expected a JSON array')
+                position += 1
+                expected = 'first'
+                continue
+            if char == u']' and expected in ('first', ','):
+                return
+            if expected == ',':
+                if char != u',':
+                    raise ValueError('Expected "," or "]" at position {}'.format(position))
+                position += 1
+                expected = 'value'
+                continue
+
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if exhausted:
+                    raise
+                # the item is not complete yet
+            else:
+                if not isinstance(item, dict):
+                    raise ValueError('Expected a JSON object at position {}'.format(position))
+                position = end
+                expected = ','
+                yield {key: value for key, value in item.items() if key in fields}
+                continue
+        elif exhausted:
+            raise ValueError('Unexpected end of JSON array')
+
+        # read more, dropping everything that has been parsed
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            exhausted = True
+            chunk = text_decoder.decode(b'', True)
+        else:
+            chunk = text_decoder.decode(chunk)
+        buffer = buffer[position:] + chunk
+        position = 0
+
+
+def encode_id(database, id):
+    # type: (str, Union[int, str]) -> Optional[int]
+    """
+    Convert an ID to the integer stored in the cache.
+
+    Parameters
+    ----------
+    database : str
+        The database the ID belongs to.
+    id : Union[int, str]
+        The ID to convert.
+
+    Returns
+    -------
+    Optional[int]
+        The integer ID, or None if the ID is not valid for the database.
+
+    Examples
+    --------
+    >>> encode_id(database='themoviedb', id='710')
+    710
+    >>> encode_id(database='imdb', id='tt0113189')
+    113189
+    >>> encode_id(database='imdb', id=None)
+    """
+    prefix = db_id_prefix.get(database)
+    if prefix is None or id is None:
+        return
+
+    value = str(id)
+    if not value.startswith(prefix):
+        return
+
+    try:
+        return int(value[len(prefix):])
+    except ValueError:
+        return
+
+
+def build_id_array(ids):
+    # type: (Iterable[int]) -> array
+    """
+    Build a sorted array of unique integer IDs.
+
+    Parameters
+    ----------
+    ids : Iterable[int]
+        The IDs to store.
+
+    Returns
+    -------
+    array
+        The sorted array of IDs.
+
+    Examples
+    --------
+    >>> build_id_array(ids=[3, 1, 2, 1])
+    array('l', [1, 2, 3])
+    """
+    ids = array('l', ids)
+
+    # pages are usually already in order, which avoids building a set and a list of the IDs
+    if any(previous >= current for previous, current in zip(ids, islice(ids, 1, None))):
+        ids = array('l', sorted(set(ids)))
+
+    return ids
+
 
-def update_cache():
-    # type: () -> None
+def id_array_contains(ids, value):
+    # type: (array, Optional[int]) -> bool
+    """
+    Check if an ID is in a sorted array of IDs, using a binary search.
+
+    Parameters
+    ----------
+    ids : array
+        The sorted array of IDs.
+    value : Optional[int]
+        The ID to look for, as returned by ``encode_id()``.
+
+    Returns
+    -------
+    py:class:`bool`
+        True if the ID is in the array, otherwise False.
+
+    Examples
+    --------
+    >>> id_array_contains(ids=array('l', [1, 2, 3]), value=2)
+    True
+    """
+    if value is None:
+        return False
+
+    index = bisect_left(ids, value)
+    return index < len(ids) and ids[index] == value
+
+
+def get_page(database_type, page, previous=None):
+    # type: (str, int, Optional[dict]) -> Tuple[dict, bool]
+    """
+    Get the IDs and records from a single ThemerrDB page.
+
+    Records are only collected for items that include the ``youtube_theme_url`` field, otherwise the page only
+    provides IDs and the item data must be fetched individually.
+
+    When the previous version of the page is provided, the page is requested conditionally using the ETag and
+    Last-Modified validators sent by the server. If the server does not support conditional requests, a hash of the
+    raw content is compared instead, before the page is parsed. In both cases, the previous IDs and records are
+    reused for an unchanged page.
+
+    The page is parsed with ``iter_json_array()`` while it is downloaded, keeping only the ID and record fields, so
+    the full page is never held in memory. A page that is hashed first is spooled, to disk if it is large.
+
+    Parameters
+    ----------
+    database_type : str
+        The database type of the page.
+    page : int
+        The page number, starting at 1.
+    previous : Optional[dict]
+        The previous entry for this page from ``page_cache``.
+
+    Returns
+    -------
+    Tuple[dict, py:class:`bool`]
+        The page entry, containing the ``validator``, ``ids``, and ``records`` of the page, and whether the page
+        changed.
+
+    Examples
+    --------
+    >>> get_page(database_type='movies', page=1)
+    ({'validator': {...}, 'ids': {'imdb': array('l', [...]), 'themoviedb': array('l', [...])}, 'records': [...]}, True)
+    """
+    headers = {}
+    if previous:
+        if previous['validator'].get('etag'):
+            headers['If-None-Match'] = previous['validator']['etag']
+        if previous['validator'].get('last_modified'):
+            headers['If-Modified-Since'] = previous['validator']['last_modified']
+
+    response = session.get(
+        url='{}/{}/all_page_{}.json'.format(base_url, database_type, page),
+        headers=headers,
+        timeout=request_timeout,
+        stream=True,
+    )
+
+    spool = None
+    try:
+        if response.status_code == 304 and previous:
+            return previous, False
+
+        response.raise_for_status()
+
+        validator = dict(
+            etag=response.headers.get('ETag'),
+            last_modified=response.headers.get('Last-Modified'),
+        )
+        content_hash = hashlib.sha256()
+
+        if previous and previous['validator'].get('sha256') and not validator['etag'] and \
+                not validator['last_modified']:
+            # the server did not validate the page, hash it before parsing it
+            spool = tempfile.SpooledTemporaryFile(max_size=page_spool_max_size)
+            for chunk in response.iter_content(chunk_size=page_chunk_size):
+                content_hash.update(chunk)
+                spool.write(chunk)
+
+            validator['sha256'] = content_hash.hexdigest()
+            if previous['validator']['sha256'] == validator['sha256']:
+                return dict(validator=validator, ids=previous['ids'], records=previous['records']), False
+
+            spool.seek(0)
+            chunks = iter(lambda: spool.read(page_chunk_size), b'')
+        else:
+            def hashed_chunks():
+                for chunk in response.iter_content(chunk_size=page_chunk_size):
+                    content_hash.update(chunk)
+                    yield chunk
+
+            chunks = hashed_chunks()
+
+        fields = db_field_name[database_type]
+        encoded_ids = {db: array('l') for db in fields}
+        records = []
+
+        for item in iter_json_array(chunks=chunks, fields=set(fields.values()).union(record_fields)):
+            item_ids = {}
+            for db, field in fields.items():
+                value = encode_id(database=db, id=item.get(field))
+                if value is not None:
+                    encoded_ids[db].append(value)
+                    item_ids[db] = value
+
+            if 'youtube_theme_url' in item:
+                records.append(dict(
+                    ids=item_ids,
+                    data={field: item[field] for field in record_fields if field in item},
+                ))
+    finally:
+        response.close()
+        if spool is not None:
+            spool.close()
+
+    validator['sha256'] = content_hash.hexdigest()
+
+    if previous and previous['validator'].get('sha256') == validator['sha256']:
+        return dict(validator=validator, ids=previous['ids'], records=previous['records']), False
+
+    ids = {db: build_id_array(ids=values) for db, values in encoded_ids.items()}
+
+    return dict(validator=validator, ids=ids, records=records), True
+
+
+def build_type_cache(database_type, pages):
+    # type: (str, dict) -> dict
+    """
+    Combine the IDs of all pages of a database type.
+
+    Parameters
+    ----------
+    database_type : str
+        The database type of the pages.
+    pages : dict
+        The page entries for the database type, keyed by page number.
+
+    Returns
+    -------
+    dict
+        The sorted array of IDs for each database.
+
+    Examples
+    --------
+    >>> build_type_cache(database_type='games', pages={1: {'validator': {}, 'ids': {'igdb': array('l', [1638])}}})
+    {'igdb': array('l', [1638])}
+    """
+    return {
+        db: build_id_array(ids=(value for page_entry in pages.values() for value in page_entry['ids'].get(db, [])))
+        for db in db_field_name[database_type]
+    }
+
+
+def build_type_records(pages):
+    # type: (dict) -> dict
+    """
+    Combine the records of all pages of a database type.
+
+    Parameters
+    ----------
+    pages : dict
+        The page entries for the database type, keyed by page number.
+
+    Returns
+    -------
+    dict
+        The record data, keyed by ``(database, id)``.
+
+    Examples
+    --------
+    >>> build_type_records(pages={1: {..., 'records': [{'ids': {'igdb': 1638}, 'data': {'youtube_theme_url': ...}}]}})
+    {('igdb', 1638): {'youtube_theme_url': ...}}
+    """
+    return {
+        (db, value): record['data']
+        for page_entry in pages.values()
+        for record in page_entry['records']
+        for db, value in record['ids'].items()
+    }
+
+
+def publish_type_cache(database_type, pages, type_cache):
+    # type: (str, Optional[dict], dict) -> None
+    """
+    Swap a refreshed database type into the cache.
+
+    The cache dictionaries are copied and replaced, instead of being modified in place, so readers always see a
+    complete snapshot without taking a lock. The records are rebuilt from the pages, so they are always in step with
+    the ID index.
+
+    Parameters
+    ----------
+    database_type : str
+        The database type that was refreshed.
+    pages : Optional[dict]
+        The page entries for the database type, or None to remove them.
+    type_cache : dict
+        The set of IDs for each database.
+
+    Examples
+    --------
+    >>> publish_type_cache(database_type='games', pages={...}, type_cache={'igdb': {'1638'}})
+    """
+    global database_cache, page_cache, record_cache
+
+    type_records = build_type_records(pages=pages) if pages else {}
+
+    with swap_lock:
+        new_page_cache = dict(page_cache)
+        if pages is None:
+            new_page_cache.pop(database_type, None)
+        else:
+            new_page_cache[database_type] = pages
+
+        new_database_cache = dict(database_cache)
+        new_database_cache[database_type] = type_cache
+
+        new_record_cache = dict(record_cache)
+        new_record_cache[database_type] = type_records
+
+        page_cache = new_page_cache
+        database_cache = new_database_cache
+        record_cache = new_record_cache
+
+
+def get_type_refresh_state(database_type):
+    # type: (str) -> dict
+    """
+    Get the refresh state of a database type.
+
+    Parameters
+    ----------
+    database_type : str
+        The database type to get the refresh state for.
+
+    Returns
+    -------
+    dict
+        The time the snapshot was last updated, the number of consecutive failures, the time of the next retry and
+        the last error.
+
+    Examples
+    --------
+    >>> get_type_refresh_state(database_type='movies')
+    {'updated': ..., 'due_at': ..., 'failures': 0, 'retry_at': 0, 'last_error': None}
+    """
+    return type_refresh_state.setdefault(
+        database_type, dict(updated=None, due_at=0, failures=0, retry_at=0, last_error=None))
+
+
+def schedule_next_refresh(database_type, updated):
+    # type: (str, float) -> None
+    """
+    Schedule the next refresh of a database type, according to its refresh policy.
+
+    Parameters
+    ----------
+    database_type : str
+        The database type to schedule.
+    updated : float
+        The time the database type was last refreshed.
+
+    Examples
+    --------
+    >>> schedule_next_refresh(database_type='movies', updated=time.time())
+    """
+    policy = type_refresh_policy[database_type]
+
+    state = get_type_refresh_state(database_type=database_type)
+    state['updated'] = updated
+    state['due_at'] = updated + policy['interval'] + random.uniform(0, policy['jitter'])
+
+
+def request_refresh(database_types=None):
+    # type: (Optional[Iterable[str]]) -> None
+    """
+    Make database types due for a refresh.
+
+    The refresh is performed by the next call to ``update_cache()``. A database type that is backing off after a
+    failure is retried as well.
+
+    Parameters
+    ----------
+    database_types : Optional[Iterable[str]]
+        The database types to refresh. Defaults to all database types.
+
+    Examples
+    --------
+    >>> request_refresh(database_types=['movies'])
+    """
+    for database_type in database_types or db_field_name:
+        state = get_type_refresh_state(database_type=database_type)
+        state['due_at'] = 0
+        state['retry_at'] = 0
+
+
+def refresh_type(database_type, fetch_threads, fetch_limit, only_if_missing=False):
+    # type: (str, int, BoundedSemaphore, bool) -> bool
+    """
+    Refresh a single database type.
+
+    The new index is built off to the side, then swapped in with ``publish_type_cache()``.
+
+    If the refresh fails, the previous snapshot is kept, so items of this type do not look absent from ThemerrDB
+    because of a transient error. The database type is then retried with exponential backoff, and attempts made
+    before the backoff has elapsed are skipped without any requests.
+
+    Parameters
+    ----------
+    database_type : str
+        The database type to refresh.
+    fetch_threads : int
+        The number of threads to use to fetch pages.
+    fetch_limit : BoundedSemaphore
+        Limits the number of requests in progress, shared by all database types being refreshed.
+    only_if_missing : py:class:`bool`
+        Skip the refresh if the database type is already in the cache, e.g. when another thread refreshed it while
+        waiting for the lock.
+
+    Returns
+    -------
+    py:class:`bool`
+        False if the refresh failed, otherwise True.
+
+    Examples
+    --------
+    >>> refresh_type(database_type='games', fetch_threads=4, fetch_limit=BoundedSemaphore(4))
+    True
+    """
+    def limited(func, **kwargs):
+        with fetch_limit:
+            return func(**kwargs)
+
+    with type_locks[database_type]:
+        if only_if_missing and database_type in database_cache:
+            return True
+
+        state = get_type_refresh_state(database_type=database_type)
+        if time.time() < state['retry_at']:
+            Log.Debug('{}: skipping refresh, retrying after {}'.format(database_type, time.ctime(state['retry_at'])))
+            return False
+
+        try:
+            page_count = limited(func=get_json, url='{}/{}/pages.json'.format(base_url, database_type))['pages']
+
+            previous_pages = page_cache.get(database_type, {})
+            pages = run_concurrently(
+                func=lambda page: limited(
+                    func=get_page, database_type=database_type, page=page, previous=previous_pages.get(page)),
+                args_list=range(1, page_count + 1),
+                threads=fetch_threads,
+            )
+
+            type_pages = {}
+            changed_pages = 0
+
+            for page in range(1, page_count + 1):
+                if isinstance(pages[page], Exception):
+                    raise pages[page]
+
+                type_pages[page] = pages[page][0]
+                changed_pages += pages[page][1]
+
+            publish_type_cache(
+                database_type=database_type,
+                pages=type_pages,
+                type_cache=build_type_cache(database_type=database_type, pages=type_pages),
+            )
+
+            Log.Info('{}: database updated, {} of {} pages changed'.format(
+                database_type, changed_pages, len(type_pages)))
+        except Exception as e:
+            state['failures'] += 1
+            state['last_error'] = str(e)
+            state['retry_at'] = time.time() + min(
+                refresh_backoff_max, refresh_backoff_base * 2 ** (state['failures'] - 1))
+
+            Log.Error('{}: Error retrieving page index from ThemerrDB, keeping the previous snapshot and retrying '
+                      'after {}: {}'.format(database_type, time.ctime(state['retry_at']), e))
+            return False
+
+        schedule_next_refresh(database_type=database_type, updated=time.time())
+        state['failures'] = 0
+        state['last_error'] = None
+        state['retry_at'] = 0
+
+    return True
+
+
+def update_cache(fetch_threads=None, database_types=None, active_types=None):
+    # type: (Optional[int], Optional[Iterable[str]], Optional[Iterable[str]]) -> dict
     """
     Update the ThemerrDB cache.
 
     The pages.json file is fetched for all database types, then each all_page_N.json file is fetched to form the
-    complete set of available IDs.
+    complete set of available IDs. All database types are refreshed in parallel, sharing a bounded number of
+    concurrent requests.
+
+    Pages are requested conditionally, so only pages that changed since the last update, or are new, are downloaded
+    and indexed again. Unchanged pages are reused from the previous index.
 
-    Attempting to update the cache while an update is already in progress will wait until the current update is
-    complete.
+    The cache is never locked for readers. Each database type is built off to the side and swapped in as soon as it
+    is complete, so readers keep using the previous snapshot until then.
 
-    Updating the cache less than an hour after the last update is a no-op.
+    Refreshes are single-flight. Calling this while an update is already in progress joins that update and returns
+    its result, instead of starting another one.
+
+    Each database type is refreshed on its own schedule, see ``type_refresh_policy``. Only database types that are
+    due, or that failed and whose backoff has elapsed, are refreshed. Database types that are not used by any Plex
+    library are not refreshed at all. This is checked once the update is running, so callers that arrive together
+    only refresh once. Use ``request_refresh()`` to refresh a database type before it is due.
+
+    Parameters
+    ----------
+    fetch_threads : Optional[int]
+        The number of threads to use to fetch pages. Defaults to the ``int_themerr_db_fetch_threads`` preference.
+    database_types : Optional[Iterable[str]]
+        Only refresh these database types, if they are not already in the cache. This is used when a reader needs a
+        database type that has not been loaded yet.
+    active_types : Optional[Iterable[str]]
+        The database types used by the Plex libraries, see ``plex_api_helper.get_library_database_types()``. This is
+        remembered for later updates. Until it is known, all database types are refreshed.
+
+    Returns
+    -------
+    dict
+        The refresh statistics, see ``refresh_stats``.
+
+    Examples
+    --------
+    >>> update_cache()
+    {'last_refresh_started': ..., 'last_refresh_duration': ..., 'last_refresh_outcome': 'success', ...}
+    >>> update_cache(database_types=['movies'])
+    {...}
+    >>> update_cache(active_types={'movies', 'movie_collections'})
+    {...}
     """
-    Log.Info('Updating ThemerrDB cache')
+    global active_database_types
 
-    global last_cache_update
+    if active_types is not None:
+        active_database_types = frozenset(active_types)
 
-    if time.time() - last_cache_update < 3600:
-        Log.Info('Cache updated less than an hour ago, skipping')
-        return
+    if fetch_threads is None:
+        fetch_threads = int(Prefs['int_themerr_db_fetch_threads'])
+    fetch_limit = BoundedSemaphore(max(1, fetch_threads))
 
-    with lock:
-        for database_type, databases in db_field_name.items():
-            try:
-                pages = JSON.ObjectFromURL(
-                    cacheTime=3600,
-                    url='https://app.lizardbyte.dev/ThemerrDB/{}/pages.json'.format(database_type),
-                    errors='ignore'  # don't crash the plugin
-                )
-                page_count = pages['pages']
+    if database_types is not None:
+        published_pages = page_cache
+        for database_type in database_types:
+            refresh_flight.do(
+                key=database_type,
+                func=lambda: refresh_type(
+                    database_type=database_type, fetch_threads=fetch_threads, fetch_limit=fetch_limit,
+                    only_if_missing=True),
+            )
 
-                id_index = {db: set() for db in databases}
+        # the page cache is replaced when a snapshot is published, skipped and failed refreshes do not replace it
+        if page_cache is not published_pages:
+            save_cache()
+        return refresh_stats
 
-                for page in range(page_count):
-                    page_data = JSON.ObjectFromURL(
-                        cacheTime=3600,
-                        url='https://app.lizardbyte.dev/ThemerrDB/{}/all_page_{}.json'.format(database_type, page + 1),
-                        errors='ignore'  # don't crash the plugin
-                    )
+    def full_refresh():
+        global last_cache_update, refresh_stats
 
-                    for db in databases:
-                        id_index[db].update(str(item[db_field_name[database_type][db]]) for item in page_data)
+        with lock:
+            started = time.time()
 
-                database_cache[database_type] = id_index
+            used_types = [
+                database_type for database_type in db_field_name
+                if active_database_types is None or database_type in active_database_types
+            ]
 
-                Log.Info('{}: database updated'.format(database_type))
-            except Exception as e:
-                Log.Error('{}: Error retrieving page index from ThemerrDB: {}'.format(database_type, e))
+            refresh_types = []
+            for database_type in used_types:
+                state = get_type_refresh_state(database_type=database_type)
+                if started >= (state['retry_at'] if state['failures'] else state['due_at']):
+                    refresh_types.append(database_type)
+
+            if not refresh_types:
+                Log.Info('No ThemerrDB database types are due for a refresh, skipping')
+                return refresh_stats
+
+            Log.Info('Updating ThemerrDB cache for: {}'.format(refresh_types))
+
+            run_concurrently(
+                func=lambda database_type: refresh_type(
+                    database_type=database_type, fetch_threads=fetch_threads, fetch_limit=fetch_limit),
+                args_list=refresh_types,
+                threads=len(refresh_types),
+            )
+            failed_types = sorted(
+                database_type for database_type in used_types
+                if get_type_refresh_state(database_type=database_type)['failures'])
 
-                database_cache[database_type] = {}
+            if not failed_types:
+                outcome = 'success'
+            elif len(failed_types) < len(used_types):
+                outcome = 'partial'
+            else:
+                outcome = 'failed'
 
-        last_cache_update = time.time()
+            last_cache_update = time.time()
+
+            refresh_stats = dict(
+                last_refresh_started=started,
+                last_refresh_duration=last_cache_update - started,
+                last_refresh_outcome=outcome,
+                last_refresh_failed_types=failed_types,
+            )
+            Log.Info('ThemerrDB cache update finished in {:.1f} seconds, outcome: {}'.format(
+                refresh_stats['last_refresh_duration'], outcome))
+
+            save_cache()
+
+            return refresh_stats
+
+    return refresh_flight.do(key='all', func=full_refresh)
+
+
+def save_cache():
+    # type: () -> bool
+    """
+    Save the ThemerrDB cache to disk.
+
+    The page index, including the validators and IDs of every page, is written to the Themerr data directory as zlib
+    compressed JSON, along with the time it was fetched. The sorted integer IDs compress well.
+
+    Returns
+    -------
+    py:class:`bool`
+        True if the cache was saved, otherwise False.
+
+    Examples
+    --------
+    >>> save_cache()
+    True
+    """
+    data = dict(
+        version=database_cache_file_version,
+        last_cache_update=last_cache_update,
+        type_updated={
+            database_type: state['updated'] for database_type, state in type_refresh_state.items()
+            if state['updated']
+        },
+        page_cache={
+            database_type: {
+                page: dict(validator=page_entry['validator'],
+                           ids={db: ids.tolist() for db, ids in page_entry['ids'].items()},
+                           records=page_entry['records'])
+                for page, page_entry in pages.items()
+            }
+            for database_type, pages in page_cache.items()
+        },
+    )
+
+    try:
+        if not os.path.isdir(os.path.dirname(database_cache_file)):
+            os.makedirs(os.path.dirname(database_cache_file))
+
+        Core.storage.save(
+            filename=database_cache_file,
+            data=zlib.compress(json.dumps(data, separators=(',', ':')).encode('utf-8')),
+            binary=True,
+        )
+    except Exception as e:
+        Log.Error('Error saving ThemerrDB cache to disk: {}'.format(e))
+        return False
+
+    return True
+
+
+def load_cache():
+    # type: () -> bool
+    """
+    Load the ThemerrDB cache from disk.
+
+    This is called when the module is imported, so that ``item_exists()`` can answer immediately after the plugin is
+    restarted, instead of waiting for the full index to be fetched again. The fetch time of each database type is
+    restored as well, so its next refresh is scheduled as usual, and the page validators allow the refresh to skip
+    pages that have not changed.
+
+    Returns
+    -------
+    py:class:`bool`
+        True if the cache was loaded, otherwise False.
+
+    Examples
+    --------
+    >>> load_cache()
+    True
+    """
+    global database_cache, last_cache_update, page_cache, record_cache
+
+    if not os.path.isfile(database_cache_file):
+        return False
+
+    try:
+        data = json.loads(zlib.decompress(Core.storage.load(filename=database_cache_file, binary=True)).decode('utf-8'))
+    except Exception as e:
+        Log.Error('Error loading ThemerrDB cache from disk: {}'.format(e))
+        return False
+
+    if data.get('version') != database_cache_file_version:
+        Log.Info('ThemerrDB cache on disk is from an older version, ignoring it')
+        return False
+
+    # json object keys are always strings, restore the page numbers and ID arrays
+    page_cache = {
+        database_type: {
+            int(page): dict(validator=page_entry['validator'],
+                            ids={db: array('l', ids) for db, ids in page_entry['ids'].items()},
+                            records=page_entry['records'])
+            for page, page_entry in pages.items()
+        }
+        for database_type, pages in data['page_cache'].items()
+        if database_type in db_field_name
+    }
+    database_cache = {
+        database_type: build_type_cache(database_type=database_type, pages=pages)
+        for database_type, pages in page_cache.items()
+    }
+    record_cache = {
+        database_type: build_type_records(pages=pages)
+        for database_type, pages in page_cache.items()
+    }
+    last_cache_update = data['last_cache_update']
+
+    for database_type in page_cache:
+        schedule_next_refresh(
+            database_type=database_type,
+            updated=data.get('type_updated', {}).get(database_type, last_cache_update),
+        )
+
+    Log.Info('Loaded ThemerrDB cache from disk, last updated: {}'.format(time.ctime(last_cache_update)))
+    return True
+
+
+def get_index_version(database_types):
+    # type: (Iterable[str]) -> Optional[str]
+    """
+    Get the version of the index for the given database types.
+
+    The version is a digest of the content hashes of the indexed pages, so it only changes when ThemerrDB changed.
+
+    Parameters
+    ----------
+    database_types : Iterable[str]
+        The database types, e.g. ``movies`` and ``movie_collections``.
+
+    Returns
+    -------
+    Optional[str]
+        The version of the index, or None if none of the database types are indexed.
+
+    Examples
+    --------
+    >>> get_index_version(database_types=['movies', 'movie_collections'])
+    '3b1f...'
+    """
+    pages = page_cache  # a snapshot, the cache is swapped and not modified in place
+
+    version = hashlib.sha256()
+    indexed = False
+    for database_type in sorted(database_types):
+        if database_type not in pages:
+            continue
+        indexed = True
+        for page in sorted(pages[database_type]):
+            version.update('{}:{}:{}\n'.format(
+                database_type, page, pages[database_type][page]['validator'].get('sha256')).encode('utf-8'))
+
+    return version.hexdigest() if indexed else None
 
 
 def item_exists(database_type, database, id):
@@ -120,7 +1177,156 @@ def item_exists(database_type, database, id):
         return False
 
     if database_type not in database_cache:
-        update_cache()
+        # only wait for the database type that is needed
+        update_cache(database_types=[database_type])
+
+    type_cache = database_cache.get(database_type, {})
+    return database in type_cache and id_array_contains(
+        ids=type_cache[database], value=encode_id(database=database, id=id))
+
+
+def get_record(database_type, database, id):
+    # type: (str, str, Union[int, str]) -> Optional[dict]
+    """
+    Get the record of an item from the local record cache.
+
+    The record cache is filled from the ThemerrDB pages when they are indexed, so this does not make any requests.
+
+    Parameters
+    ----------
+    database_type : str
+        The type of database of the item.
+    database : str
+        The database of the item.
+    id : Union[int, str]
+        The ID of the item.
+
+    Returns
+    -------
+    Optional[dict]
+        The ``youtube_theme_url``, ``poster_path``, ``backdrop_path`` and ``overview`` of the item, when available,
+        or None if the item is not in the record cache.
+
+    Examples
+    --------
+    >>> get_record(database_type='movies', database='themoviedb', id=710)
+    {'youtube_theme_url': 'https://www.youtube.com/watch?v=...', 'poster_path': ..., ...}
+    """
+    return record_cache.get(database_type, {}).get((database, encode_id(database=database, id=id)))
+
+
+def _count_item_cache(stat):
+    # type: (str) -> None
+    """Increment an item cache counter."""
+    with item_cache_stats_lock:
+        item_cache_stats[stat] += 1
+
+
+def get_item_data(database_type, database, id):
+    # type: (str, str, Union[int, str]) -> Optional[dict]
+    """
+    Get the data of an item from ThemerrDB.
+
+    The record cache is used when it has the item. Otherwise, the individual item is cached in the Themerr data
+    directory along with its ETag and Last-Modified validators. A cached item is used without any request for an hour,
+    then it is revalidated with a conditional request, so an unchanged item is not downloaded again.
+
+    If the request fails, the cached item continues to be used until it is older than the
+    ``int_themerr_db_max_staleness`` preference.
+
+    Parameters
+    ----------
+    database_type : str
+        The type of database of the item.
+    database : str
+        The database of the item.
+    id : Union[int, str]
+        The ID of the item.
+
+    Returns
+    -------
+    Optional[dict]
+        The item data, or None if it could not be retrieved.
+
+    Examples
+    --------
+    >>> get_item_data(database_type='movies', database='themoviedb', id=710)
+    {'youtube_theme_url': 'https://www.youtube.com/watch?v=...', ...}
+    """
+    record = get_record(database_type=database_type, database=database, id=id)
+    if record is not None:
+        _count_item_cache(stat='records')
+        return record
+
+    item_cache_file = os.path.join(item_cache_directory, database_type, database, '{}.json'.format(id))
+
+    cached = None
+    if os.path.isfile(item_cache_file):
+        try:
+            cached = json.loads(s=str(Core.storage.load(filename=item_cache_file, binary=False)))
+
+            # a truncated file, or an entry from an older version, is a cache miss
+            cached = dict(
+                data=cached['data'],
+                fetched=float(cached['fetched']),
+                etag=cached.get('etag'),
+                last_modified=cached.get('last_modified'),
+            )
+        except Exception as e:
+            Log.Error('Error loading cached ThemerrDB item {}: {}'.format(item_cache_file, e))
+            cached = None
+
+    now = time.time()
+    if cached and now - cached['fetched'] < item_cache_max_age:
+        _count_item_cache(stat='hits')
+        return cached['data']
+
+    headers = {}
+    if cached:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
+    try:
+        response = session.get(
+            url='{}/{}/{}/{}.json'.format(base_url, database_type, database, id),
+            headers=headers,
+            timeout=request_timeout,
+        )
+
+        if response.status_code == 304 and cached:
+            _count_item_cache(stat='revalidated')
+        else:
+            response.raise_for_status()
+            _count_item_cache(stat='updated' if cached else 'misses')
+            cached = dict(
+                data=response.json(),
+                etag=response.headers.get('ETag'),
+                last_modified=response.headers.get('Last-Modified'),
+            )
+    except Exception as e:
+        if cached and now - cached['fetched'] < int(Prefs['int_themerr_db_max_staleness']) * 3600:
+            Log.Warning('{}/{}/{}: Error retrieving data from ThemerrDB, using cached data: {}'.format(
+                database_type, database, id, e))
+            _count_item_cache(stat='stale')
+            return cached['data']
+
+        Log.Error('{}/{}/{}: Error retrieving data from ThemerrDB: {}'.format(database_type, database, id, e))
+        _count_item_cache(stat='errors')
+        return
+
+    cached['fetched'] = now
+
+    try:
+        if not os.path.isdir(os.path.dirname(item_cache_file)):
+            os.makedirs(os.path.dirname(item_cache_file))
+        Core.storage.save(filename=item_cache_file, data=json.dumps(cached), binary=False)
+    except Exception as e:
+        Log.Error('Error saving cached ThemerrDB item {}: {}'.format(item_cache_file, e))
+
+    return cached['data']
+
 
-    type_cache = database_cache[database_type]
-    return database in type_cache and str(id) in type_cache[database]
+# restore the last known index, a refresh will be performed in the background when the plugin starts
+load_cache()
@@ -4,10 +4,12 @@
 from __future__ import division  # fix float division for python2
 
 # standard imports
+from itertools import chain
 import json
 import logging
 import os
 from threading import Lock, Thread
+import time
 
 # plex debugging
 try:
@@ -23,7 +25,7 @@ else:  # the code is running outside of Plex
 
 # lib imports
 import flask
-from flask import Flask, Response, render_template, send_from_directory
+from flask import Flask, Response, redirect, render_template, request, send_from_directory
 from flask_babel import Babel
 import polib
 from six.moves.urllib.parse import quote_plus
@@ -32,7 +34,17 @@ from werkzeug.utils import secure_filename
 # local imports
 from constants import contributes_to, issue_urls, plugin_directory, plugin_identifier, themerr_data_directory
 import general_helper
-from plex_api_helper import get_database_info, setup_plexapi
+from plex_api_helper import (
+    get_database_info,
+    get_library_database_types,
+    iter_section_items,
+    last_sweep,
+    listener_stats,
+    lock_retries,
+    q,
+    setup_plexapi,
+    upload_retries
+)
 import themerr_db_helper
 import tmdb_helper
 
@@ -108,6 +120,7 @@ database_cache_lock = Lock()
 
 
 responses = {
+    400: Response(response='Bad Request', status=400, mimetype='text/plain'),
     500: Response(response='Internal Server Error', status=500, mimetype='text/plain')
 }
 
@@ -208,10 +221,10 @@ def cache_data():
     plex_server = setup_plexapi()
     plex_library = plex_server.library
 
-    themerr_db_helper.update_cache()
-
     sections = plex_library.sections()
 
+    themerr_db_helper.update_cache(active_types=get_library_database_types(sections=sections))
+
     items = dict()
 
     for section in sections:
@@ -220,39 +233,34 @@ def cache_data():
             # a individual items that was matched with a supported agent...
             continue  # skip unsupported metadata agents
 
-        # get all the items in the section
-        media_items = section.all()
-
-        # get all items in the section with theme songs
-        media_items_with_themes = section.all(theme__exists=True)
+        # get all the items in the section, one page at a time, so only one page of Plex objects is held in memory
+        media_items = iter_section_items(section=section)
 
         # get all collections in the section
-        collections = section.collections() if Prefs['bool_auto_update_collection_themes'] else []
-        collections_with_themes = section.collections(theme__exists=True) if Prefs[
+        collections = iter_section_items(section=section, libtype='collection') if Prefs[
             'bool_auto_update_collection_themes'] else []
 
-        # combine the items and collections into one list
+        # chain the items and collections
         # this is done so that we can process both items and collections in the same loop
-        all_items = media_items + collections
+        all_items = chain(media_items, collections)
 
-        # add each section to the items dict
+        # add each section to the items dict, the counts are added once all the items are processed
         items[section.key] = dict(
             key=section.key,
             title=section.title,
             agent=section.agent,
             items=[],
-            media_count=len(media_items),
-            media_percent_complete=int(
-                len(media_items_with_themes) / len(media_items) * 100) if len(media_items_with_themes) else 0,
-            collection_count=len(collections),
-            collection_percent_complete=int(
-                len(collections_with_themes) / len(collections) * 100) if len(collections_with_themes) else 0,
             collections_enabled=Prefs['bool_auto_update_collection_themes'],
-            total_count=len(all_items),
             type=section.type,
         )
+        counts = dict(media=0, media_with_themes=0, collection=0, collection_with_themes=0)
 
         for item in all_items:
+            count_key = 'collection' if item.type == 'collection' else 'media'
+            counts[count_key] += 1
+            if item.theme:
+                counts['{}_with_themes'.format(count_key)] += 1
+
             # build the issue url
             database_info = get_database_info(item=item)
             database_type = database_info[0]
@@ -356,6 +364,7 @@ def cache_data():
                 database_id=database_id,
                 issue_action=issue_action,
                 issue_url=item_issue_url,
+                rating_key=item.ratingKey,
                 theme=True if item.theme else False,
                 theme_provider=theme_provider,
                 theme_status=theme_status,
@@ -363,6 +372,17 @@ def cache_data():
                 year=year,
             ))
 
+        items[section.key].update(
+            media_count=counts['media'],
+            media_percent_complete=int(
+                counts['media_with_themes'] / counts['media'] * 100) if counts['media_with_themes'] else 0,
+            collection_count=counts['collection'],
+            collection_percent_complete=int(
+                counts['collection_with_themes'] / counts['collection'] * 100) if counts[
+                'collection_with_themes'] else 0,
+            total_count=counts['media'] + counts['collection'],
+        )
+
     with database_cache_lock:
         Core.storage.save(filename=database_cache_file, data=json.dumps(items), binary=False)
 
@@ -403,6 +423,148 @@ def home():
     return render_template('home.html', title='Home', items=items)
 
 
+@app.route('/update/<int:rating_key>', methods=["POST"])
+def update_item(rating_key):
+    # type: (int) -> Response
+    """
+    Queue an item to be updated.
+
+    The item is added to the ``manual`` lane of the work queue, so it is processed ahead of the scheduled update.
+
+    Parameters
+    ----------
+    rating_key : int
+        The rating key of the item to update.
+
+    Returns
+    -------
+    Response
+        A redirect to the home page.
+
+    Notes
+    -----
+    The following routes trigger this function.
+
+        - `/update/<rating_key>`
+
+    Examples
+    --------
+    >>> update_item(rating_key=1)
+    """
+    q.put_unique(item=rating_key, lane='manual')
+    return redirect('/')
+
+
+@app.route('/diagnostics', methods=["GET"])
+def diagnostics():
+    # type: () -> render_template
+    """
+    Serve the webapp diagnostics page.
+
+    This page shows the state of the ThemerrDB caches, including the age of the snapshot of each database type, the
+    state of the work queue, the items that failed after all retries, and the plan of the last scheduled update.
+
+    Returns
+    -------
+    render_template
+        The rendered page.
+
+    Notes
+    -----
+    The following routes trigger this function.
+
+        - `/diagnostics`
+
+    Examples
+    --------
+    >>> diagnostics()
+    """
+    now = time.time()
+    active_types = themerr_db_helper.active_database_types
+
+    database_types = []
+    for database_type in sorted(themerr_db_helper.db_field_name):
+        state = themerr_db_helper.get_type_refresh_state(database_type=database_type)
+        database_types.append(dict(
+            name=database_type,
+            active=active_types is None or database_type in active_types,
+            age=now - state['updated'] if state['updated'] else None,
+            next_refresh_in=max(0, (state['retry_at'] if state['failures'] else state['due_at']) - now),
+            failures=state['failures'],
+            last_error=state['last_error'],
+        ))
+
+    # the items that ran out of retries, the latest first
+    dead_letters = [
+        dict(rating_key=rating_key, media_type=media_type, action='upload', **dead_letter)
+        for (rating_key, media_type), dead_letter in upload_retries.get_dead_letters().items()
+    ] + [
+        dict(rating_key=rating_key, media_type=media_type, action='unlock', **dead_letter)
+        for (rating_key, media_type), dead_letter in lock_retries.get_dead_letters().items()
+    ]
+    dead_letters.sort(key=lambda dead_letter: dead_letter['failed_at'], reverse=True)
+    for dead_letter in dead_letters:
+        dead_letter['age'] = now - dead_letter['failed_at']
+
+    return render_template(
+        'diagnostics.html',
+        title='Diagnostics',
+        item_cache_stats=themerr_db_helper.item_cache_stats,
+        database_types=database_types,
+        lane_sizes=q.lane_sizes(),
+        queue_stats=q.stats(),
+        retry_stats=dict(scheduled=upload_retries.stats()['scheduled'] + lock_retries.stats()['scheduled']),
+        dead_letters=dead_letters,
+        listener_stats=listener_stats,
+        last_sweep=last_sweep,
+        last_sweep_age=now - last_sweep['started_at'] if last_sweep['started_at'] else None,
+    )
+
+
+@app.route('/diagnostics/refresh', methods=["POST"])
+def diagnostics_refresh():
+    # type: () -> Response
+    """
+    Refresh a ThemerrDB database type now.
+
+    The database type is taken from the ``database_type`` form field. The refresh runs in the background, and the
+    browser is redirected back to the diagnostics page.
+
+    Returns
+    -------
+    Response
+        A redirect to the diagnostics page, a 400 response if the database type is not valid, or a 409 response if
+        the database type is not used by any Plex library.
+
+    Notes
+    -----
+    The following routes trigger this function.
+
+        - `/diagnostics/refresh`
+
+    Examples
+    --------
+    >>> diagnostics_refresh()
+    """
+    database_type = request.form.get('database_type')
+    if database_type not in themerr_db_helper.db_field_name:
+        return responses[400]
+
+    # the refresh skips database types that are not used by any library
+    active_types = themerr_db_helper.active_database_types
+    if active_types is not None and database_type not in active_types:
+        return Response(response="Database type '{}' is not used by any Plex library".format(database_type),
+                        status=409, mimetype='text/plain')
+
+    themerr_db_helper.request_refresh(database_types=[database_type])
+
+    refresh_thread = Thread(target=themerr_db_helper.update_cache)
+    refresh_thread.daemon = True
+    refresh_thread.start()
+
+    return redirect('/diagnostics')
+
+
 @app.route("/<path:img>", methods=["GET"])
 def image(img):
     # type: (str) -> flask.send_from_directory
@@ -446,6 +608,8 @@ def status():
     This can be used to test if the plugin is still running. It could be used as part of a healthcheck for Docker,
     and may have many other uses in the future.
 
+    The duration and outcome of the last ThemerrDB cache refresh are included.
+
     Returns
     -------
     dict
@@ -455,7 +619,7 @@ def status():
     --------
     >>> status()
     """
-    web_status = {'result': 'success', 'message': 'Ok'}
+    web_status = {'result': 'success', 'message': 'Ok', 'themerr_db': themerr_db_helper.refresh_stats}
     return web_status
 
 
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+# standard imports
+import os
+import sys
+import threading
+import time
+import traceback
+
+# lib imports
+import pytest
+from six.moves import BaseHTTPServer, socketserver
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+
+class ThreadedHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def handler_factory(routes, delay):
+    """
+    Create a request handler serving the given routes.
+
+    Each route is either the response body, or a callable accepting the request handler and returning a tuple of
+    ``(status, headers, body)``.
+    """
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(delay)  # simulate network latency
+
+            route = routes.get(self.path.split('?', 1)[0])
+            if route is None:
+                status, headers, body = 404, {}, b'Not Found'
+            elif callable(route):
+                status, headers, body = route(self)
+            else:
+                status, headers, body = 200, {}, route
+
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass  # keep the test output clean
+
+    return Handler
+
+
+@pytest.fixture(scope='function')
+def http_stand_in():
+    """Start local HTTP servers that serve synthetic files, returns a function that starts a server."""
+    servers = []
+
+    def start(routes, delay=0.0):
+        server = ThreadedHTTPServer(('127.0.0.1', 0), handler_factory(routes=routes, delay=delay))
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        servers.append(server)
+        return 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+    yield start
+
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def measure_peak_memory(func):
+    # type: (callable) -> int
+    """
+    Measure how much the peak resident set size grows while calling a function, in bytes.
+
+    The function is called in a forked child process, so each measurement starts from the size of the process at the
+    fork, and does not depend on the tests that ran before. Side effects of the function are lost with the child.
+    """
+    if resource is None or not hasattr(os, 'fork'):
+        pytest.skip('The peak resident set size can only be measured in a forked process')
+
+    # ru_maxrss is in bytes on macOS, and in kilobytes elsewhere
+    unit = 1 if sys.platform == 'darwin' else 1024
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:  # child
+        status = 1
+        try:
+            os.close(read_fd)
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            func()
+            after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            os.write(write_fd, str((after - before) * unit).encode('utf-8'))
+            status = 0
+        except BaseException:
+            os.write(write_fd, traceback.format_exc().encode('utf-8'))
+        finally:
+            os._exit(status)
+
+    os.close(write_fd)
+    output = b''
+    while True:
+        chunk = os.read(read_fd, 4096)
+        if not chunk:
+            break
+        output += chunk
+    os.close(read_fd)
+
+    _, status = os.waitpid(pid, 0)
+    assert status == 0, 'Measured function failed:\n{}'.format(output.decode('utf-8'))
+    return int(output)
+
+
+@pytest.fixture(scope='function')
+def peak_memory():
+    """Returns a function that measures the peak memory growth while calling a function, in bytes."""
+    return measure_peak_memory
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+# standard imports
+import logging
+
+# lib imports
+import plexapi.server
+import pytest
+from six.moves.urllib.parse import parse_qs, urlparse
+
+# local imports
+from Code import plex_api_helper
+
+pytestmark = pytest.mark.benchmark
+
+
+def synthetic_section_page(section_size):
+    # type: (int) -> callable
+    """Serve the pages of a synthetic movie section, honoring the Plex container paging headers."""
+    def route(handler):
+        query = parse_qs(urlparse(handler.path).query)
+
+        def paging(name, default):
+            value = handler.headers.get(name) or query.get(name, [default])[0]
+            return int(value)
+
+        start = paging('X-Plex-Container-Start', 0)
+        size = paging('X-Plex-Container-Size', section_size)
+        rating_keys = range(start + 1, min(start + size, section_size) + 1)
+
+        body = '<MediaContainer size="{}" totalSize="{}" offset="{}">{}</MediaContainer>'.format(
+            len(rating_keys), section_size, start, ''.join(
+                '<Video ratingKey="{0}" key="/library/metadata/{0}" type="movie" title="Movie {0}" '
+                'guid="plex://movie/{0}" year="2000" librarySectionID="1" />'.format(rating_key)
+                for rating_key in rating_keys
+            ))
+        return 200, {'Content-Type': 'text/xml'}, body.encode('utf-8')
+
+    return route
+
+
+def synthetic_plex_server(http_stand_in, section_size):
+    # type: (callable, int) -> plexapi.server.PlexServer
+    """Start a Plex server stand-in with a single movie section."""
+    sections = (
+        b'<MediaContainer size="1"><Directory key="1" type="movie" title="Movies" agent="tv.plex.agents.movie" '
+        b'scanner="Plex Movie" language="en-US" uuid="stand-in" /></MediaContainer>'
+    )
+    url = http_stand_in(routes={
+        '/': b'<MediaContainer machineIdentifier="stand-in" version="1.40.0.0" friendlyName="stand-in" />',
+        '/library': b'<MediaContainer title1="Plex Library" />',
+        '/library/sections': sections,
+        '/library/sections/': sections,
+        '/library/sections/1/all': synthetic_section_page(section_size=section_size),
+    })
+    return plexapi.server.PlexServer(baseurl=url, token='stand-in')
+
+
+def test_iter_section_items_memory(caplog, http_stand_in, peak_memory):
+    # the captured log records of each request would grow with the section
+    caplog.set_level(logging.WARNING)
+
+    peaks = {}
+    for section_size in (5000, 50000):
+        section = synthetic_plex_server(http_stand_in=http_stand_in, section_size=section_size).library.section(
+            'Movies')
+
+        def walk_pages():
+            count = 0
+            for _ in plex_api_helper.iter_section_items(section=section):
+                count += 1
+            assert count == section_size
+
+        peaks[section_size] = peak_memory(walk_pages)
+
+    # only one page is held in memory, so the peak memory stays flat as the section grows
+    assert peaks[50000] - peaks[5000] < 1024 * 1024, 'Paged walk held the section in memory: {}'.format(peaks)
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+# standard imports
+import time
+
+# lib imports
+import pytest
+from future.moves import queue
+from typing import Optional
+
+# local imports
+from Code import queue_helper
+
+pytestmark = pytest.mark.benchmark
+
+
+def sweep_with_scan(item_count):
+    # type: (int) -> float
+    """Enqueue a sweep the previous way, scanning the queue for each item."""
+    q = queue.Queue()
+    start = time.time()
+    for item in range(item_count):
+        if item not in q.queue:
+            q.put(item=item)
+    return time.time() - start
+
+
+def sweep_with_set(item_count):
+    # type: (int) -> float
+    """Enqueue a sweep with the set backed work queue."""
+    q = queue_helper.WorkQueue()
+    start = time.time()
+    for item in range(item_count):
+        q.put_unique(item=item)
+    return time.time() - start
+
+
+def test_sweep_enqueue():
+    durations = {}
+    for item_count in (1000, 10000, 100000):
+        durations[item_count] = dict(
+            # the scan is quadratic, only measure it where it finishes in a reasonable time
+            scan=sweep_with_scan(item_count=item_count) if item_count <= 10000 else None,
+            set=sweep_with_set(item_count=item_count),
+        )
+
+    assert durations[10000]['set'] < durations[10000]['scan'], \
+        'Set backed enqueue was not faster: {}'.format(durations)
+
+    # enqueue time grows linearly with the sweep, allowing generous headroom for timer noise
+    assert durations[100000]['set'] < 50 * durations[1000]['set'] + 0.5, \
+        'Enqueue time grew faster than the sweep: {}'.format(durations)
+
+
+def test_listener_latency_during_sweep():
+    q = queue_helper.WorkQueue()
+    for item in range(50000):
+        q.put_unique(item=item, lane='sweep')
+
+    # simulate workers that take 1 ms per item, in the middle of the sweep
+    for _ in range(1000):
+        q.get()
+        time.sleep(0.001)
+
+    start = time.time()
+    q.put_unique(item='new', lane='listener')
+
+    processed_before = 0
+    while q.get() != 'new':
+        processed_before += 1
+        time.sleep(0.001)
+    latency = time.time() - start
+
+    assert processed_before <= 1, 'Listener item waited behind {} sweep items, {:.3f} seconds'.format(
+        processed_before, latency)
+    assert q.qsize() == 50000 - 1000 - processed_before
+
+
+def simulated_stages(finished, slow_every):
+    # type: (dict, int) -> list
+    """Create update stages with simulated latencies, where only some items need the slow extraction."""
+    def resolve(job):
+        time.sleep(0.002)  # plex fetch and guid resolution
+        return job
+
+    def lookup(job):
+        time.sleep(0.001)  # local ThemerrDB index
+        if job % slow_every:
+            finished[job] = time.time()  # nothing to update
+            return None
+        return job
+
+    def extract(job):
+        time.sleep(0.1)  # youtube extraction
+        return job
+
+    def upload(job):
+        time.sleep(0.005)  # plex upload
+        finished[job] = time.time()
+        return job
+
+    return [('resolve', resolve, 2), ('lookup', lookup, 2), ('extract', extract, 2), ('upload', upload, 3)]
+
+
+def test_pipeline_quick_items_not_blocked():
+    item_count = 200
+    slow_every = 5
+    durations = {}
+
+    # the previous model, each worker runs every stage of an item before taking the next item
+    finished = {}
+    stages = simulated_stages(finished=finished, slow_every=slow_every)
+
+    def serial(job):
+        for _, func, _ in stages:
+            job = func(job)
+            if job is None:
+                return
+
+    source = queue_helper.WorkQueue()
+    queue_helper.Pipeline(source=source, stages=[('serial', serial, 3)]).start()
+    start = time.time()
+    for item in range(item_count):
+        source.put_unique(item=item)
+    source.join()
+    durations['serial'] = dict(
+        quick=max(t for item, t in finished.items() if item % slow_every) - start,
+        total=max(finished.values()) - start,
+    )
+
+    # the staged pipeline, using the default number of threads for each stage
+    finished = {}
+    source = queue_helper.WorkQueue()
+    pipeline = queue_helper.Pipeline(source=source, stages=simulated_stages(finished=finished, slow_every=slow_every))
+    pipeline.start()
+    start = time.time()
+    for item in range(item_count):
+        source.put_unique(item=item)
+    pipeline.join()
+    durations['pipeline'] = dict(
+        quick=max(t for item, t in finished.items() if item % slow_every) - start,
+        total=max(finished.values()) - start,
+    )
+
+    assert len(finished) == item_count
+    assert durations['pipeline']['quick'] < durations['serial']['quick'] / 2, \
+        'Quick items waited behind extraction, seconds until all quick items / all items are done: {}'.format(
+            durations)
+
+
+def test_listener_burst_ingestion():
+    # a library scan reports 2000 items, each one 5 times
+    events = [item for _ in range(5) for item in range(2000)]
+
+    q = queue_helper.WorkQueue()
+    start = time.time()
+    for item in events:
+        q.put_unique(item=item, lane='listener')
+    per_event = time.time() - start
+
+    q = queue_helper.WorkQueue()
+    batches = []
+    debouncer = queue_helper.Debouncer(
+        callback=lambda batch: batches.append(q.put_many(items=batch, lane='listener')), settle=60, max_wait=60)
+    start = time.time()
+    for item in events:
+        debouncer.add(items=[item])
+    debouncer.flush()
+    batched = time.time() - start
+
+    # the burst reaches the queue as one batch, with each item once
+    assert batches == [2000], 'seconds to queue {} events: {}'.format(
+        len(events), dict(per_event=per_event, batched=batched))
+    assert q.qsize() == 2000
+
+
+def sweep_with_round_trips(item_count, batch_size):
+    # type: (int, Optional[queue_helper.AdaptiveBatchSize]) -> float
+    """Resolve a sweep through a pipeline, where each fetch from the Plex server takes a 10 ms round trip."""
+    source = queue_helper.WorkQueue()
+    source.put_many(items=range(item_count), lane='sweep')
+
+    def fetch(items):
+        time.sleep(0.01)
+        if batch_size:
+            batch_size.record(seconds=0.01)
+        return items
+
+    pipeline = queue_helper.Pipeline(
+        source=source,
+        stages=[('resolve', fetch if batch_size else lambda item: fetch([item])[0], 2), ('done', lambda job: None, 1)],
+        batch_size=batch_size,
+    )
+    start = time.time()
+    pipeline.start()
+    pipeline.join()
+    return time.time() - start
+
+
+def test_sweep_batched_fetch():
+    durations = dict(
+        single=sweep_with_round_trips(item_count=500, batch_size=None),
+        batched=sweep_with_round_trips(
+            item_count=500, batch_size=queue_helper.AdaptiveBatchSize(maximum=50, target_latency=1)),
+    )
+
+    assert durations['batched'] * 5 < durations['single'], \
+        'Batched fetches did not save round trips, seconds to resolve 500 items: {}'.format(durations)
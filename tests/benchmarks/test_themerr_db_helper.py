@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+
+# standard imports
+from array import array
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+# lib imports
+import pytest
+
+# local imports
+from Code import themerr_db_helper
+
+pytestmark = pytest.mark.benchmark
+
+
+def synthetic_item(item_id, records=False):
+    # type: (int, bool) -> dict
+    """Create a synthetic ThemerrDB item."""
+    item = dict(id=item_id, imdb_id='tt{:07d}'.format(item_id), title='Item {}'.format(item_id))
+    if records:
+        item.update(
+            youtube_theme_url='https://www.youtube.com/watch?v={:011d}'.format(item_id),
+            poster_path='/poster_{}.jpg'.format(item_id),
+            backdrop_path='/backdrop_{}.jpg'.format(item_id),
+            overview='Overview of item {}'.format(item_id),
+        )
+    return item
+
+
+def synthetic_page(start, items_per_page, records=False):
+    # type: (int, int, bool) -> bytes
+    """Create a synthetic ThemerrDB page."""
+    page_data = [synthetic_item(item_id=start + i, records=records) for i in range(items_per_page)]
+    return json.dumps(page_data).encode('utf-8')
+
+
+def synthetic_themerr_db(page_count, items_per_page, records=False):
+    # type: (int, int, bool) -> dict
+    """Create synthetic ThemerrDB routes for all database types."""
+    routes = {}
+    for database_type in themerr_db_helper.db_field_name:
+        routes['/{}/pages.json'.format(database_type)] = json.dumps(dict(pages=page_count)).encode('utf-8')
+        for page in range(page_count):
+            routes['/{}/all_page_{}.json'.format(database_type, page + 1)] = synthetic_page(
+                start=page * items_per_page, items_per_page=items_per_page, records=records)
+    return routes
+
+
+def etag_route(body, sent):
+    # type: (bytes, list) -> callable
+    """Serve a body with an ETag, answering conditional requests with 304."""
+    etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+
+    def route(handler):
+        if handler.headers.get('If-None-Match') == etag:
+            return 304, {'ETag': etag}, b''
+        sent.append(len(body))
+        return 200, {'ETag': etag}, body
+
+    return route
+
+
+def test_update_cache_fetch_threads(empty_themerr_db_cache, http_stand_in, monkeypatch, tmpdir):
+    monkeypatch.setattr(themerr_db_helper, 'database_cache_file', os.path.join(str(tmpdir), 'index.json.zlib'))
+    routes = synthetic_themerr_db(page_count=5, items_per_page=100)
+
+    durations = {}
+    caches = {}
+    for fetch_threads in (1, 8):
+        # start each run with an empty index, so every page is downloaded and indexed
+        monkeypatch.setattr(themerr_db_helper, 'base_url', http_stand_in(routes=routes, delay=0.05))
+        themerr_db_helper.database_cache = {}
+        themerr_db_helper.page_cache = {}
+        themerr_db_helper.type_refresh_state = {}
+
+        start = time.time()
+        themerr_db_helper.update_cache(fetch_threads=fetch_threads)
+        durations[fetch_threads] = time.time() - start
+        caches[fetch_threads] = themerr_db_helper.database_cache
+
+    assert caches[1] == caches[8], 'Parallel fetch produced a different index'
+    assert len(caches[8]['movies']['themoviedb']) == 500
+    assert durations[8] < durations[1], \
+        'Parallel fetch was not faster than serial fetch, seconds by fetch threads: {}'.format(durations)
+
+
+def test_update_cache_incremental(empty_themerr_db_cache, http_stand_in, monkeypatch, tmpdir):
+    monkeypatch.setattr(themerr_db_helper, 'database_cache_file', os.path.join(str(tmpdir), 'index.json.zlib'))
+    page_count = 5
+    items_per_page = 100
+    sent = []
+
+    # serve pages with ETag validators
+    routes = {
+        path: body if path.endswith('pages.json') else etag_route(body=body, sent=sent)
+        for path, body in synthetic_themerr_db(page_count=page_count, items_per_page=items_per_page).items()
+    }
+    monkeypatch.setattr(themerr_db_helper, 'base_url', http_stand_in(routes=routes))
+
+    themerr_db_helper.update_cache()
+    full_refresh_bytes = sum(sent)
+    assert len(sent) == page_count * len(themerr_db_helper.db_field_name)
+
+    # change one page and add a new page
+    del sent[:]
+    routes['/movies/all_page_1.json'] = etag_route(
+        body=synthetic_page(start=10000, items_per_page=items_per_page), sent=sent)
+    routes['/movies/pages.json'] = json.dumps(dict(pages=page_count + 1)).encode('utf-8')
+    routes['/movies/all_page_{}.json'.format(page_count + 1)] = etag_route(
+        body=synthetic_page(start=20000, items_per_page=items_per_page), sent=sent)
+
+    themerr_db_helper.request_refresh()
+    themerr_db_helper.update_cache()
+    incremental_refresh_bytes = sum(sent)
+
+    assert len(sent) == 2, 'Only the changed and new pages should be downloaded'
+    assert incremental_refresh_bytes < full_refresh_bytes / 10, \
+        'full refresh: {} bytes, incremental refresh: {} bytes'.format(full_refresh_bytes, incremental_refresh_bytes)
+    assert themerr_db_helper.item_exists(database_type='movies', database='themoviedb', id=10000)
+    assert themerr_db_helper.item_exists(database_type='movies', database='themoviedb', id=20000)
+    assert not themerr_db_helper.item_exists(database_type='movies', database='themoviedb', id=0)
+    assert themerr_db_helper.item_exists(database_type='tv_shows', database='themoviedb', id=0)
+
+
+def test_update_cache_readers_not_blocked(empty_themerr_db_cache, http_stand_in, monkeypatch, tmpdir):
+    monkeypatch.setattr(themerr_db_helper, 'database_cache_file', os.path.join(str(tmpdir), 'index.json.zlib'))
+    routes = synthetic_themerr_db(page_count=2, items_per_page=10)
+
+    # cold start, only the requested database type is loaded
+    monkeypatch.setattr(themerr_db_helper, 'base_url', http_stand_in(routes=routes))
+    assert themerr_db_helper.item_exists(database_type='movies', database='themoviedb', id=1)
+    assert list(themerr_db_helper.database_cache.keys()) == ['movies']
+
+    # a slow refresh must not block readers of the previous snapshot
+    monkeypatch.setattr(themerr_db_helper, 'base_url', http_stand_in(routes=routes, delay=0.5))
+    themerr_db_helper.request_refresh()
+    refresh_thread = threading.Thread(target=themerr_db_helper.update_cache)
+    refresh_thread.start()
+
+    start = time.time()
+    assert themerr_db_helper.item_exists(database_type='movies', database='themoviedb', id=1)
+    read_duration = time.time() - start
+
+    refresh_thread.join()
+
+    assert read_duration < 0.5, 'Reader was blocked by the refresh for {:.3f} seconds'.format(read_duration)
+    assert len(themerr_db_helper.database_cache) == len(themerr_db_helper.db_field_name)
+
+
+def test_update_cache_records(empty_themerr_db_cache, http_stand_in, monkeypatch, tmpdir):
+    monkeypatch.setattr(themerr_db_helper, 'database_cache_file', os.path.join(str(tmpdir), 'index.json.zlib'))
+    routes = synthetic_themerr_db(page_count=2, items_per_page=10, records=True)
+    monkeypatch.setattr(themerr_db_helper, 'base_url', http_stand_in(routes=routes))
+
+    themerr_db_helper.update_cache()
+
+    expected = synthetic_item(item_id=15, records=True)
+    for database, item_id in (('themoviedb', 15), ('imdb', 'tt0000015')):
+        record = themerr_db_helper.get_record(database_type='movies', database=database, id=item_id)
+        assert record == {field: expected[field] for field in themerr_db_helper.record_fields}
+
+    assert themerr_db_helper.get_record(database_type='movies', database='themoviedb', id=100) is None
+
+    # the records are restored from disk with the index
+    themerr_db_helper.record_cache = {}
+    assert themerr_db_helper.load_cache()
+    assert themerr_db_helper.get_record(database_type='games', database='igdb', id=15)['poster_path'] == \
+        expected['poster_path']
+
+
+def test_update_cache_failure_keeps_snapshot(empty_themerr_db_cache, http_stand_in, monkeypatch, tmpdir):
+    monkeypatch.setattr(themerr_db_helper, 'database_cache_file', os.path.join(str(tmpdir), 'index.json.zlib'))
+    routes = synthetic_themerr_db(page_count=2, items_per_page=10)
+    monkeypatch.setattr(themerr_db_helper, 'base_url', http_stand_in(routes=routes))
+
+    themerr_db_helper.update_cache()
+    snapshot = themerr_db_helper.database_cache['movies']
+
+    # movies fails on the next refresh
+    failed_requests = []
+    pages_json = routes['/movies/pages.json']
+
+    def failing_route(handler):
+        failed_requests.append(handler.path)
+        return 500, {}, b''
+
+    routes['/movies/pages.json'] = failing_route
+
+    themerr_db_helper.request_refresh()
+    stats = themerr_db_helper.update_cache()
+    assert stats['last_refresh_outcome'] == 'partial'
+    assert stats['last_refresh_failed_types'] == ['movies']
+    assert len(failed_requests) == 1
+
+    # the previous snapshot is kept
+    assert themerr_db_helper.database_cache['movies'] is snapshot
+    assert themerr_db_helper.item_exists(database_type='movies', database='themoviedb', id=1)
+
+    state = themerr_db_helper.get_type_refresh_state(database_type='movies')
+    assert state['failures'] == 1
+    assert state['retry_at'] > time.time()
+
+    # no requests are made until the backoff has elapsed
+    themerr_db_helper.update_cache()
+    assert len(failed_requests) == 1
+
+    # once the backoff has elapsed, only the failed database type is retried
+    routes['/movies/pages.json'] = pages_json
+    state['retry_at'] = 0
+    games_updated = themerr_db_helper.get_type_refresh_state(database_type='games')['updated']
+    stats = themerr_db_helper.update_cache()
+    assert stats['last_refresh_outcome'] == 'success'
+    assert themerr_db_helper.get_type_refresh_state(database_type='games')['updated'] == games_updated
+    assert state['failures'] == 0
+    assert state['updated'] > games_updated
+
+
+def test_update_cache_refresh_policy(empty_themerr_db_cache, http_stand_in, monkeypatch, tmpdir):
+    monkeypatch.setattr(themerr_db_helper, 'database_cache_file', os.path.join(str(tmpdir), 'index.json.zlib'))
+    routes = synthetic_themerr_db(page_count=2, items_per_page=10)
+    requested = []
+
+    def counting_route(path):
+        body = routes[path]
+
+        def route(handler):
+            requested.append(handler.path.split('/')[1])
+            return 200, {}, body
+
+        return route
+
+    monkeypatch.setattr(themerr_db_helper, 'base_url', http_stand_in(
+        routes={path: counting_route(path=path) for path in routes}))
+
+    # database types that no library uses are never refreshed
+    themerr_db_helper.update_cache(active_types={'movies', 'movie_collections'})
+    assert set(requested) == {'movies', 'movie_collections'}
+    assert set(themerr_db_helper.database_cache) == {'movies', 'movie_collections'}
+
+    # database types that are not due are skipped
+    del requested[:]
+    themerr_db_helper.update_cache()
+    assert requested == []
+
+    # each database type is due according to its own interval
+    state = themerr_db_helper.get_type_refresh_state(database_type='movies')
+    policy = themerr_db_helper.type_refresh_policy['movies']
+    assert state['updated'] + policy['interval'] <= state['due_at'] <= \
+        state['updated'] + policy['interval'] + policy['jitter']
+
+    state['due_at'] = 0
+    themerr_db_helper.update_cache()
+    assert set(requested) == {'movies'}
+
+    # an on-demand refresh does not wait for the interval
+    del requested[:]
+    themerr_db_helper.request_refresh(database_types=['movie_collections'])
+    themerr_db_helper.update_cache()
+    assert set(requested) == {'movie_collections'}
+
+
+def test_id_index_memory_and_lookup():
+    id_count = 200000
+    lookup_count = 100000
+    ids = random.sample(range(1, 10 * id_count), id_count)
+    lookups = [random.randint(1, 10 * id_count) for _ in range(lookup_count)]
+
+    # the previous layout, a set of strings
+    string_set = set(str(i) for i in ids)
+    string_set_bytes = sys.getsizeof(string_set) + sum(sys.getsizeof(i) for i in string_set)
+
+    start = time.time()
+    string_set_found = sum(1 for i in lookups if str(i) in string_set)
+    string_set_duration = time.time() - start
+
+    # the current layout, a sorted array of integers
+    id_array = themerr_db_helper.build_id_array(ids=ids)
+    id_array_bytes = sys.getsizeof(id_array)
+
+    start = time.time()
+    id_array_found = sum(1 for i in lookups if themerr_db_helper.id_array_contains(
+        ids=id_array, value=themerr_db_helper.encode_id(database='themoviedb', id=i)))
+    id_array_duration = time.time() - start
+
+    assert string_set_found == id_array_found, 'Lookups returned different results'
+    assert id_array_bytes * 4 < string_set_bytes, \
+        'Integer array is not significantly smaller, set of strings: {} bytes, {:.2f} us per lookup, ' \
+        'array of integers: {} bytes, {:.2f} us per lookup'.format(
+            string_set_bytes, string_set_duration / lookup_count * 1000000,
+            id_array_bytes, id_array_duration / lookup_count * 1000000)
+
+
+def test_get_item_data_revalidation(empty_themerr_db_cache, http_stand_in, monkeypatch, tmpdir):
+    monkeypatch.setattr(themerr_db_helper, 'item_cache_directory', str(tmpdir))
+    monkeypatch.setattr(themerr_db_helper, 'item_cache_stats', {
+        stat: 0 for stat in themerr_db_helper.item_cache_stats})
+    sent = []
+
+    body = json.dumps(synthetic_item(item_id=1, records=True)).encode('utf-8')
+    routes = {'/movies/themoviedb/1.json': etag_route(body=body, sent=sent)}
+    monkeypatch.setattr(themerr_db_helper, 'base_url', http_stand_in(routes=routes))
+
+    def get_item_data():
+        return themerr_db_helper.get_item_data(database_type='movies', database='themoviedb', id=1)
+
+    # the first lookup downloads the item, the second is served from the item cache
+    assert get_item_data()['id'] == 1
+    assert get_item_data()['id'] == 1
+    assert len(sent) == 1
+
+    # once the cached copy is too old, it is revalidated without downloading the body again
+    monkeypatch.setattr(themerr_db_helper, 'item_cache_max_age', 0)
+    assert get_item_data()['id'] == 1
+    assert len(sent) == 1
+
+    # while ThemerrDB is failing, the cached copy is served
+    routes['/movies/themoviedb/1.json'] = lambda handler: (500, {}, b'')
+    assert get_item_data()['id'] == 1
+
+    stats = themerr_db_helper.item_cache_stats
+    assert stats['misses'] == 1
+    assert stats['hits'] == 1
+    assert stats['revalidated'] == 1
+    assert stats['stale'] == 1
+    assert stats['errors'] == 0
+
+
+def test_get_page_memory(http_stand_in, monkeypatch, peak_memory):
+    peaks = {}
+    for items_per_page in (10000, 100000):
+        body = synthetic_page(start=0, items_per_page=items_per_page)
+        monkeypatch.setattr(themerr_db_helper, 'base_url', http_stand_in(routes={'/movies/all_page_1.json': body}))
+
+        streaming = peak_memory(lambda: themerr_db_helper.get_page(database_type='movies', page=1))
+        full = peak_memory(lambda: json.loads(body.decode('utf-8')))
+
+        entry, _ = themerr_db_helper.get_page(database_type='movies', page=1)
+        assert len(entry['ids']['themoviedb']) == len(entry['ids']['imdb']) == items_per_page
+
+        peaks[items_per_page] = dict(page_bytes=len(body), ids=items_per_page * len(entry['ids']),
+                                     streaming=streaming, full=full)
+
+    small, large = peaks[10000], peaks[100000]
+
+    # only the ID arrays and their sorted copies grow with the page, the rest of the peak memory stays flat
+    id_arrays_growth = 2 * array('l').itemsize * (large['ids'] - small['ids'])
+    assert large['streaming'] - small['streaming'] < 1.5 * id_arrays_growth, \
+        'Peak memory grew with the page: {}'.format(peaks)
+    assert id_arrays_growth < large['page_bytes'] - small['page_bytes'], 'The ID arrays are larger than the page'
+    assert large['streaming'] < large['full'] / 4, 'Streaming parse used too much memory: {}'.format(peaks)
@@ -23,6 +23,8 @@ if os.path.isdir(contents_dir):
     # local imports
     from Code import constants
     from Code import Themerr, ThemerrMovies, ThemerrTvShows
+    from Code import plex_api_helper
+    from Code import queue_helper
     from Code import themerr_db_helper
     from Code import webapp
 else:
@@ -37,6 +39,10 @@ MOVIE_SECTIONS = ["Movies", "Movies-imdb", "Movies-tmdb"]
 TV_SHOW_SECTIONS = ["TV Shows", "TV Shows-tmdb", "TV Shows-tvdb"]
 
 
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'benchmark: slow performance tests, run with `-m benchmark`')
+
+
 def wait_for_file(file_path, timeout=300):
     # type: (str, int) -> None
     found = False
@@ -197,5 +203,17 @@ def section(section_names, plex):
 @pytest.fixture(scope='function')
 def empty_themerr_db_cache():
     themerr_db_helper.database_cache = {}  # reset the cache
+    themerr_db_helper.page_cache = {}
+    themerr_db_helper.record_cache = {}
+    themerr_db_helper.type_refresh_state = {}
+    themerr_db_helper.active_database_types = None
     themerr_db_helper.last_cache_update = 0
     return
+
+
+@pytest.fixture(scope='function')
+def work_queue(monkeypatch):
+    """Replace the work queue with a fresh queue without a journal, so tests do not write the work journal."""
+    fresh_queue = queue_helper.WorkQueue()
+    monkeypatch.setattr(plex_api_helper, 'q', fresh_queue)
+    return fresh_queue
@@ -7,6 +7,7 @@ import os
 import pytest
 
 # local imports
+from Code import themerr_db_helper
 from Code import webapp
 
 
@@ -76,3 +77,49 @@ def test_status(test_client):
     response = test_client.get('/status')
     assert response.status_code == 200
     assert response.content_type == 'application/json'
+
+
+def test_diagnostics(test_client):
+    """
+    WHEN the '/diagnostics' page is requested (GET)
+    THEN check that the response is valid
+    """
+    response = test_client.get('/diagnostics')
+    assert response.status_code == 200
+
+    assert 'id="snapshots"' in response.data.decode('utf-8')
+    assert 'id="item_cache"' in response.data.decode('utf-8')
+    assert 'id="work_queue"' in response.data.decode('utf-8')
+    assert 'id="failed_items"' in response.data.decode('utf-8')
+    assert 'id="scheduled_update"' in response.data.decode('utf-8')
+
+
+def test_diagnostics_refresh(test_client, monkeypatch):
+    """
+    WHEN a database type refresh is requested from the '/diagnostics/refresh' page (POST)
+    THEN check that the response redirects to the diagnostics page
+
+    Repeat for an invalid database type, and a database type that is not used by any library
+    """
+    monkeypatch.setattr(themerr_db_helper, 'active_database_types', frozenset(['movies']))
+
+    response = test_client.post('/diagnostics/refresh', data=dict(database_type='movies'))
+    assert response.status_code == 302
+    assert response.location.endswith('/diagnostics')
+
+    response = test_client.post('/diagnostics/refresh', data=dict(database_type='invalid'))
+    assert response.status_code == 400
+
+    response = test_client.post('/diagnostics/refresh', data=dict(database_type='games'))
+    assert response.status_code == 409
+    assert 'not used by any Plex library' in response.data.decode('utf-8')
+
+
+def test_update_item(test_client):
+    """
+    WHEN an item update is requested from the '/update/<rating_key>' page (POST)
+    THEN check that the response redirects to the home page
+    """
+    response = test_client.post('/update/1')
+    assert response.status_code == 302
+    assert response.location.endswith('/')
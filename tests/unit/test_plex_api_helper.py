@@ -1,12 +1,35 @@
 # -*- coding: utf-8 -*-
 
+# standard imports
+from datetime import datetime
+import os
+import time
+from xml.etree import ElementTree
+
 # lib imports
 import pytest
 
 # local imports
+from Code import general_helper
 from Code import plex_api_helper
 
 
+class SweepItem(object):
+    """A stand-in for an item of a section listing."""
+    type = 'movie'
+
+    def __init__(self, rating_key, theme=None, locked=False, changed_at=0):
+        self.ratingKey = rating_key
+        self.title = 'Item {}'.format(rating_key)
+        self.theme = theme
+        self.locked = locked
+        self.updatedAt = datetime.fromtimestamp(changed_at) if changed_at else None
+        self.addedAt = datetime.fromtimestamp(changed_at) if changed_at else None
+
+    def isLocked(self, field):
+        return self.locked
+
+
 def test_all_themes_unlocked(section):
     field = 'theme'
     for item in section.all():
@@ -24,3 +47,278 @@ def test_change_lock_status(section, lock):
         change_status = plex_api_helper.change_lock_status(item, field=field, lock=lock)
         assert change_status, 'change_lock_status did not return True'
         assert item.isLocked(field=field) == lock, 'Failed to change lock status to {}'.format(lock)
+
+
+def test_unlock_media_field_retry(monkeypatch, work_queue):
+    class LockedItem(SweepItem):
+        """An item that cannot be unlocked while Plex is timing out."""
+        timing_out = True
+
+        def edit(self, **kwargs):
+            if self.timing_out:
+                raise plex_api_helper.requests.ReadTimeout('timed out')
+            self.locked = bool(kwargs['theme.locked'])
+
+        def reload(self, **kwargs):
+            pass
+
+    lock_retries = plex_api_helper.queue_helper.RetryScheduler(
+        callback=plex_api_helper.queue_retry, max_retries=2, base_delay=60)
+    monkeypatch.setattr(plex_api_helper, 'lock_retries', lock_retries)
+
+    item = LockedItem(rating_key=999940, theme='/theme', locked=True)
+    assert not plex_api_helper.unlock_media_field(item=item, media_type='themes')
+    assert lock_retries.pending(item=(999940, 'themes'))
+    assert not lock_retries.pending(item=(999940, 'posters'))
+
+    # the retry only queues the item again, the unlock is done by the workers
+    lock_retries.callback((999940, 'themes'))
+    assert 999940 in work_queue
+    assert work_queue.lane_sizes()['retry'] == 1
+
+    item.timing_out = False
+    assert plex_api_helper.unlock_media_field(item=item, media_type='themes')
+    assert not item.locked
+    assert not lock_retries.pending(item=(999940, 'themes'))
+
+
+def test_plex_listener_handler_self_write(work_queue):
+    def timeline(rating_key):
+        return dict(
+            type='timeline',
+            TimelineEntry=[dict(type=1, state=5, identifier='com.plexapp.plugins.library', itemID=str(rating_key))],
+        )
+
+    rating_key = 999999
+    plex_api_helper.record_self_write(rating_key=rating_key)
+    assert plex_api_helper.is_self_write(rating_key=rating_key)
+
+    # the echo of a change made by Themerr is dropped
+    self_writes = plex_api_helper.listener_stats['self_writes']
+    plex_api_helper.plex_listener_handler(data=timeline(rating_key=rating_key))
+    plex_api_helper.listener_debouncer.flush()
+    assert plex_api_helper.listener_stats['self_writes'] == self_writes + 1
+    assert rating_key not in work_queue
+
+    # once the entry expires, changes to the item are queued again
+    plex_api_helper.self_writes[rating_key] = 0
+    assert not plex_api_helper.is_self_write(rating_key=rating_key)
+    plex_api_helper.plex_listener_handler(data=timeline(rating_key=rating_key))
+    plex_api_helper.listener_debouncer.flush()
+    assert rating_key in work_queue
+
+
+def test_plex_listener_handler_batch(work_queue):
+    rating_keys = [999990, 999991, 999992]
+    data = dict(
+        type='timeline',
+        TimelineEntry=[
+            dict(type=1, state=5, identifier='com.plexapp.plugins.library', itemID=str(rating_key))
+            for rating_key in rating_keys * 3  # a scan reports the same items several times
+        ] + [
+            dict(type=1, state=0, identifier='com.plexapp.plugins.library', itemID='999993'),  # not a metadata update
+            dict(type=3, state=5, identifier='com.plexapp.plugins.library', itemID='999994'),  # a season
+        ],
+    )
+
+    plex_api_helper.plex_listener_handler(data=data)
+    assert list(plex_api_helper.listener_debouncer.pending) == rating_keys
+
+    batches = plex_api_helper.listener_stats['batches']
+    plex_api_helper.listener_debouncer.flush()
+    assert plex_api_helper.listener_stats['batches'] == batches + 1
+    assert work_queue.qsize() == len(rating_keys)
+    for rating_key in rating_keys:
+        assert rating_key in work_queue
+    assert 999993 not in work_queue
+    assert 999994 not in work_queue
+
+
+def test_plan_item():
+    settings_hash = general_helper.get_themerr_settings_hash()
+    last_sweep = time.time() - 3600
+
+    def plan(item, changed_since=last_sweep):
+        return plex_api_helper.plan_item(item=item, settings_hash=settings_hash, changed_since=changed_since)
+
+    # without a previous sweep, every item is checked
+    assert plan(SweepItem(rating_key=999980, theme='/theme'), changed_since=None) == 'full'
+
+    assert plan(SweepItem(rating_key=999981)) == 'no_theme'
+    assert plan(SweepItem(rating_key=999981, locked=True)) is None, 'Locked theme was queued'
+
+    # a theme that was not added by Themerr, Plex provided themes are not overwritten by default
+    assert plan(SweepItem(rating_key=999982, theme='/theme')) is None
+    assert plan(SweepItem(rating_key=999982, theme='/theme', changed_at=time.time())) == 'changed'
+
+    item = SweepItem(rating_key=999983, theme='/theme')
+    themerr_json_path = general_helper.get_themerr_json_path(item=item)
+    try:
+        general_helper.update_themerr_data_file(item=item, new_themerr_data=dict(settings_hash='previous'))
+        assert plan(item) == 'settings_changed'
+
+        general_helper.update_themerr_data_file(item=item, new_themerr_data=dict(settings_hash=settings_hash))
+        assert plan(item) is None
+
+        # the change made by the upload of Themerr is not a reason to queue the item again
+        item.updatedAt = datetime.fromtimestamp(time.time())
+        assert plan(item) is None
+    finally:
+        os.remove(themerr_json_path)
+
+
+class SweepSection(object):
+    """A stand-in for a movie section, honoring the paging and sort of the section listing."""
+    key = 999
+    agent = 'tv.plex.agents.movie'
+    type = 'movie'
+
+    def __init__(self, items):
+        self.items = items
+        self.requests = 0
+        self.updatedAt = None
+        self._data = ElementTree.Element('Directory', contentChangedAt='1')
+
+    def search(self, libtype=None, container_start=0, container_size=None, maxresults=None, sort=None):
+        self.requests += 1
+        items = self.items if libtype in (None, 'movie') else []
+        if sort == 'updatedAt:desc':
+            items = sorted(items, key=plex_api_helper.get_item_changed_at, reverse=True)
+        return items[container_start:container_start + maxresults]
+
+
+def test_plan_sweep_watermarks(monkeypatch):
+    monkeypatch.setattr(plex_api_helper, 'plex_token', 'stand-in')
+    monkeypatch.setattr(plex_api_helper, 'section_page_size', 2)
+
+    now = int(time.time())
+    section = SweepSection(items=[
+        SweepItem(rating_key=999970 + i, theme='/theme', changed_at=now - 86400 + i) for i in range(10)])
+
+    # a full update checks every item, and records the latest change of each listing
+    plan = plex_api_helper.plan_sweep(sections=[section])
+    assert plan['mode'] == 'full'
+    assert plan['counts']['full'] == 10
+    assert plan['watermarks'] == {'999:movie': now - 86400 + 9, '999:collection': 0}
+
+    # nothing changed, the walk stops at the first page
+    section.requests = 0
+    plan = plex_api_helper.plan_sweep(sections=[section], watermarks=plan['watermarks'])
+    assert plan['mode'] == 'changes'
+    assert plan['candidates'] == []
+    assert section.requests == 2  # a page of the movies, and the empty collections
+    watermarks = plan['watermarks']
+
+    # only the changed items are checked
+    section.items[3].updatedAt = datetime.fromtimestamp(now)
+    section.items[5].updatedAt = datetime.fromtimestamp(now)
+    plan = plex_api_helper.plan_sweep(sections=[section], watermarks=watermarks)
+    assert sorted(plan['candidates']) == [(999973, 'changed'), (999975, 'changed')]
+    assert plan['watermarks']['999:movie'] == now
+
+    # a listing without a watermark is walked in full
+    plan = plex_api_helper.plan_sweep(sections=[section], watermarks={})
+    assert plan['counts']['full'] == 10
+
+
+def test_plan_sweep_resume(monkeypatch):
+    monkeypatch.setattr(plex_api_helper, 'plex_token', 'stand-in')
+    monkeypatch.setattr(plex_api_helper, 'section_page_size', 2)
+
+    now = int(time.time())
+    section = SweepSection(items=[
+        SweepItem(rating_key=999950 + i, theme='/theme', changed_at=now - 86400 + i) for i in range(10)])
+
+    class Interrupted(Exception):
+        pass
+
+    queued = []
+
+    def interrupt(rating_key, reason):
+        if len(queued) == 5:
+            raise Interrupted()
+        queued.append(rating_key)
+
+    # the update is interrupted in the third page, after the second page was recorded
+    progress = dict(offsets={}, watermarks={}, done=[])
+    with pytest.raises(Interrupted):
+        plex_api_helper.plan_sweep(sections=[section], on_candidate=interrupt, progress=progress)
+    assert progress['offsets'] == {'999:movie': 4}
+    assert progress['watermarks'] == {'999:movie': now - 86400 + 3}
+    assert progress['done'] == []
+
+    # the walk continues from the previous page, not from the start of the section
+    section.requests = 0
+    plan = plex_api_helper.plan_sweep(sections=[section], progress=progress)
+    assert [rating_key for rating_key, reason in plan['candidates']] == [999950 + i for i in range(2, 10)]
+    assert section.requests == 6  # the four remaining pages and an empty page of the movies, and the collections
+    assert plan['watermarks'] == {'999:movie': now - 86400 + 9, '999:collection': 0}
+    assert progress['offsets'] == {}
+    assert sorted(progress['done']) == ['999:collection', '999:movie']
+
+    # the listings already done are not walked again
+    section.requests = 0
+    plan = plex_api_helper.plan_sweep(sections=[section], progress=progress)
+    assert plan['candidates'] == []
+    assert section.requests == 0
+    assert plan['watermarks'] == {'999:movie': now - 86400 + 9, '999:collection': 0}
+
+
+def test_plan_sweep_fingerprints(monkeypatch):
+    monkeypatch.setattr(plex_api_helper, 'plex_token', 'stand-in')
+
+    now = int(time.time())
+    section = SweepSection(items=[
+        SweepItem(rating_key=999960 + i, theme='/theme', changed_at=now - 86400 + i) for i in range(5)])
+    section.items[0].theme = None
+
+    plan = plex_api_helper.plan_sweep(sections=[section])
+    assert plan['sections_skipped'] == 0
+
+    # the section is not walked while nothing changed
+    section.requests = 0
+    plan = plex_api_helper.plan_sweep(sections=[section], watermarks=plan['watermarks'],
+                                      fingerprints=plan['fingerprints'])
+    assert plan['sections_skipped'] == 1
+    assert section.requests == 0
+    assert plan['watermarks']['999:movie'] == now - 86400 + 4
+
+    # a change in the section is walked up to the watermark
+    section._data.set('contentChangedAt', '2')
+    plan = plex_api_helper.plan_sweep(sections=[section], watermarks=plan['watermarks'],
+                                      fingerprints=plan['fingerprints'])
+    assert plan['sections_skipped'] == 0
+    assert plan['candidates'] == []
+
+    # a new index checks the items without a theme again
+    monkeypatch.setattr(plex_api_helper.themerr_db_helper, 'get_index_version', lambda database_types: 'new')
+    plan = plex_api_helper.plan_sweep(sections=[section], watermarks=plan['watermarks'],
+                                      fingerprints=plan['fingerprints'])
+    assert plan['sections_skipped'] == 0
+    assert plan['candidates'] == [(999960, 'no_theme')]
+
+
+def test_update_themerr_db_cache(monkeypatch):
+    refreshes = []
+    monkeypatch.setattr(plex_api_helper.themerr_db_helper, 'update_cache', lambda **kwargs: refreshes.append(kwargs))
+
+    # the database types are not known while the Plex server cannot be reached, so nothing is refreshed
+    def unreachable():
+        raise plex_api_helper.requests.ConnectionError('Plex server is not running')
+
+    monkeypatch.setattr(plex_api_helper, 'setup_plexapi', unreachable)
+    plex_api_helper.update_themerr_db_cache()
+    assert refreshes == []
+
+    # only the database types used by the libraries are refreshed
+    class Library(object):
+        def sections(self):
+            return ['movies']
+
+    class PlexServer(object):
+        library = Library()
+
+    monkeypatch.setattr(plex_api_helper, 'setup_plexapi', PlexServer)
+    monkeypatch.setattr(plex_api_helper, 'get_section_database_types', lambda section: {section})
+    plex_api_helper.update_themerr_db_cache()
+    assert refreshes == [dict(active_types={'movies'})]
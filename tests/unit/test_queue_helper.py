@@ -0,0 +1,476 @@
+# -*- coding: utf-8 -*-
+
+# standard imports
+import threading
+import time
+
+# lib imports
+import pytest
+
+# local imports
+from Code import queue_helper
+
+
+def test_work_queue_put_unique():
+    q = queue_helper.WorkQueue()
+
+    assert q.put_unique(item=1)
+    assert q.put_unique(item=2)
+    assert not q.put_unique(item=1), 'Queued item was added again'
+    assert q.qsize() == 2
+    assert 1 in q
+
+    assert q.get() == 1
+    assert 1 not in q
+    q.finish(item=1)
+    assert q.put_unique(item=1), 'Finished item could not be added again'
+
+    assert [q.get(), q.get()] == [2, 1]
+    assert q.empty()
+    assert not q.queued
+
+
+def test_work_queue_put_unique_threads():
+    q = queue_helper.WorkQueue()
+    added = []
+
+    def put_all():
+        added.append(sum(q.put_unique(item=item) for item in range(1000)))
+
+    threads = [threading.Thread(target=put_all) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sum(added) == 1000, 'Concurrent producers queued duplicate items'
+    assert q.qsize() == 1000
+
+
+def test_work_queue_lanes():
+    q = queue_helper.WorkQueue()
+
+    for item in range(3):
+        q.put_unique(item=item, lane='sweep')
+    q.put_unique(item='manual', lane='manual')
+    q.put_unique(item='listener', lane='listener')
+    q.put_unique(item='agent', lane='agent')
+
+    assert q.lane_sizes() == dict(agent=1, listener=1, manual=1, retry=0, sweep=3)
+    assert [q.get() for _ in range(6)] == ['agent', 'listener', 'manual', 0, 1, 2]
+
+
+def test_work_queue_lane_promotion():
+    q = queue_helper.WorkQueue()
+
+    for item in range(3):
+        q.put_unique(item=item, lane='sweep')
+
+    # an item queued by the sweep is moved ahead when the listener reports it
+    assert q.put_unique(item=2, lane='listener')
+    assert not q.put_unique(item=2, lane='sweep'), 'Item was moved to a lower priority lane'
+    assert q.qsize() == 3
+    assert q.lane_sizes() == dict(agent=0, listener=1, manual=0, retry=0, sweep=2)
+
+    assert [q.get() for _ in range(3)] == [2, 0, 1]
+    assert q.empty()
+    for item in range(3):
+        q.finish(item=item)
+
+    # the skipped entry must not come back when the item is queued again
+    assert q.put_unique(item=2, lane='sweep')
+    assert q.get() == 2
+    assert q.empty()
+
+
+def test_work_queue_lanes_do_not_starve():
+    q = queue_helper.WorkQueue()
+
+    for item in range(100):
+        q.put_unique(item=('sweep', item), lane='sweep')
+        q.put_unique(item=('agent', item), lane='agent')
+
+    lanes = [q.get()[0] for _ in range(90)]
+
+    # when both lanes are busy, each lane gets its share, in proportion to the lane weights
+    assert lanes.count('sweep') == 10
+    assert 'sweep' in lanes[:9], 'Lower priority lane was starved'
+
+
+def test_work_queue_in_flight():
+    q = queue_helper.WorkQueue()
+
+    q.put_unique(item=1, lane='sweep')
+    assert q.get() == 1
+    assert q.stats() == dict(queued=0, in_flight=1, coalesced=0, resumed=0)
+
+    # an item in flight is not queued again, it is marked to run once more
+    assert not q.put_unique(item=1, lane='sweep')
+    assert not q.put_unique(item=1, lane='listener')
+    assert not q.put_unique(item=1, lane='sweep')
+    assert q.empty(), 'Item in flight was queued again'
+    assert q.stats() == dict(queued=0, in_flight=1, coalesced=3, resumed=0)
+
+    # it is queued once when finished, in the highest priority lane it was added to
+    assert q.finish(item=1)
+    assert q.lane_sizes() == dict(agent=0, listener=1, manual=0, retry=0, sweep=0)
+    assert q.get() == 1
+
+    # an item that was not added while in flight is not queued again
+    assert not q.finish(item=1)
+    assert q.empty()
+    assert q.stats() == dict(queued=0, in_flight=0, coalesced=3, resumed=0)
+
+
+def test_work_queue_put_many():
+    q = queue_helper.WorkQueue()
+    q.put_unique(item=1, lane='sweep')
+
+    # repeats are skipped, and an item queued in a lower priority lane is moved ahead
+    assert q.put_many(items=[1, 2, 2, 3], lane='listener') == 3
+    assert q.lane_sizes() == dict(agent=0, listener=3, manual=0, retry=0, sweep=0)
+    assert [q.get() for _ in range(3)] == [1, 2, 3]
+
+
+def test_work_queue_reserved():
+    q = queue_helper.WorkQueue(maxsize=3, reserved=1)
+    q.put_many(items=[1, 2], lane='sweep')
+
+    # the lowest priority lane waits while only the reserved places are free
+    producer = threading.Thread(target=q.put_unique, kwargs=dict(item=3, lane='sweep'))
+    producer.daemon = True
+    producer.start()
+    producer.join(0.2)
+    assert producer.is_alive(), 'Lowest priority lane used a reserved place'
+
+    # the other lanes still get in
+    assert q.put_unique(item='listener', lane='listener')
+    assert q.qsize() == 3
+
+    # taking items frees places for the waiting producer
+    assert q.get() == 'listener'
+    q.get()
+    producer.join(5)
+    assert not producer.is_alive()
+    assert 3 in q
+
+
+def test_work_queue_reserved_in_flight():
+    q = queue_helper.WorkQueue(maxsize=2, reserved=1)
+    q.put_unique(item=1, lane='sweep')
+
+    # the producer waits for a place for the item
+    producer = threading.Thread(target=q.put_unique, kwargs=dict(item='x', lane='sweep'))
+    producer.daemon = True
+    producer.start()
+    producer.join(0.2)
+    assert producer.is_alive()
+
+    # meanwhile, the item is queued by another lane, and taken by a worker
+    assert q.put_unique(item='x', lane='listener')
+    assert q.get() == 'x'
+    assert q.get() == 1
+
+    # the waiting producer must not queue the item that is in flight
+    producer.join(5)
+    assert not producer.is_alive()
+    assert 'x' not in q, 'Item in flight was queued again'
+    assert q.stats()['coalesced'] == 1
+    assert q.finish(item='x'), 'Item was not marked to run once more'
+
+
+def test_work_queue_reserved_invalid():
+    with pytest.raises(ValueError):
+        queue_helper.WorkQueue(maxsize=3, reserved=3)
+
+
+def test_work_journal_resume(tmp_path):
+    path = str(tmp_path / 'work_journal.jsonl')
+
+    q = queue_helper.WorkQueue(journal=queue_helper.WorkJournal(path=path))
+    q.put_many(items=[1, 2, 3, 4], lane='sweep')
+    q.put_unique(item=5, lane='listener')
+    assert q.get() == 5
+    q.finish(item=5)
+    assert q.get() == 1  # taken, but not finished before the restart
+    q.journal.flush()  # the writer thread may not have written the last records yet
+
+    # after a restart, the items that were not finished are queued again, in their lanes and order, even when
+    # there are more of them than the queue holds
+    q = queue_helper.WorkQueue(maxsize=2, journal=queue_helper.WorkJournal(path=path))
+    assert q.resume() == 4
+    assert q.stats()['resumed'] == 4
+    assert q.lane_sizes() == dict(agent=0, listener=0, manual=0, retry=0, sweep=4)
+    assert [q.get() for _ in range(4)] == [1, 2, 3, 4]
+
+
+def test_work_journal_compaction(tmp_path):
+    path = str(tmp_path / 'work_journal.jsonl')
+    journal = queue_helper.WorkJournal(path=path, compact_min=10)
+
+    q = queue_helper.WorkQueue(journal=journal)
+    for item in range(100):
+        q.put_unique(item=item)
+        q.get()
+        q.finish(item=item)
+    q.put_unique(item='pending')
+    journal.flush()
+
+    # the journal does not grow with the finished items
+    assert journal.records < 10
+    with open(path, 'rb') as f:
+        assert len(f.readlines()) == journal.records
+
+    # a line that was not written completely is skipped
+    with open(path, 'ab') as f:
+        f.write(b'["queued", "torn')
+    assert list(queue_helper.WorkJournal(path=path).load()) == ['pending']
+
+
+def test_work_journal_writes_outside_queue_lock(tmp_path):
+    journal = queue_helper.WorkJournal(path=str(tmp_path / 'work_journal.jsonl'))
+    writing = threading.Event()
+    release = threading.Event()
+    open_journal = journal._open
+
+    def slow_open():
+        writing.set()
+        release.wait(30)
+        open_journal()
+
+    journal._open = slow_open
+
+    q = queue_helper.WorkQueue(journal=journal)
+    threading.Thread(target=q.put_unique, kwargs=dict(item=1, lane='sweep')).start()
+    assert writing.wait(5)
+
+    # while the writer thread waits for the disk, the queue is not held up
+    producer = threading.Thread(target=lambda: q.put_unique(item=2, lane='listener') and q.get())
+    producer.start()
+    producer.join(5)
+    release.set()
+    assert not producer.is_alive(), 'The queue waited for the journal to be written'
+
+    journal.flush()
+    assert journal.records == 3
+
+
+def test_retry_scheduler():
+    retried = []
+    handed_over = threading.Event()
+
+    def collect(item):
+        retried.append((item, time.time()))
+        handed_over.set()
+
+    retries = queue_helper.RetryScheduler(callback=collect, max_retries=2, base_delay=0.2)
+
+    start = time.time()
+    assert retries.failed(item=1, error='first')
+    assert retries.stats() == dict(scheduled=1, dead_letters=0)
+    assert not retried, 'Retry was not delayed'
+    assert retries.pending(item=1)
+    assert not retries.pending(item=2)
+
+    # the caller is not held up, the retry is handed over once it is due
+    assert handed_over.wait(5)
+    assert retried[0][0] == 1
+    assert 0.1 <= retried[0][1] - start < 1
+    assert retries.pending(item=1), 'Item handed over for a retry is no longer pending'
+
+    # an item that runs out of retries is moved to the dead letters
+    assert retries.failed(item=1, error='second')
+    assert not retries.failed(item=1, error='third')
+    assert not retries.pending(item=1)
+    assert retries.dead_letters[1]['attempts'] == 3
+    assert retries.dead_letters[1]['error'] == 'third'
+
+    # the dead letters are read from a copy
+    dead_letters = retries.get_dead_letters()
+    assert list(dead_letters) == [1]
+    dead_letters[1]['error'] = 'changed'
+    assert retries.dead_letters[1]['error'] == 'third'
+
+    # a success forgets the attempts and the dead letter
+    retries.succeeded(item=1)
+    assert not retries.attempts
+    assert not retries.dead_letters
+
+
+def test_retry_scheduler_delay():
+    retries = queue_helper.RetryScheduler(callback=None, base_delay=5, max_delay=60)
+    for attempt, backoff in ((1, 5), (2, 10), (3, 20), (10, 60)):
+        for _ in range(20):
+            assert backoff / 2.0 <= retries.delay(attempt=attempt) <= backoff
+
+
+def test_debouncer():
+    batches = []
+    handed_over = threading.Event()
+
+    def collect(batch):
+        batches.append(batch)
+        handed_over.set()
+
+    debouncer = queue_helper.Debouncer(callback=collect, settle=0.2, max_wait=5)
+    debouncer.add(items=[1, 2])
+    debouncer.add(items=[2, 3, 1])
+    assert not batches, 'Batch was handed over before the burst settled'
+
+    assert handed_over.wait(5)
+    assert batches == [[1, 2, 3]]
+    assert not debouncer.pending
+
+
+def test_debouncer_max_wait():
+    batches = []
+    debouncer = queue_helper.Debouncer(callback=batches.append, settle=0.2, max_wait=0.5)
+
+    # a steady stream of items never settles, but is still handed over
+    start = time.time()
+    while not batches and time.time() - start < 5:
+        debouncer.add(items=[time.time()])
+        time.sleep(0.05)
+
+    assert batches, 'Batch was not handed over after the maximum wait'
+    assert time.time() - start < 2
+
+
+def test_debouncer_flush():
+    batches = []
+    debouncer = queue_helper.Debouncer(callback=batches.append, settle=60, max_wait=60)
+    debouncer.add(items=[1, 1, 2])
+    debouncer.flush()
+    debouncer.flush()  # an empty batch is not handed over
+
+    assert batches == [[1, 2]]
+
+
+def test_work_queue_invalid_lane():
+    with pytest.raises(ValueError):
+        queue_helper.WorkQueue().put_unique(item=1, lane='invalid')
+
+
+def test_pipeline():
+    source = queue_helper.WorkQueue()
+    results = []
+    results_lock = threading.Lock()
+
+    def collect(job):
+        with results_lock:
+            results.append(job)
+
+    pipeline = queue_helper.Pipeline(
+        source=source,
+        stages=[
+            ('double', lambda job: job * 2, 2),
+            ('drop_odd_source', lambda job: job if job % 4 == 0 else None, 1),  # a stage can end a job early
+            ('collect', collect, 3),
+        ],
+        queue_size=2,
+    )
+    pipeline.start()
+    assert len(pipeline.threads) == 6
+
+    for item in range(100):
+        source.put_unique(item=item)
+    pipeline.join()
+
+    assert sorted(results) == [item * 2 for item in range(0, 100, 2)]
+
+
+def test_pipeline_stage_error():
+    source = queue_helper.WorkQueue()
+    results = []
+
+    def fail_on_three(job):
+        if job == 3:
+            raise ValueError('failed')
+        return job
+
+    pipeline = queue_helper.Pipeline(source=source, stages=[('fail', fail_on_three, 1), ('collect', results.append, 1)])
+    pipeline.start()
+
+    for item in range(5):
+        source.put_unique(item=item)
+    pipeline.join()
+
+    # the failed job is dropped, and the workers keep going
+    assert results == [0, 1, 2, 4]
+
+
+def test_pipeline_in_flight():
+    source = queue_helper.WorkQueue()
+    started = threading.Event()
+    release = threading.Event()
+    runs = []
+    runs_lock = threading.Lock()
+
+    def process(job):
+        with runs_lock:
+            runs.append(job)
+        started.set()
+        release.wait(5)
+        return job
+
+    pipeline = queue_helper.Pipeline(source=source, stages=[('process', process, 4), ('done', lambda job: None, 1)])
+    pipeline.start()
+
+    source.put_unique(item=1)
+    assert started.wait(5)
+
+    # duplicates while the item is processed must not run in parallel on the other workers
+    for _ in range(5):
+        source.put_unique(item=1, lane='listener')
+    assert runs == [1]
+
+    release.set()
+    pipeline.join()
+
+    # the duplicates are coalesced into a single run after the first one is done
+    assert runs == [1, 1]
+    assert source.stats() == dict(queued=0, in_flight=0, coalesced=5, resumed=0)
+
+
+def test_adaptive_batch_size():
+    batch_size = queue_helper.AdaptiveBatchSize(maximum=20, target_latency=1)
+    assert batch_size() == 1
+
+    # quick requests grow the batch up to the maximum
+    for _ in range(10):
+        batch_size.record(seconds=0.1)
+    assert batch_size() == 20
+
+    # requests within the target keep the batch size
+    batch_size.record(seconds=0.8)
+    assert batch_size() == 20
+
+    # slow requests shrink the batch down to the minimum
+    for _ in range(10):
+        batch_size.record(seconds=2)
+    assert batch_size() == 1
+
+
+def test_pipeline_batch():
+    source = queue_helper.WorkQueue()
+    batches = []
+    results = []
+
+    def resolve(items):
+        batches.append(len(items))
+        return [item * 2 if item % 2 else None for item in items]  # a batch can drop some of its jobs
+
+    for item in range(10):
+        source.put_unique(item=item)
+
+    pipeline = queue_helper.Pipeline(
+        source=source,
+        stages=[('resolve', resolve, 1), ('collect', results.append, 1)],
+        batch_size=lambda: 4,
+    )
+    pipeline.start()
+    pipeline.join()
+
+    assert batches == [4, 4, 2]
+    assert sorted(results) == [item * 2 for item in range(1, 10, 2)]
+    assert source.stats()['in_flight'] == 0, 'Items of the batch were not finished'
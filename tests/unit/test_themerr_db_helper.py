@@ -1,5 +1,14 @@
 # -*- coding: utf-8 -*-
 
+# standard imports
+import json
+import os
+import threading
+import time
+
+# lib imports
+import pytest
+
 # local imports
 from Code import plex_api_helper
 from Code import themerr_db_helper
@@ -33,3 +42,211 @@ def test_item_exists_with_invalid_database():
     # movie is not valid... the correct type is movies
     assert not themerr_db_helper.item_exists(database_type='movie', database='invalid', id='invalid'), \
         'Invalid database should not exist in ThemerrDB'
+
+
+def test_save_and_load_cache(empty_themerr_db_cache):
+    themerr_db_helper.update_cache()
+    expected_cache = themerr_db_helper.database_cache
+    expected_last_update = themerr_db_helper.last_cache_update
+
+    assert themerr_db_helper.save_cache(), 'Cache was not saved'
+    assert os.path.isfile(themerr_db_helper.database_cache_file), 'Cache file not found'
+
+    themerr_db_helper.database_cache = {}
+    themerr_db_helper.last_cache_update = 0
+
+    assert themerr_db_helper.load_cache(), 'Cache was not loaded'
+    assert themerr_db_helper.database_cache == expected_cache, 'Loaded cache does not match saved cache'
+    assert themerr_db_helper.last_cache_update == expected_last_update, 'Loaded cache update time does not match'
+
+
+def test_single_flight():
+    single_flight = themerr_db_helper.SingleFlight()
+    calls = []
+
+    def slow_call():
+        calls.append(1)
+        time.sleep(1)
+        return 'result'
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(single_flight.do(key='all', func=slow_call)))
+        for _ in range(5)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1, 'Concurrent callers did not join the call in progress'
+    assert results == ['result'] * 5, 'Concurrent callers did not receive the same result'
+
+    # the call is complete, so a new call runs again
+    assert single_flight.do(key='all', func=slow_call) == 'result'
+    assert len(calls) == 2
+
+
+def test_update_cache_refresh_stats(empty_themerr_db_cache):
+    stats = themerr_db_helper.update_cache()
+    assert stats['last_refresh_outcome'] == 'success'
+    assert stats['last_refresh_duration'] > 0
+
+    # a second update within the freshness window is skipped and returns the same stats
+    assert themerr_db_helper.update_cache() == stats
+
+
+def test_encode_id():
+    assert themerr_db_helper.encode_id(database='themoviedb', id=710) == 710
+    assert themerr_db_helper.encode_id(database='themoviedb', id='710') == 710
+    assert themerr_db_helper.encode_id(database='imdb', id='tt0113189') == 113189
+    assert themerr_db_helper.encode_id(database='imdb', id='0113189') is None
+    assert themerr_db_helper.encode_id(database='imdb', id=None) is None
+    assert themerr_db_helper.encode_id(database='themoviedb', id='tt0113189') is None
+    assert themerr_db_helper.encode_id(database='invalid', id=710) is None
+
+
+def test_iter_json_array():
+    items = [
+        dict(id=1, title=u'Am\u00e9lie', overview='{"not": ["a", "nested", "object"]}'),
+        dict(id=2, title='Item 2', nested=dict(ids=[1, 2, 3])),
+        dict(title='No ID'),
+    ]
+    document = json.dumps(items, indent=2, ensure_ascii=False).encode('utf-8')
+
+    expected = [dict(id=1), dict(id=2), dict()]
+
+    # any chunk size must give the same result, including chunks that split multi-byte characters
+    for chunk_size in (1, 2, 7, len(document)):
+        chunks = [document[i:i + chunk_size] for i in range(0, len(document), chunk_size)]
+        assert list(themerr_db_helper.iter_json_array(chunks=chunks, fields=['id'])) == expected
+
+    assert list(themerr_db_helper.iter_json_array(chunks=[b' [ ] '], fields=['id'])) == []
+
+
+@pytest.mark.parametrize('document', [
+    b'{"id": 1}',
+    b'[{"id": 1}',
+    b'[{"id": 1} {"id": 2}]',
+    b'[1, 2]',
+    b'',
+])
+def test_iter_json_array_invalid(document):
+    with pytest.raises(ValueError):
+        list(themerr_db_helper.iter_json_array(chunks=[document], fields=['id']))
+
+
+def test_get_index_version(empty_themerr_db_cache):
+    def publish(sha256):
+        themerr_db_helper.publish_type_cache(
+            database_type='movies',
+            pages={1: dict(validator=dict(sha256=sha256), ids={}, records=[])},
+            type_cache={},
+        )
+
+    assert themerr_db_helper.get_index_version(database_types=['movies']) is None
+
+    publish(sha256='first')
+    version = themerr_db_helper.get_index_version(database_types=['movies'])
+    assert version
+
+    # only the indexed database types are part of the version
+    assert themerr_db_helper.get_index_version(database_types=['movies', 'games']) == version
+
+    # the version changes with the content of the pages
+    publish(sha256='second')
+    assert themerr_db_helper.get_index_version(database_types=['movies']) != version
+
+
+def test_update_cache_skips_save_without_changes(empty_themerr_db_cache, monkeypatch):
+    saves = []
+    monkeypatch.setattr(themerr_db_helper, 'save_cache', lambda: saves.append(True))
+
+    # a database type in its retry backoff is skipped without a request, and there is nothing new to save
+    state = themerr_db_helper.get_type_refresh_state(database_type='games')
+    state.update(failures=1, retry_at=time.time() + 3600)
+    for _ in range(5):
+        themerr_db_helper.update_cache(database_types=['games'])
+    assert not saves, 'Cache was saved without a new snapshot'
+
+
+def test_get_page_unchanged_without_validators(monkeypatch):
+    body = json.dumps([dict(id=1, imdb_id='tt0000001'), dict(id=2, imdb_id='tt0000002')]).encode('utf-8')
+
+    class Response(object):
+        status_code = 200
+        headers = {}  # the server sends no ETag or Last-Modified
+
+        def raise_for_status(self):
+            pass
+
+        def iter_content(self, chunk_size):
+            return [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+
+        def close(self):
+            pass
+
+    class Session(object):
+        def get(self, **kwargs):
+            return Response()
+
+    monkeypatch.setattr(themerr_db_helper, 'session', Session())
+    monkeypatch.setattr(themerr_db_helper, 'page_chunk_size', 7)
+
+    entry, changed = themerr_db_helper.get_page(database_type='movies', page=1)
+    assert changed
+    assert list(entry['ids']['themoviedb']) == [1, 2]
+
+    # an unchanged page is recognized by the hash of its content, before it is parsed
+    def iter_json_array(chunks, fields):
+        raise AssertionError('Unchanged page was parsed')
+
+    monkeypatch.setattr(themerr_db_helper, 'iter_json_array', iter_json_array)
+    unchanged_entry, changed = themerr_db_helper.get_page(database_type='movies', page=1, previous=entry)
+    assert not changed
+    assert unchanged_entry['ids'] is entry['ids']
+
+    # a changed page is parsed from the spooled content
+    monkeypatch.undo()
+    monkeypatch.setattr(themerr_db_helper, 'session', Session())
+    body = json.dumps([dict(id=3, imdb_id='tt0000003')]).encode('utf-8')
+    changed_entry, changed = themerr_db_helper.get_page(database_type='movies', page=1, previous=entry)
+    assert changed
+    assert list(changed_entry['ids']['themoviedb']) == [3]
+
+
+@pytest.mark.parametrize('cache_file_content', [
+    '{"data": {"id": 1}, "fetched": 17',
+    '{"data": {"id": 1}}',
+    '{"data": {"id": 1}, "fetched": "yesterday"}',
+    '[]',
+])
+def test_get_item_data_malformed_cache(monkeypatch, tmpdir, cache_file_content):
+    monkeypatch.setattr(themerr_db_helper, 'item_cache_directory', str(tmpdir))
+    monkeypatch.setattr(themerr_db_helper, 'item_cache_stats', {
+        stat: 0 for stat in themerr_db_helper.item_cache_stats})
+
+    item_cache_file = tmpdir.join('movies', 'themoviedb', '1.json')
+    item_cache_file.write(cache_file_content, ensure=True)
+
+    class Response(object):
+        status_code = 200
+        headers = {}
+
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            return dict(id=1, title='Item 1')
+
+    class Session(object):
+        def get(self, **kwargs):
+            return Response()
+
+    monkeypatch.setattr(themerr_db_helper, 'session', Session())
+
+    # the malformed entry is treated as a cache miss, and replaced
+    data = themerr_db_helper.get_item_data(database_type='movies', database='themoviedb', id=1)
+    assert data == dict(id=1, title='Item 1')
+    assert themerr_db_helper.item_cache_stats['misses'] == 1
+    assert json.loads(item_cache_file.read())['data'] == data